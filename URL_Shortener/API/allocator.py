@@ -0,0 +1,131 @@
+import secrets  # cryptographically strong randomness, used for the pre-generated random codes
+import string  # provides a collection of string constants(ASCII characters, digits, lowercase and uppercase letters)
+import threading
+
+# Short code allocators.
+# An allocator hands out short codes that no other worker has been given, so creating a link needs a single INSERT
+# instead of a SELECT-until-unused loop. Codes are reserved from the database in blocks (one short write per block)
+# and then handed out from memory. Uniqueness across users is enforced by the unique index on url_mappings.SHORT_URL,
+# a custom code chosen by a user can still take a code first, in which case the caller just asks for the next one.
+# The allocator tables live in the main database file, next to the users (see storage.py).
+
+ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase  # the 62 characters used in short codes
+
+
+def base62_encode(number):  # turns a non-negative integer into a base62 string, e.g. 61 -> 'z', 62 -> '10'
+    if number == 0:
+        return ALPHABET[0]
+    digits = []
+    while number:
+        number, remainder = divmod(number, 62)
+        digits.append(ALPHABET[remainder])
+    return ''.join(reversed(digits))
+
+
+def base62_decode(code):  # the inverse of base62_encode
+    number = 0
+    for character in code:
+        number = number * 62 + ALPHABET.index(character)
+    return number
+
+
+class ShortCodeAllocator:  # the interface every allocator implements
+    def __init__(self, block_size=1000):
+        self.block_size = block_size  # how many codes are reserved from the database at once
+        self._block = []
+        self._lock = threading.Lock()
+
+    def next_code(self, storage):
+        # returns a fresh code, reserving a new block from the storage backend when the in-memory block is empty.
+        # The reservation is committed on its own connection.
+        with self._lock:
+            if not self._block:
+                self._block = self._reserve_block(storage, self.block_size)
+                self._block.reverse()  # pop() from the end hands the codes out in the order they were reserved
+            return self._block.pop()
+
+    def next_codes(self, storage, count):  # returns count fresh codes at once, used by the batch endpoints
+        with self._lock:
+            codes = self._block[-count:][::-1] if count else []
+            del self._block[len(self._block) - len(codes):]
+            missing = count - len(codes)
+            if missing:
+                # one reservation covers the whole batch, the leftover codes stay in memory for the next request
+                reserved = self._reserve_block(storage, max(missing, self.block_size))
+                codes.extend(reserved[:missing])
+                self._block = reserved[missing:][::-1]
+            return codes
+
+    def _reserve_block(self, storage, count):  # returns a list of count codes no other worker will receive
+        raise NotImplementedError
+
+
+class SequenceAllocator(ShortCodeAllocator):
+    # base62 encoding of a monotonic sequence stored in the code_sequences table.
+    # Codes are short and never repeat, but consecutive codes are guessable.
+
+    def __init__(self, block_size=1000, min_length=6, sequence='short_code'):
+        super().__init__(block_size)
+        self.offset = 62 ** (min_length - 1)  # the smallest number whose base62 form has min_length characters
+        self.sequence = sequence
+
+    def _reserve_block(self, storage, count):
+        with storage.meta_connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                start = conn.execute('SELECT NEXT_VALUE FROM code_sequences WHERE NAME = ?',
+                                     (self.sequence,)).fetchone()[0]
+                conn.execute('UPDATE code_sequences SET NEXT_VALUE = ? WHERE NAME = ?',
+                             (start + count, self.sequence))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return [base62_encode(self.offset + number) for number in range(start, start + count)]
+
+
+class RandomPoolAllocator(ShortCodeAllocator):
+    # random codes pre-generated into the code_pool table.
+    # A worker claims a block of them by moving them out of the pool, the pool is refilled with new random codes that
+    # are not used by any mapping when it runs low. Codes are not guessable from one another.
+
+    def __init__(self, block_size=1000, code_length=6):
+        super().__init__(block_size)
+        self.code_length = code_length
+
+    def _random_code(self):
+        return ''.join(secrets.choice(ALPHABET) for _ in range(self.code_length))
+
+    def _refill(self, conn, storage, count):  # adds up to count unused random codes to the pool
+        candidates = {self._random_code() for _ in range(count)}
+        candidates -= storage.existing_short_codes(candidates)  # the mappings may live in other files
+        conn.executemany('INSERT OR IGNORE INTO code_pool (CODE) VALUES (?)', ((code,) for code in candidates))
+
+    def _reserve_block(self, storage, count):
+        with storage.meta_connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                codes = [row[0] for row in conn.execute('SELECT CODE FROM code_pool LIMIT ?', (count,))]
+                while len(codes) < count:
+                    self._refill(conn, storage, count * 2)  # top up the pool for this and the next reservation
+                    codes = [row[0] for row in conn.execute('SELECT CODE FROM code_pool LIMIT ?', (count,))]
+                conn.executemany('DELETE FROM code_pool WHERE CODE = ?', ((code,) for code in codes))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return codes
+
+
+ALLOCATORS = {  # the allocators that can be selected with the SHORT_CODE_ALLOCATOR setting
+    'sequence': SequenceAllocator,
+    'pool': RandomPoolAllocator,
+}
+
+
+def make_allocator(name, **options):  # builds the allocator registered under name
+    try:
+        allocator_class = ALLOCATORS[name]
+    except KeyError:
+        raise ValueError(f"Unknown short code allocator: {name!r}") from None
+    return allocator_class(**options)
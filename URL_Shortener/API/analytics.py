@@ -0,0 +1,111 @@
+import atexit  # for flushing the buffered clicks when the process exits
+import logging
+import threading
+import time
+from collections import Counter, deque
+from urllib.parse import urlsplit
+
+# Click analytics with write-behind counters.
+# A redirect only appends (short code, time bucket, referrer) to an in-memory buffer. A background thread drains the
+# buffer every flush_interval seconds (or as soon as it holds flush_size clicks), adds up identical clicks and writes
+# them to url_clicks with one batched upsert (Storage.record_clicks), so redirects never wait for SQLite's write lock.
+
+logger = logging.getLogger(__name__)
+
+
+def referrer_host(referrer):  # keeps only the host of a referrer, '' for direct visits
+    if not referrer:
+        return ''
+    if '//' not in referrer:
+        return referrer  # already reduced to a host (clicks put back into the buffer after a failed flush)
+    return urlsplit(referrer).hostname or ''
+
+
+class ClickRecorder:
+    def __init__(self, storage, flush_interval=5.0, flush_size=10000, bucket_seconds=3600):
+        self.storage = storage  # the storage backend the clicks are written to
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.bucket_seconds = bucket_seconds  # clicks are counted per hour by default
+        self._buffer = deque()  # appends and pops on a deque are thread safe, no lock is needed on the hot path
+        self._wake = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+    def record(self, short_code, referrer=None):  # called by the redirect routes, only touches memory
+        now = int(time.time())
+        self._buffer.append((short_code, now - now % self.bucket_seconds, referrer))
+        if self._thread is None:
+            self.start()
+        if len(self._buffer) >= self.flush_size:
+            self._wake.set()
+
+    def start(self):  # starts the background flusher, done lazily on the first recorded click
+        with self._flush_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='click-flusher', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Error while flushing clicks")  # they stay counted in memory until the next flush
+
+    def flush(self):  # writes everything buffered so far, returns the number of clicks written
+        with self._flush_lock:
+            counts = Counter()
+            drained = 0
+            while True:
+                try:
+                    short_code, bucket, referrer = self._buffer.popleft()
+                except IndexError:
+                    break
+                counts[short_code, bucket, referrer_host(referrer)] += 1
+                drained += 1
+
+            if not counts:
+                return 0
+
+            rows = [(short_code, bucket, host, clicks) for (short_code, bucket, host), clicks in counts.items()]
+            try:
+                failed = self.storage.record_clicks(rows)
+            except Exception:
+                self._put_back(rows)
+                raise
+            self._put_back(failed)
+            return drained - sum(clicks for _, _, _, clicks in failed)
+
+    def _put_back(self, rows):  # puts clicks that could not be written back into the buffer so they are not lost
+        self._buffer.extend((code, bucket, host) for code, bucket, host, clicks in rows for _ in range(clicks))
+
+    def stop(self):  # stops the flusher and writes out whatever is still buffered
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.flush_interval + 5)
+        self.flush()
+
+
+def link_stats(storage, short_code):  # the click statistics of a single link, read from the aggregated table
+    total, buckets, referrers = storage.link_clicks(short_code)
+    return {
+        'short_code': short_code,
+        'clicks': total,
+        'buckets': [{'start': bucket, 'clicks': clicks} for bucket, clicks in buckets],
+        'referrers': [{'referrer': referrer or None, 'clicks': clicks} for referrer, clicks in referrers],
+    }
+
+
+def user_stats(storage, user_id):  # the total clicks of every link owned by a user
+    rows = storage.user_clicks(user_id)
+    return {
+        'clicks': sum(total for _, total in rows),
+        'links': [{'short_code': short_code, 'clicks': total} for short_code, total in rows],
+    }
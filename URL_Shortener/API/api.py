@@ -0,0 +1,75 @@
+import hashlib
+import json
+import secrets
+
+from flask import Response
+
+from cache import LRUCache
+
+# Helpers of the versioned JSON API (/api/v1 in app.py).
+# The API is meant for services calling it millions of times a day, so it skips everything the HTML views pay for:
+# callers authenticate with a bearer token instead of a session cookie (nothing is read from or written to the Flask
+# session), responses are built straight from a pre-configured json.JSONEncoder (compact, unsorted keys, no
+# app.json provider) and no template is rendered. Tokens are random, only their SHA-256 is stored, and the token ->
+# user lookups are kept in an LRU cache so most calls never query the users file for authentication.
+
+TOKEN_BYTES = 32  # random bytes per token, 43 characters once encoded
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), check_circular=False)
+
+
+def json_response(payload, status=200):  # a compact JSON response, built without Flask's JSON provider
+    return Response(_encoder.encode(payload), status=status, mimetype='application/json')
+
+
+def api_error(message, status):  # the error body of every API route, {"error": "..."}
+    response = json_response({'error': message}, status)
+    if status == 401:
+        response.headers['WWW-Authenticate'] = 'Bearer'
+    return response
+
+
+def hash_token(token):  # tokens carry 256 random bits, a fast hash is enough to keep them out of the database
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def new_token():  # returns (token, its hash), the token itself is shown to the user once and never stored
+    token = secrets.token_urlsafe(TOKEN_BYTES)
+    return token, hash_token(token)
+
+
+def bearer_token(request):  # the token of an "Authorization: Bearer <token>" header, None without one
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    token = token.strip()
+    return token if scheme.lower() == 'bearer' and token else None
+
+
+def link_etag(short_code, long_url, expires_at):  # changes whenever what a code resolves to changes
+    return hashlib.blake2b(f'{short_code}\0{long_url}\0{expires_at}'.encode('utf-8'), digest_size=8).hexdigest()
+
+
+class TokenAuthenticator:  # maps bearer tokens to user IDs, with an in-memory cache in front of the api_tokens table
+    def __init__(self, storage, cache_size=10000, ttl=60, negative_ttl=5):
+        self.storage = storage
+        # a revoked token keeps working in other worker processes for at most ttl seconds
+        self._cache = LRUCache(max_size=cache_size, ttl=ttl, negative_ttl=negative_ttl)
+
+    def user_id(self, token):  # the owner of a token, None for a missing or unknown token
+        if not token:
+            return None
+        token_hash = hash_token(token)
+        found, user_id = self._cache.get(token_hash)
+        if not found:
+            user_id = self.storage.find_token(token_hash)
+            self._cache.set(token_hash, user_id)
+        return user_id
+
+    def create(self, user_id, name, created_at):  # returns a new token of the user
+        token, token_hash = new_token()
+        self.storage.create_token(user_id, token_hash, name, created_at)
+        return token
+
+    def revoke(self, token):
+        token_hash = hash_token(token)
+        self.storage.delete_token(token_hash)
+        self._cache.invalidate(token_hash)
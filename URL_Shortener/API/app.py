@@ -1,11 +1,11 @@
+import atexit  # for running clean-up code (such as saving the short code filter) when the process exits
+import logging
 import sqlite3  # for database operations, a database engine, a relational database management system
-import random
-import string  # provides a collection of string constants(ASCII characters, digits, lowercase and uppercase letters,
-# and various string-related constants)
-
-import segno  # a python library for generating qr codes
-
-from flask import Flask, request, redirect, render_template, url_for, flash, session
+import threading
+import time
+from functools import wraps
+from flask import Flask, request, redirect, render_template, url_for, flash, session, abort, jsonify, Response, \
+    stream_with_context, make_response
 
 # Flask: This is the main class of the Flask framework, represents a Flask web application, creating an instance of
 # this class to define and run web application
@@ -22,9 +22,17 @@ from flask import Flask, request, redirect, render_template, url_for, flash, ses
 
 # session: a dictionary-like object that allows you to keep user-specific information.
 
+# abort: a function that stops the request with an HTTP error code (e.g. 404).
+
+# jsonify: a function that turns a Python dict into a JSON response.
+
+# Response: the response class, used to send raw bytes such as QR code images.
+
+# stream_with_context: keeps the request available while a generator streams a response piece by piece.
+
+# make_response: turns a view's return value into a response object, used to add headers such as Retry-After.
+
 
-from werkzeug.security import check_password_hash, generate_password_hash
-# Werkzeug is utility library for WSGI that provides security related functions
 
 
 from flask_login import LoginManager, UserMixin, login_user, login_required
@@ -44,15 +52,242 @@ from flask_login import LoginManager, UserMixin, login_user, login_required
 # ----These components collectively contribute to the implementation of user authentication and session management in a
 # Flask application using Flask-Login.------
 
+import db
+# db: the connection pool, every storage call borrows a long-lived connection from it instead of opening a new one
+
+from storage import make_storage  # every query against users, url_mappings and url_clicks, in one or several files
+from short_codes import normalize_short_code, format_short_url, short_code_error
+# normalize_short_code: turns a 'https://short-url/XXXXXX' (or bare) input into the bare code stored in the database
+# format_short_url: turns a stored code back into the full short URL shown to the user
+# short_code_error: why a custom code cannot be used (characters, length, a route of this application)
+from long_urls import long_url_error  # rejects anything but absolute http(s) URLs, e.g. javascript: links
+
+from cache import LRUCache  # an in-process LRU cache with expiry, keeps hot short code -> long URL lookups in memory
+from allocator import make_allocator  # hands out unused short codes from blocks reserved in the database
+from batch import BatchError, parse_batch_body, create_mappings  # bulk link creation in a single transaction
+from analytics import ClickRecorder, link_stats, user_stats  # buffered click counting and the statistics
+from qr import QRCodeCache, FORMATS as QR_FORMATS  # QR code images cached by a hash of their content
+import listing  # keyset pagination and streaming export of a user's links
+from cuckoo import ShortCodeFilter  # an in-memory filter answering "this short code does not exist" without SQL
+import metrics  # request, SQL, template and QR timings, exposed in the Prometheus format at /metrics
+from metrics import PASSWORD_HASH_SECONDS
+from hashing import PasswordHasher, HashingSaturated, TokenBucketLimiter
+from expiry import LinkPurger, parse_expiry  # link expiry times and the background purge of expired links
+from api import TokenAuthenticator, api_error, bearer_token, json_response, link_etag  # the /api/v1 helpers
+# PasswordHasher: hashes and checks passwords in a separate, bounded pool of processes
+# HashingSaturated: raised when that pool is full, the request is turned away instead of waiting
+# TokenBucketLimiter: limits how often a single IP address or email may try to sign in or sign up
+
 # -------------------------------------------------------------------
 
 
-app = Flask(__name__)  # initializing flask project, creating a Flask application instance named 'app'
-# Flask(__name__) tells Flask to look for resources (templates, static files, etc.) relative to the current module.
+ROUTES = []  # (rule, options, view) of every route of this module, registered on the application by create_app()
+
+
+def route(rule, **options):  # used like app.route(), the views are defined before the application that serves them
+    def decorator(view):
+        ROUTES.append((rule, options, view))
+        return view
+    return decorator
+
+
+# The subsystems of the application, built by create_app(). Like the connection pool in db.py they exist once per
+# process: a worker builds one application and the views below use these.
+storage = None  # every query against users, url_mappings and url_clicks
+redirect_cache = None  # the cache used by the public GET /<code> redirect route
+short_code_allocator = None  # the allocator used for every short code the user does not choose themselves
+click_recorder = None  # records redirects in memory, a background thread writes them to the url_clicks table
+qr_cache = None  # renders each QR code once and serves it from memory afterwards
+short_code_filter = None  # answers "this short code does not exist" without a query
+password_hasher = None  # hashes and checks passwords in a separate pool of processes
+ip_limiter = None  # sign in / sign up attempts per IP address
+email_limiter = None  # sign in attempts per email address
+api_tokens = None  # the bearer tokens of the JSON API, looked up once per token and minute
+link_purger = None  # deletes expired links in the background
+
+
+def create_app(config=None):
+    # builds the application: settings, database schema, caches and background workers, once per process. A WSGI
+    # server loads it as "app:create_app()", or as "app:app", which calls this on first use (see __getattr__ below).
+    global app, storage, redirect_cache, short_code_allocator, click_recorder, qr_cache, short_code_filter, \
+        password_hasher, ip_limiter, email_limiter, api_tokens, link_purger
+
+    app = Flask(__name__)  # initializing flask project, creating a Flask application instance named 'app'
+    # Flask(__name__) tells Flask to look for resources (templates, static files, etc.) relative to the current module.
+
+    app.config.update(config or {})  # the settings passed in win over the defaults below
+
+    app.secret_key = app.config['SECRET_KEY'] or 'your_secret_key'  # a secret key to ensure the integrity of session
+    # data, Flask always has a SECRET_KEY setting (None by default) so setdefault() would not apply here
+    app.config.setdefault('REDIRECT_STATUS', 302)  # 302 so browsers keep asking us, 301 lets them cache the redirect
+    app.config.setdefault('REDIRECT_CACHE_SIZE', 100000)  # maximum number of short codes kept in memory
+    app.config.setdefault('REDIRECT_CACHE_TTL', 300)  # seconds a cached long URL is trusted
+    app.config.setdefault('REDIRECT_CACHE_NEGATIVE_TTL', 30)  # seconds an unknown short code is remembered as unknown
+    app.config.setdefault('SHORT_CODE_ALLOCATOR', 'sequence')  # 'sequence' (base62 counter) or 'pool' (random codes)
+    app.config.setdefault('SHORT_CODE_BLOCK_SIZE', 1000)  # how many codes a worker reserves from the database at once
+    app.config.setdefault('BATCH_MAX_ITEMS', 100000)  # the largest batch accepted by /shorten-url/batch
+    app.config.setdefault('ANALYTICS_FLUSH_INTERVAL', 5.0)  # seconds between writes of the buffered clicks
+    app.config.setdefault('ANALYTICS_FLUSH_SIZE', 10000)  # buffered clicks that trigger an early write
+    app.config.setdefault('ANALYTICS_BUCKET_SECONDS', 3600)  # clicks are counted per hour
+    app.config.setdefault('QR_CACHE_DIR', 'qr_cache')  # where rendered QR codes are kept on disk
+    app.config.setdefault('QR_CACHE_MEMORY_BYTES', 32 * 1024 * 1024)  # how many bytes of QR images are kept in memory
+    app.config.setdefault('QR_MAX_AGE', 86400)  # seconds browsers and proxies may cache a QR code image
+    app.config.setdefault('LIST_PAGE_SIZE', 100)  # links shown per page of /list-urls
+    app.config.setdefault('LIST_MAX_PAGE_SIZE', 1000)  # the largest page a client may ask for
+    app.config.setdefault('EXPORT_CHUNK_SIZE', 1000)  # links read per query while streaming an export
+    app.config.setdefault('SHORT_CODE_FILTER', True)  # keep a cuckoo filter of all short codes in memory
+    app.config.setdefault('SHORT_CODE_FILTER_SNAPSHOT', 'short_codes.filter')  # where the filter is saved between runs
+    app.config.setdefault('SHORT_CODE_FILTER_REFRESH', 1.0)  # seconds before codes created by other workers are seen
+    app.config.setdefault('SLOW_REQUEST_SECONDS', None)  # log requests slower than this with their SQL, None disables
+    app.config.setdefault('PASSWORD_HASH_METHOD', 'scrypt')  # other hashes are replaced at the user's next login
+    app.config.setdefault('PASSWORD_HASH_WORKERS', 2)  # processes dedicated to password hashing
+    app.config.setdefault('PASSWORD_HASH_QUEUE', 16)  # hashes allowed to wait for a free process before rejecting
+    app.config.setdefault('PASSWORD_HASH_TIMEOUT', 5.0)  # seconds a request waits for its hash at most
+    app.config.setdefault('AUTH_IP_RATE', 1.0)  # sign in / sign up attempts per second and IP address...
+    app.config.setdefault('AUTH_IP_BURST', 20)  # ...with bursts of up to this many
+    app.config.setdefault('AUTH_EMAIL_RATE', 0.2)  # sign in attempts per second and email address...
+    app.config.setdefault('AUTH_EMAIL_BURST', 5)  # ...with bursts of up to this many
+    app.config.setdefault('STORAGE_SHARDS', 1)  # database files the links are spread over, move them with reshard.py
+    app.config.setdefault('STORAGE_SHARD_PATH', 'url_shortener.shard{}.db')  # the shard files, {} is the shard number
+    app.config.setdefault('DEDUP_MODE', 'off')  # 'user' gives a long URL the user shortened before its existing code
+    app.config.setdefault('LINK_DEFAULT_TTL', None)  # seconds a link lives when no expiry is given, None: forever
+    app.config.setdefault('LINK_PURGE_INTERVAL', 60.0)  # seconds between purges of expired links, None disables them
+    app.config.setdefault('LINK_PURGE_BATCH', 500)  # expired links deleted per transaction
+    app.config.setdefault('LINK_VACUUM_PAGES', 1000)  # free pages handed back to the file system per step after a purge
+    app.config.setdefault('API_TOKEN_CACHE_TTL', 60)  # seconds a token is trusted without asking the database again
+    app.config.setdefault('API_RESOLVE_MAX_AGE', 60)  # seconds clients may cache a link from /api/v1/links/<code>
+    app.config.setdefault('WARM_CACHES', False)  # load the short code filter and fill the caches on a background thread
+    app.config.setdefault('WARM_REDIRECT_LINKS', 1000)  # the most clicked links put into the redirect cache by it
+    app.config.setdefault('WARM_CLICKS_SECONDS', 86400)  # how far back "most clicked" looks
+
+    if app.config['DEDUP_MODE'] not in ('off', 'user'):
+        raise ValueError(f"DEDUP_MODE must be 'off' or 'user', not {app.config['DEDUP_MODE']!r}")
+
+    db.init_app(app)  # applies the DATABASE, DB_POOL_SIZE and DB_POOL_TIMEOUT settings to the connection pool
+    metrics.init_app(app)  # times every request and every template rendering
+    login_manager.init_app(app)
+
+    storage = make_storage(db.pool, shard_count=app.config['STORAGE_SHARDS'],
+                           shard_path=app.config['STORAGE_SHARD_PATH'], pool_size=db.pool.max_size)
+    storage.migrate()  # creating the tables and indexes (or upgrading an old database) here, never in a request
+
+    redirect_cache = LRUCache(max_size=app.config['REDIRECT_CACHE_SIZE'], ttl=app.config['REDIRECT_CACHE_TTL'],
+                              negative_ttl=app.config['REDIRECT_CACHE_NEGATIVE_TTL'])
+    short_code_allocator = make_allocator(app.config['SHORT_CODE_ALLOCATOR'],
+                                          block_size=app.config['SHORT_CODE_BLOCK_SIZE'])
+    click_recorder = ClickRecorder(storage, flush_interval=app.config['ANALYTICS_FLUSH_INTERVAL'],
+                                   flush_size=app.config['ANALYTICS_FLUSH_SIZE'],
+                                   bucket_seconds=app.config['ANALYTICS_BUCKET_SECONDS'])
+    qr_cache = QRCodeCache(cache_dir=app.config['QR_CACHE_DIR'],
+                           max_memory_bytes=app.config['QR_CACHE_MEMORY_BYTES'])
+
+    short_code_filter = ShortCodeFilter(storage, snapshot_path=app.config['SHORT_CODE_FILTER_SNAPSHOT'],
+                                        refresh_interval=app.config['SHORT_CODE_FILTER_REFRESH'])
+    if app.config['SHORT_CODE_FILTER']:
+        if not app.config['WARM_CACHES']:
+            short_code_filter.load()  # loads the snapshot (or builds the filter from url_mappings) before serving
+        atexit.register(short_code_filter.save)  # the next start only has to catch up with the newest rows
+
+    password_hasher = PasswordHasher(workers=app.config['PASSWORD_HASH_WORKERS'],
+                                     max_queue=app.config['PASSWORD_HASH_QUEUE'],
+                                     timeout=app.config['PASSWORD_HASH_TIMEOUT'],
+                                     method=app.config['PASSWORD_HASH_METHOD'])
+    password_hasher.start()  # forks the hashing processes now, before the cache warming thread below is started
+    atexit.register(password_hasher.shutdown)
+
+    ip_limiter = TokenBucketLimiter(app.config['AUTH_IP_RATE'], app.config['AUTH_IP_BURST'])
+    email_limiter = TokenBucketLimiter(app.config['AUTH_EMAIL_RATE'], app.config['AUTH_EMAIL_BURST'])
+    api_tokens = TokenAuthenticator(storage, ttl=app.config['API_TOKEN_CACHE_TTL'])
+    link_purger = LinkPurger(storage, interval=app.config['LINK_PURGE_INTERVAL'] or 0,
+                             batch_size=app.config['LINK_PURGE_BATCH'], vacuum_pages=app.config['LINK_VACUUM_PAGES'],
+                             on_purge=forget_links)
+
+    app.before_request(start_link_purger)
+    for rule, options, view in ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+
+    if app.config['WARM_CACHES']:
+        # the worker takes requests right away, the filter answers "might exist" for every code until it is loaded
+        threading.Thread(target=warm_caches, name='cache-warmer', daemon=True).start()
+    return app
+
+
+def warm_caches():  # loads what the first requests would otherwise wait for, on a background thread
+    started = time.perf_counter()
+    try:
+        if app.config['SHORT_CODE_FILTER']:
+            short_code_filter.load()
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)  # compiled here instead of by the first request rendering it
+        since = int(time.time()) - app.config['WARM_CLICKS_SECONDS']
+        links = storage.most_clicked(since, app.config['WARM_REDIRECT_LINKS'])
+        for short_code, _ in links:
+            resolve_link(short_code)  # fills the redirect cache
+    except Exception:
+        app.logger.exception("Error while warming the caches")  # the requests fill them as they come
+        return
+    app.logger.info("Warmed the caches with %d links in %.2fs", len(links), time.perf_counter() - started)
+
+
+def forget_links(short_codes):  # called with every batch of purged links
+    for short_code in short_codes:
+        redirect_cache.invalidate(short_code)
+
+
+def start_link_purger():  # started by the first request, so every worker of a pre-forking server runs its own thread
+    if app.config['LINK_PURGE_INTERVAL']:
+        link_purger.start()
+
 
-app.secret_key = 'your_secret_key'  # a secret key for the Flask application to ensure the integrity of session data
+def short_code_might_exist(short_code):  # False means the code is definitely not in the database
+    return short_code_filter.might_contain(short_code)
 
-login_manager = LoginManager(app)  # creating a LoginManager object, the LoginManager is used to manage user
+
+def delete_link(user_id, short_code):  # deletes a link of the user everywhere it is known, True if there was one
+    # make sure the filter holds this code before its fingerprint is removed below
+    short_code_filter.refresh(force=True)
+    if not storage.delete_mapping(user_id, short_code):
+        return False
+    redirect_cache.invalidate(short_code)  # stop the public redirect from serving it
+    short_code_filter.remove(short_code)
+    return True
+
+
+def existing_short_code(long_url, user_id):  # the code a long URL already has under DEDUP_MODE, None otherwise
+    if app.config['DEDUP_MODE'] == 'off' or not long_url:
+        return None
+    # one lookup in the LONG_URL_HASH index, of the user's own links only: handing out another user's code would
+    # give the link no row of its own, and deleting theirs would break it
+    return storage.find_short_codes([long_url], user_id).get(long_url)
+
+
+def create_link(user_id, long_url, custom_short_code, created_at, expires_at=None):
+    # creates a link for /shorten-url and the JSON API, returns (short code, created). created is False when
+    # DEDUP_MODE handed back the code the long URL already has. Raises sqlite3.IntegrityError for a taken custom code.
+    if custom_short_code:
+        short_code = custom_short_code
+        # short codes are unique across all users, the unique index rejects a code that is already taken
+        storage.insert_mapping(user_id, long_url, short_code, created_at, expires_at)
+    else:
+        # a long URL shortened before keeps its code, unless the new link is meant to expire
+        short_code = existing_short_code(long_url, user_id) if expires_at is None else None
+        if short_code is not None:
+            return short_code, False
+        while short_code is None:
+            # allocated codes are never handed out twice, the insert only fails in the rare case that a user
+            # already picked the same code as a custom code, then the next allocated code is used
+            short_code = short_code_allocator.next_code(storage)
+            try:
+                storage.insert_mapping(user_id, long_url, short_code, created_at, expires_at)
+            except sqlite3.IntegrityError:
+                short_code = None
+
+    short_code_filter.add(short_code)
+    redirect_cache.invalidate(short_code)  # drop a negative entry cached while the code was still unknown
+    return short_code, True
+
+
+login_manager = LoginManager()  # creating a LoginManager object, the LoginManager is used to manage user
 # authentication and session management.
 
 login_manager.login_view = 'signin'  # specifying the route where Flask-Login should redirect users if they are
@@ -80,31 +315,29 @@ def load_user(user_id):
 # The secret key is used for session security, and the login manager helps in handling user authentication.
 
 
-@app.route('/')  # a decorator to specify that the associated function (home()) should be called when the user visits
+@route('/')  # a decorator to specify that the associated function (home()) should be called when the user visits
 # the root URL of the application.
 def home():  # function is executed when a user accesses the root URL
     return render_template("main.html")  # Renders the main.html template for the home page.
 
 
-@app.route('/signup', methods=["GET", "POST"])  # a route for user signup with support for both GET and POST methods
+def too_many_attempts(template, wait):  # the 429 response used when a client is throttled
+    flash("Too many attempts. Please wait a moment and try again.")
+    response = make_response(render_template(template), 429)
+    response.headers['Retry-After'] = str(int(wait) + 1)
+    return response
+
+
+def hashing_busy(template):  # the 503 response used when the password hashing pool is full
+    flash("The service is busy right now. Please try again in a moment.")
+    response = make_response(render_template(template), 503)
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+@route('/signup', methods=["GET", "POST"])  # a route for user signup with support for both GET and POST methods
 def signup():
-    conn = sqlite3.connect("url_shortener.db")  # connecting to the SQLite database
-    # Establishing a connection to the SQLite database named "url_shortener.db"
-    c = conn.cursor()
-
-    # creating users and url_mappings tables if they don't exist
-    c.execute(
-        'CREATE TABLE IF NOT EXISTS users '
-        '(ID INTEGER PRIMARY KEY AUTOINCREMENT, NAME TEXT, EMAIL TEXT UNIQUE, PASSWORD TEXT)'
-    )
-    c.execute(
-        'CREATE TABLE IF NOT EXISTS url_mappings '
-        '(URL_ID INTEGER PRIMARY KEY AUTOINCREMENT,  USER_ID INTEGER, LONG_URL TEXT, SHORT_URL TEXT, '
-        'FOREIGN KEY (USER_ID) REFERENCES users(ID))'
-    )
-    # committing the changes to the database and close the connection
-    conn.commit()
-    conn.close()
+    # the users and url_mappings tables are created by the migrations create_app() runs, once per process
 
     if request.method == "POST":  # check if the request method is POST
 
@@ -112,27 +345,29 @@ def signup():
         name = request.form.get('NAME')
         email = request.form.get('EMAIL')
         password = request.form.get('PASSWORD')
-        hashed_password = generate_password_hash(password)
-        # generate_password_hash: This function is used to hash a password
+
+        wait = ip_limiter.allow(request.remote_addr)  # throttles signup waves coming from a single address
+        if wait:
+            return too_many_attempts("signup.html", wait)
 
         try:
-            conn = sqlite3.connect('url_shortener.db')  # connect to the database again
-            cursor = conn.cursor()
             # Checks if a user with the provided email already exists in the database.
-            cursor.execute("SELECT * FROM users WHERE EMAIL = ?", (email,))
-            existing_user = cursor.fetchone()
+            existing_user = storage.find_user(email)
 
             if existing_user:
                 # If the email is already in use, shows an error message and redirects to the signup page.
                 flash("Email already in use. Please use a different email.")
                 return redirect(url_for('signup'))
             else:
+                # Hashes the password in the hashing pool, only once we know the email is free
+                try:
+                    with PASSWORD_HASH_SECONDS.time('generate'):
+                        hashed_password = password_hasher.generate(password)
+                except HashingSaturated:
+                    return hashing_busy("signup.html")
+
                 # Inserts a new user into the users table if the email is unique.
-                cursor.execute("INSERT INTO users (NAME, EMAIL, PASSWORD) VALUES (?, ?, ?)",
-                               (name, email, hashed_password))
-                conn.commit()
-                cursor.close()   # close the cursor and connection
-                conn.close()
+                storage.create_user(name, email, hashed_password)
 
                 # Sets a session flag indicating successful signup and redirects to the signup success page.
                 session['signed_up'] = True
@@ -140,14 +375,14 @@ def signup():
                 # Redirect to the signup success page
                 return redirect(url_for('signup_success'))
 
-        except Exception as e:
+        except Exception:
             flash("An error occurred during signup. Please try again.")  # Flash an error message
-            print("Error during signup:", str(e))  # Print the error for debugging
+            app.logger.exception("Error during signup")  # log the error with its traceback for debugging
 
     return render_template("signup.html")
 
 
-@app.route('/signin', methods=["GET", "POST"])  # Sign-in route supporting both GET and POST methods
+@route('/signin', methods=["GET", "POST"])  # Sign-in route supporting both GET and POST methods
 def signin():
     if request.method == "POST":  # handling form submission (if method is POST)
 
@@ -155,15 +390,12 @@ def signin():
         email = request.form.get('EMAIL')
         password = request.form.get('PASSWORD')
 
-        # connecting to the db, creating cursor object
-        conn = sqlite3.connect('url_shortener.db')
-        cursor = conn.cursor()
+        # throttles credential stuffing, both from a single address and against a single account
+        wait = max(ip_limiter.allow(request.remote_addr), email_limiter.allow((email or '').lower()))
+        if wait:
+            return too_many_attempts("signin.html", wait)
 
-        cursor.execute("SELECT ID, PASSWORD FROM users WHERE EMAIL = ?", (email,))
-        user_data = cursor.fetchone()   # Fetch user data based on the provided email
-
-        cursor.close()
-        conn.close()
+        user_data = storage.find_user(email)   # Fetch user data based on the provided email
 
         if user_data:  # checks if user data was successfully retrieved from the database. If a user with the provided
             # email exists, the code proceeds
@@ -171,7 +403,21 @@ def signin():
             stored_hash = user_data[1]  # Retrieve the hashed password from the database
 
             # Checks if the entered password matches the stored hashed password in the database.
-            if stored_hash and check_password_hash(stored_hash, password):
+            try:
+                with PASSWORD_HASH_SECONDS.time('check'):
+                    password_matches = bool(stored_hash) and password_hasher.check(stored_hash, password)
+            except HashingSaturated:
+                return hashing_busy("signin.html")
+
+            if password_matches:
+                # Rehashes the password if it was hashed with other cost parameters than the configured ones
+                if password_hasher.needs_rehash(stored_hash):
+                    try:
+                        with PASSWORD_HASH_SECONDS.time('generate'):
+                            new_hash = password_hasher.generate(password)
+                        storage.update_password(user_data[0], new_hash)
+                    except HashingSaturated:
+                        pass  # not urgent, it is tried again at the next login
 
                 # If the password is correct, creates a user object and logs in the user using Flask-Login.
                 user = User(user_data[0])  # Create an instance of the User class
@@ -192,31 +438,25 @@ def signin():
     return render_template("signin.html")  # Render the signin.html template for GET requests
 
 
-@app.route('/signup-success')
+@route('/signup-success')
 def signup_success():  # a route that displays success message and asks user if they want to sign in or go to home page
     return render_template('signup_success.html')
 
 
-@app.route('/logout', methods=["GET", "POST"])  # a route to log out the user & redirect them to home page
+@route('/logout', methods=["GET", "POST"])  # a route to log out the user & redirect them to home page
 @login_required
 def logout():
     session.clear()  # resetting the information stored about a user during their visit to website
     return redirect(url_for('home'))  # Redirects the user to the home page after logging out.
 
 
-def generate_random_short_code():  # Function to generate a random string of 6 uppercase letters
-    characters = string.ascii_uppercase  # generating a string containing all uppercase letters
-    return ''.join(random.choice(characters) for _ in range(6))
-    # Generates a random string of 6 uppercase letters by choosing characters randomly from the string.
-
-
-@app.route('/urlshortener', methods=["GET", "POST"])  # a route to go to the url shortener page
+@route('/urlshortener', methods=["GET", "POST"])  # a route to go to the url shortener page
 # @login_required
 def urlshortner():
     return render_template('index.html')  # Renders the index.html template, displaying the URL shortener page.
 
 
-@app.route('/shorten-url', methods=['POST'])
+@route('/shorten-url', methods=['POST'])
 @login_required
 def shorten_url_endpoint():
     user_id = session.get('user_id')
@@ -225,91 +465,100 @@ def shorten_url_endpoint():
         flash("User not logged in.")
         return redirect(url_for('signin'))
 
-    original_url = request.form.get('original_url')
-    custom_short_code = request.form.get('custom_short_code')
+    original_url = (request.form.get('original_url') or '').strip()
+    custom_short_code = normalize_short_code(request.form.get('custom_short_code'))
 
-    conn = sqlite3.connect('url_shortener.db')
-    cursor = conn.cursor()
+    # the same checks as the JSON API, the batch route and bulk.py: GET /<code> redirects to whatever is stored here
+    error = long_url_error(original_url) if original_url else "a URL is required"
+    if not error and custom_short_code:
+        error = short_code_error(custom_short_code)
+    if error:
+        flash(f"Invalid input: {error}.")
+        return redirect(request.referrer or url_for('urlshortner'))
 
     try:
-        if custom_short_code:
-            check_existing_mapping_query = "SELECT * FROM url_mappings WHERE USER_ID = ? AND SHORT_URL = ?"
-            existing_mapping = cursor.execute(check_existing_mapping_query,
-                                              (user_id, f'https://short-url/{custom_short_code}')).fetchone()
-
-            if existing_mapping:
-                flash(f"Short code '{custom_short_code}' is already in use for your account. "
-                      f"Please choose another.")
-                return redirect(request.referrer)
-
-        valid_short_code_found = False
-        short_code = custom_short_code or generate_random_short_code()
-
-        while not valid_short_code_found:
-            existing_mapping = cursor.execute("SELECT * FROM url_mappings WHERE USER_ID = ? AND SHORT_URL = ?",
-                                              (user_id, f'https://short-url/{short_code}')).fetchone()
-
-            if not existing_mapping:
-                valid_short_code_found = True
-            else:
-                short_code = generate_random_short_code()
+        # only the bare code is stored, the 'https://short-url/' prefix is added back when it is displayed
+        created_at = int(time.time())
+        try:
+            expires_at = parse_expiry(request.form.get('expires_in'), request.form.get('expires_at'),
+                                      app.config['LINK_DEFAULT_TTL'], created_at)
+        except ValueError as e:
+            flash(f"Invalid expiry: {e}.")
+            return redirect(request.referrer or url_for('urlshortner'))
 
-        short_url = f'https://short-url/{short_code}'
+        try:
+            short_code, _ = create_link(user_id, original_url, custom_short_code, created_at, expires_at)
+        except sqlite3.IntegrityError:
+            flash(f"Short code '{custom_short_code}' is already in use. Please choose another.")
+            return redirect(request.referrer)
 
-        insert_mapping_query = "INSERT INTO url_mappings (USER_ID, LONG_URL, SHORT_URL) VALUES (?, ?, ?)"
-        cursor.execute(insert_mapping_query, (user_id, original_url, short_url))
-        conn.commit()
+        short_url = format_short_url(short_code)
 
         flash("URL shortened successfully!")
         return render_template('index.html', short_url=short_url)
 
     except sqlite3.Error as e:
         flash("An error occurred while processing your request.")
-        print("SQLite error:", e)
-
-    finally:
-        cursor.close()
-        conn.close()
+        app.logger.error("SQLite error while shortening a URL: %s", e)
 
     return redirect(url_for('signin'))
 
 
-@app.route('/test-url', methods=['GET', 'POST'])  # a route to test if a short url exists in db
+@route('/shorten-url/batch', methods=['POST'])  # a route to shorten many URLs at once from a JSON or CSV body
+@login_required
+def shorten_url_batch():
+    user_id = session.get('user_id')
+
+    if not user_id:
+        return jsonify(error="User not logged in."), 401
+
+    try:
+        items = parse_batch_body(request)
+    except BatchError as e:
+        return jsonify(error=str(e)), 400
+
+    if len(items) > app.config['BATCH_MAX_ITEMS']:
+        return jsonify(error=f"A batch may contain at most {app.config['BATCH_MAX_ITEMS']} items."), 413
+
+    try:
+        results, created_codes = create_mappings(storage, user_id, items, short_code_allocator, short_code_filter,
+                                                 dedup=app.config['DEDUP_MODE'],
+                                                 default_ttl=app.config['LINK_DEFAULT_TTL'])
+    except sqlite3.IntegrityError:
+        return jsonify(error="A short code in the batch was taken by another request, please retry."), 409
+
+    for short_code in created_codes:
+        redirect_cache.invalidate(short_code)  # drop negative entries cached while the codes were still unknown
+
+    existing = sum(1 for result in results if result['status'] == 'existing')
+    return jsonify(created=len(created_codes), existing=existing,
+                   failed=len(results) - len(created_codes) - existing, results=results)
+
+
+@route('/test-url', methods=['GET', 'POST'])  # a route to test if a short url exists in db
 @login_required  # Ensures that the user must be logged in to access this route.
 def test_url():
     if request.method == 'POST':  # Checks if the form was submitted (POST request).
-        test_url1 = request.form.get('test-url')  # Retrieve the short URL to be tested from the form data
-
-        conn = sqlite3.connect('url_shortener.db')  # Connect to the SQLite database
-        cursor = conn.cursor()
+        test_url1 = normalize_short_code(request.form.get('test-url'))  # Retrieve the short code to be tested
 
         user_id = session.get('user_id')  # Retrieve the user ID from the session
 
-        print(f"User ID from session: {user_id}")
-
         if user_id:
             # Checks if the user is logged in.
             user_id = int(user_id)  # Convert user_id to an integer if it's stored as a string
 
-            # Executes a SQL query to check if the provided short URL exists in the database for the specific user.
-            cursor.execute("SELECT SHORT_URL FROM url_mappings WHERE USER_ID = ? AND SHORT_URL = ?",
-                           (user_id, test_url1))
-
-            short_url = cursor.fetchone()  # Fetch the result (short URL) from the database
-
-            print(f"Short URL from database: {short_url}")
-
-            # Close the cursor and database connection
-            cursor.close()
-            conn.close()
+            # Executes a SQL query to check if the provided short URL exists in the database for the specific user,
+            # codes the short code filter has never seen are answered without a query.
+            if short_code_might_exist(test_url1):
+                short_url = storage.get_long_url(test_url1, user_id) is not None
+            else:
+                short_url = False
 
             if short_url:
                 # If the short URL exists, render the success.html template
-                print("Rendering success.html")
                 return render_template('success.html')
             else:
                 # If the short URL doesn't exist, render the failure.html template
-                print("Rendering failure.html")
                 return render_template('failure.html')
         else:
             # If the user is not logged in, redirect to the signin route
@@ -319,62 +568,84 @@ def test_url():
     return render_template('test_url.html')
 
 
-def list_urls_for_user(user_id):
-    conn = sqlite3.connect('url_shortener.db')  # Connect to the SQLite database
-    cursor = conn.cursor()
-
-    # Retrieve all short URLs for the specified user from the database
-    cursor.execute("SELECT SHORT_URL FROM url_mappings WHERE USER_ID = ?", (user_id,))
-
-    # Extract short URLs from the fetched data
-    short_urls = [url[0] for url in cursor.fetchall()]
+def page_arguments():  # reads the ?after=<cursor>&limit=<n> pagination arguments of the current request
+    cursor = request.args.get('after')
+    limit = request.args.get('limit', app.config['LIST_PAGE_SIZE'], type=int)
+    return cursor, max(1, min(limit, app.config['LIST_MAX_PAGE_SIZE']))
 
-    # Close the cursor and database connection
-    cursor.close()
-    conn.close()
 
-    # Return the list of short URLs for the user
-    return short_urls
+def list_urls_for_user(user_id, cursor=None, limit=100):
+    # Retrieve one page of the user's links, starting after the last link of the previous page.
+    # Returns the page and the cursor of the next page (None when this is the last page).
+    return listing.fetch_page(storage, user_id, cursor, limit)
 
 
-@app.route('/list-urls', methods=['GET'])  # a route to view lists of a particular user
+@route('/list-urls', methods=['GET'])  # a route to view lists of a particular user
 @login_required
 def list_urls():
     user_id = session['user_id']  # Retrieve the user ID from the session
 
     if user_id:  # Checks if the user is logged in.
-        short_urls = list_urls_for_user(user_id)   # Get the list of short URLs for the user
-        # Calls the list_urls_for_user function to retrieve the list of short URLs for the user.
+        cursor, limit = page_arguments()
+        rows, next_cursor = list_urls_for_user(user_id, cursor, limit)   # Get one page of the user's links
+        short_urls = [row['short_url'] for row in rows]
 
-        # Renders the list_urls.html template, passing the list of short URLs.
-        return render_template('lists_urls.html', short_urls=short_urls)
+        # Renders the list_urls.html template, passing the page of short URLs and the link to the next page.
+        next_page = url_for('list_urls', after=next_cursor, limit=limit) if next_cursor else None
+        return render_template('lists_urls.html', short_urls=short_urls, next_page=next_page)
     else:
         # Redirects to the signin page with a flash message if the user is not logged in.
         flash("User not logged in.")
         return redirect(url_for('signin'))
 
 
-def get_original_url(full_shortened_link, user_id):
-    # a function to retrieve the original URL from the database based on the short URL and user ID.
-    conn = sqlite3.connect('url_shortener.db')
-    cursor = conn.cursor()
+@route('/list-urls.json', methods=['GET'])  # the same pages as /list-urls, as JSON
+@login_required
+def list_urls_json():
+    user_id = session.get('user_id')
 
-    # Executes a SQL query to retrieve the original URL based on the short URL and user ID.
-    cursor.execute("SELECT LONG_URL FROM url_mappings WHERE SHORT_URL = ? AND USER_ID = ?", (full_shortened_link,
-                                                                                             user_id))
-    result = cursor.fetchone()
+    if not user_id:
+        return jsonify(error="User not logged in."), 401
+
+    cursor, limit = page_arguments()
+    rows, next_cursor = list_urls_for_user(user_id, cursor, limit)
+    return jsonify(urls=rows, next_cursor=next_cursor)
+
+
+@route('/export-urls', methods=['GET'])  # a route streaming all links of the user as CSV or JSON lines
+@login_required
+def export_urls():
+    user_id = session.get('user_id')
+
+    if not user_id:
+        return jsonify(error="User not logged in."), 401
 
-    # Check if a result is found, and extract the original URL
-    if result:
-        original_url = result[0]
+    export_format = request.args.get('format', 'csv')
+    if export_format == 'csv':
+        chunks, mimetype = listing.export_csv, 'text/csv'
+    elif export_format == 'jsonl':
+        chunks, mimetype = listing.export_jsonl, 'application/x-ndjson'
     else:
-        original_url = None
+        return jsonify(error="format must be 'csv' or 'jsonl'."), 400
 
-    conn.close()
-    return original_url
+    # the generator borrows a pooled connection per chunk, so memory use does not grow with the number of links
+    body = chunks(storage, user_id, app.config['EXPORT_CHUNK_SIZE'])
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename=urls.{export_format}'
+    return response
 
 
-@app.route('/redirect', methods=['GET', 'POST'])  # a route to redirect user to their original url using short url
+def get_original_url(full_shortened_link, user_id):
+    # a function to retrieve the original URL from the database based on the short URL and user ID.
+    short_code = normalize_short_code(full_shortened_link)
+    if not short_code_might_exist(short_code):
+        return None  # definitely unknown, no query needed
+
+    # Retrieves the original URL based on the short URL and user ID, None if there is no such link.
+    return storage.get_long_url(short_code, user_id)
+
+
+@route('/redirect', methods=['GET', 'POST'])  # a route to redirect user to their original url using short url
 @login_required  # Ensures that the user must be logged in to access this route.
 def redirect_to_original_page():
     user_id = session['user_id']  # Retrieve the user ID from the session
@@ -389,7 +660,7 @@ def redirect_to_original_page():
             original_url = get_original_url(short_url, user_id)
 
             if original_url:
-                print("Original URL Retrieved:", original_url)
+                click_recorder.record(normalize_short_code(short_url), request.referrer)  # count the click
                 return redirect(original_url)  # Redirects the user to their original URL.
             else:
                 return render_template('redirect.html',
@@ -403,23 +674,90 @@ def redirect_to_original_page():
 
 def get_long_url(short_url, user_id):
     # Defines a function to retrieve the original (long) URL from the database based on the short URL and user ID.
-    conn = sqlite3.connect('url_shortener.db')
-    cursor = conn.cursor()
+    short_code = normalize_short_code(short_url)
+    if not short_code_might_exist(short_code):
+        return None  # definitely unknown, no query needed
 
     # Retrieve the original URL from the database based on the short URL and user ID
-    cursor.execute("SELECT LONG_URL FROM url_mappings WHERE USER_ID = ? AND SHORT_URL = ?", (user_id, short_url))
-    result = cursor.fetchone()
+    return storage.get_long_url(short_code, user_id)
 
-    cursor.close()
-    conn.close()
 
-    if result:  # Check if a result is found and extract the original URL
-        return result[0]
-    else:
+def resolve_link(short_code):
+    # finds (long URL, expiry time) of a short code for the public routes, cached in memory. None for an unknown code.
+    found, link = redirect_cache.get(short_code)
+    if found:
+        return link  # served from memory without touching the database (None for a known-unknown code)
+
+    if not short_code_might_exist(short_code):
+        # the short code filter has never seen this code, it definitely does not exist. Not cached as a negative entry:
+        # asking the filter again is just as cheap, and a link another worker creates shows up with its next refresh
         return None
 
+    link = storage.get_link(short_code)  # short codes are unique, whoever owns the link
+    if link is not None:
+        link = tuple(link)
+
+    # unknown codes are cached too, as negative entries. A link that expires is not cached beyond its expiry.
+    redirect_cache.set(short_code, link, link[1] - time.time() if link and link[1] else None)
+    return link
+
 
-@app.route('/generate-qr-code', methods=['POST'])
+def resolve_short_code(short_code):  # the long URL of a short code for the public redirect route, None if unknown
+    link = resolve_link(short_code)
+    return link[0] if link else None
+
+
+@route('/<short_code>', methods=['GET'])  # the public redirect route, e.g. GET /ABCDEF, no login needed
+def follow_short_url(short_code):
+    long_url = resolve_short_code(short_code)
+
+    if long_url is None:
+        abort(404)  # the short code does not exist
+
+    click_recorder.record(short_code, request.referrer)  # only appends to an in-memory buffer
+    return redirect(long_url, code=app.config['REDIRECT_STATUS'])
+
+
+@route('/cache-stats', methods=['GET'])  # a route exposing the hit/miss/eviction counters of the redirect cache
+def cache_stats():
+    return jsonify(redirect_cache.stats())
+
+
+@route('/stats', methods=['GET'])  # a route returning the click counts of all links of the signed-in user
+@login_required
+def stats_for_user():
+    user_id = session.get('user_id')
+
+    if not user_id:
+        return jsonify(error="User not logged in."), 401
+
+    return jsonify(user_stats(storage, user_id))
+
+
+@route('/stats/<short_code>', methods=['GET'])  # a route returning the click statistics of one link
+@login_required
+def stats_for_link(short_code):
+    user_id = session.get('user_id')
+    short_code = normalize_short_code(short_code)
+
+    # only the owner of a link may see its statistics
+    if storage.get_long_url(short_code, user_id) is None:
+        return jsonify(error="Short URL not found for this user."), 404
+
+    return jsonify(link_stats(storage, short_code))
+
+
+@route('/metrics', methods=['GET'])  # a route exposing the timings in the Prometheus text format
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@route('/filter-stats', methods=['GET'])  # a route exposing the size and accuracy of the short code filter
+def filter_stats():
+    return jsonify(short_code_filter.stats())
+
+
+@route('/generate-qr-code', methods=['POST'])
 @login_required
 def generate_qr_code():  # Defines a route for generating a QR code based on a short URL.
     user_id = session['user_id']  # Retrieve the user ID from the session
@@ -429,21 +767,46 @@ def generate_qr_code():  # Defines a route for generating a QR code based on a s
 
         long_url = get_long_url(short_url, user_id)  # Retrieve the long URL based on the short URL and user ID
 
-        if long_url:  # Generate a QR code for the long URL
-            qr = segno.make(long_url)
-            image_path = f"./static/qr_codes/{user_id}_qr_code.png"  # a unique filename for each user
-
-            qr.save(image_path)  # Save the QR code image
+        if long_url:
+            # The image itself is served (and cached) by the /qr/<code>.png route, the page only links to it
+            image_url = url_for('qr_image', short_code=normalize_short_code(short_url), fmt='png')
 
             # Render the redirect.html template with the QR code image
-            return render_template('redirect.html', qr_image=image_path)
+            return render_template('redirect.html', qr_image=image_url)
         else:
             return render_template('redirect.html', error="Short URL not valid.")
     else:
         return render_template('redirect.html', error="User not logged in.")
 
 
-@app.route('/delete-url', methods=['GET', 'POST'])  # a route to delete a particular short url stored in db
+@route('/qr/<short_code>.<any(png, svg):fmt>', methods=['GET'])  # a route serving the QR code of a short URL
+def qr_image(short_code, fmt, fail=abort):  # fail(status) answers an unknown code or invalid options
+    long_url = resolve_short_code(short_code)  # the QR code encodes the long URL, like the original page did
+
+    if long_url is None:
+        return fail(404)
+
+    scale = request.args.get('scale', 5, type=int)
+    border = request.args.get('border', 4, type=int)
+    if not (1 <= scale <= 20 and 0 <= border <= 10):
+        return fail(400)
+
+    key = qr_cache.key(long_url, fmt, scale, border)
+    if request.if_none_match.contains(key):  # the client already has this exact image, skip the cache lookup
+        response = Response(status=304)
+        response.set_etag(key)
+        return response
+
+    image, key = qr_cache.get(long_url, fmt=fmt, scale=scale, border=border)
+
+    response = Response(image, mimetype=QR_FORMATS[fmt])
+    response.set_etag(key)  # the content hash, unchanged as long as the URL and the options stay the same
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['QR_MAX_AGE']
+    return response.make_conditional(request)  # answers If-None-Match with 304 Not Modified
+
+
+@route('/delete-url', methods=['GET', 'POST'])  # a route to delete a particular short url stored in db
 @login_required
 def delete_url_mapping():
     user_id = session['user_id']  # Retrieve the user ID from the session
@@ -454,28 +817,147 @@ def delete_url_mapping():
         if user_id:
 
             # Get the short URL to delete from the form submission
-            short_url_to_delete = request.form['short-url-to-delete']
-
-            # if the URL to delete belongs to the signed-in user
-            conn = sqlite3.connect('url_shortener.db')
-            cursor = conn.cursor()
-            cursor.execute("SELECT SHORT_URL FROM url_mappings WHERE USER_ID = ? AND SHORT_URL = ?",
-                           (user_id, short_url_to_delete))
-            url = cursor.fetchone()
-
-            if url:
-                # Delete the URL mapping
-                cursor.execute("DELETE FROM url_mappings WHERE USER_ID = ? AND SHORT_URL = ?",
-                               (user_id, short_url_to_delete))
-                conn.commit()
-                conn.close()
+            short_url_to_delete = normalize_short_code(request.form['short-url-to-delete'])
+
+            # Delete the URL mapping (or the user's alias of it) together with its click history, nothing is deleted
+            # when the short URL does not belong to the signed-in user
+            if delete_link(user_id, short_url_to_delete):
                 return "Short URL deleted successfully"
             else:
-                conn.close()
                 return "Unauthorized deletion: URL doesn't belong to the user", 401
         return "Unauthorized deletion", 401  # Returns an unauthorized status if the user is not signed in.
 
 
+# The versioned JSON API, see api.py. Routes under /api/v1 authenticate with "Authorization: Bearer <token>" instead of
+# the session, answer in compact JSON and never render a template.
+
+def token_required(view):  # passes the user ID of the request's bearer token to the view, 401 without a valid token
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        user_id = api_tokens.user_id(bearer_token(request))
+        if user_id is None:
+            return api_error("A valid bearer token is required.", 401)
+        return view(user_id, *args, **kwargs)
+    return wrapper
+
+
+def link_json(short_code, long_url, expires_at, **extra):  # the representation of a link in API responses
+    return {'code': short_code, 'short_url': format_short_url(short_code), 'long_url': long_url,
+            'expires_at': expires_at, **extra}
+
+
+@route('/api/v1/tokens', methods=['POST'])  # creates an API token, the one route that needs a signed-in session
+@login_required
+def api_create_token():
+    body = request.get_json(silent=True) or {}
+    token = api_tokens.create(session['user_id'], str(body.get('name') or '')[:100] or None, int(time.time()))
+    return json_response({'token': token}, 201)  # shown once, only its hash is stored
+
+
+@route('/api/v1/tokens', methods=['DELETE'])  # revokes the token the request is made with
+@token_required
+def api_revoke_token(user_id):
+    api_tokens.revoke(bearer_token(request))
+    return Response(status=204)
+
+
+@route('/api/v1/links', methods=['POST'])  # shortens {"url", "code"?, "expires_in"?, "expires_at"?}
+@token_required
+def api_shorten(user_id):
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return api_error("Expected a JSON object.", 400)
+    long_url = str(body.get('url') or body.get('original_url') or '').strip()
+    if not long_url:
+        return api_error("url is required.", 400)
+    error = long_url_error(long_url)
+    if error:
+        return api_error(f"Invalid url: {error}.", 400)
+    custom_short_code = normalize_short_code(str(body.get('code') or body.get('custom_short_code') or '')) or None
+    error = short_code_error(custom_short_code) if custom_short_code else None
+    if error:
+        return api_error(f"Invalid code: {error}.", 400)
+
+    created_at = int(time.time())
+    try:
+        expires_at = parse_expiry(body.get('expires_in'), body.get('expires_at'), app.config['LINK_DEFAULT_TTL'],
+                                  created_at)
+    except (TypeError, ValueError) as e:
+        return api_error(f"Invalid expiry: {e}.", 400)
+
+    try:
+        short_code, created = create_link(user_id, long_url, custom_short_code, created_at, expires_at)
+    except sqlite3.IntegrityError:
+        return api_error(f"Short code '{custom_short_code}' is already in use.", 409)
+    return json_response(link_json(short_code, long_url, expires_at, created=created), 201 if created else 200)
+
+
+@route('/api/v1/links', methods=['GET'])  # one page of the token owner's links, ?after=<cursor>&limit=<n>
+@token_required
+def api_list(user_id):
+    cursor, limit = page_arguments()
+    rows, next_cursor = list_urls_for_user(user_id, cursor, limit)
+    return json_response({'links': [link_json(row['short_code'], row['long_url'], row['expires_at'],
+                                              created_at=row['created_at']) for row in rows],
+                          'next_cursor': next_cursor})
+
+
+@route('/api/v1/links/<short_code>', methods=['GET'])  # resolves a code, HEAD and If-None-Match are answered too
+def api_resolve(short_code):
+    short_code = normalize_short_code(short_code)
+    link = resolve_link(short_code)  # public like the redirect itself, and served from the same cache and filter
+    if link is None:
+        return api_error("Short code not found.", 404)
+    long_url, expires_at = link
+
+    response = json_response(link_json(short_code, long_url, expires_at))
+    response.set_etag(link_etag(short_code, long_url, expires_at))
+    max_age = app.config['API_RESOLVE_MAX_AGE']
+    if expires_at is not None:
+        max_age = max(0, min(max_age, expires_at - int(time.time())))  # never cached beyond the link's expiry
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)  # 304 Not Modified when the client's ETag still matches
+
+
+@route('/api/v1/links/<short_code>/exists', methods=['GET'])  # whether the token owner has a link with this code
+@token_required
+def api_exists(user_id, short_code):
+    short_code = normalize_short_code(short_code)
+    exists = short_code_might_exist(short_code) and storage.get_long_url(short_code, user_id) is not None
+    return json_response({'code': short_code, 'exists': exists})
+
+
+@route('/api/v1/links/<short_code>', methods=['DELETE'])  # deletes a link of the token owner
+@token_required
+def api_delete(user_id, short_code):
+    if not delete_link(user_id, normalize_short_code(short_code)):
+        return api_error("Short code not found.", 404)
+    return Response(status=204)
+
+
+@route('/api/v1/links/<short_code>/qr', methods=['GET'])  # the QR code image, ?format=png|svg&scale=&border=
+def api_qr(short_code):
+    fmt = request.args.get('format', 'png')
+    if fmt not in QR_FORMATS:
+        return api_error(f"format must be one of {', '.join(QR_FORMATS)}.", 400)
+
+    def fail(status):  # JSON errors instead of the HTML error pages of abort()
+        if status == 404:
+            return api_error("Short code not found.", 404)
+        return api_error("scale must be between 1 and 20 and border between 0 and 10.", 400)
+
+    # the same cached images and ETags as /qr/<code>.<fmt>
+    return qr_image(normalize_short_code(short_code), fmt, fail)
+
+
+def __getattr__(name):  # "app" is created on first use, so "from app import app" and "app:app" keep working
+    if name == 'app':
+        return create_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 if __name__ == '__main__':  # ensuring that the development server is only started when the script is executed directly,
     # not when it's imported as a module.
-    app.run(debug=True)
+    logging.basicConfig(level=logging.INFO, format='%(message)s')  # shows the migration notes
+    create_app().run(debug=True)
@@ -0,0 +1,143 @@
+import csv  # for reading the CSV request bodies
+import io
+import time
+
+from expiry import parse_expiry
+from long_urls import long_url_error, normalize_long_url
+from short_codes import format_short_url, normalize_short_code, short_code_error
+
+# Bulk link creation.
+# A batch of {original_url, custom_short_code} items is validated in memory, the custom codes are checked with one
+# set-based query, the remaining codes come from a single allocator reservation and every row is written with one
+# executemany() per database file (see Storage.insert_mappings). Each item gets its own result so a caller can see
+# which links were created.
+
+
+class BatchError(ValueError):  # raised when the request body itself cannot be read as a batch
+    pass
+
+
+def parse_batch_body(request):  # turns a JSON or CSV request body into a list of item dicts
+    if request.mimetype in ('text/csv', 'application/csv'):
+        reader = csv.DictReader(io.StringIO(request.get_data(as_text=True)))
+        if not reader.fieldnames or 'original_url' not in reader.fieldnames:
+            raise BatchError("CSV body needs a header row with an 'original_url' column.")
+        return list(reader)
+
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        body = body.get('urls')  # {"urls": [...]} as well as a bare list is accepted
+    if not isinstance(body, list):
+        raise BatchError("Expected a JSON list of items or an object with a 'urls' list.")
+    return body
+
+
+def existing_short_codes(storage, codes, code_filter=None):  # returns the subset of codes already in url_mappings
+    if code_filter is not None:
+        # codes the filter has never seen are definitely free, only the possible matches are looked up
+        codes = [code for code in codes if code_filter.might_contain(code)]
+    return storage.existing_short_codes(codes)
+
+
+def create_mappings(storage, user_id, items, allocator, code_filter=None, dedup='off', default_ttl=None):
+    # creates a url mapping for every valid item, returns (results, created_codes), results has one dict per item.
+    # code_filter (a cuckoo.ShortCodeFilter) is optional, it saves the database lookups of codes that are free.
+    # dedup ('off' or 'user', see DEDUP_MODE) hands out the existing code of an equal long URL of the user instead of
+    # a new one, for the items without a custom code or an expiry. Items may carry expires_in (seconds) or expires_at
+    # (unix time), default_ttl applies to the others.
+    results = []
+    accepted = []  # (result, original_url, custom code or None, EXPIRES_AT) for the items that passed validation
+    requested = set()
+    now = int(time.time())
+
+    for index, item in enumerate(items):
+        result = {'index': index}
+        results.append(result)
+
+        if not isinstance(item, dict):
+            item = {'original_url': item}  # a plain list of URLs is accepted too
+        original_url = item.get('original_url') or ''
+        custom_short_code = item.get('custom_short_code') or ''
+        if not isinstance(original_url, str) or not isinstance(custom_short_code, str):
+            result.update(status='error', error='original_url and custom_short_code must be strings')
+            continue
+        original_url = original_url.strip()
+        custom_short_code = normalize_short_code(custom_short_code) or None
+        result['original_url'] = original_url
+        try:
+            expires_at = parse_expiry(item.get('expires_in'), item.get('expires_at'), default_ttl, now)
+        except (TypeError, ValueError) as e:
+            result.update(status='error', error=f'invalid expiry: {e}')
+            continue
+
+        # the same checks as the JSON API and bulk.py
+        error = long_url_error(original_url) if original_url else 'original_url is required'
+        if not error and custom_short_code:
+            error = short_code_error(custom_short_code)
+        if error:
+            result.update(status='error', error=error)
+        elif custom_short_code and custom_short_code in requested:
+            result.update(status='error', error=f"short code '{custom_short_code}' appears twice in the batch")
+        else:
+            if custom_short_code:
+                requested.add(custom_short_code)
+            accepted.append((result, original_url, custom_short_code, expires_at))
+
+    # one set-based query finds the custom codes that are already taken
+    taken = existing_short_codes(storage, requested, code_filter)
+
+    existing = {}  # long URL -> the short code it already has
+    if dedup != 'off':
+        # one indexed lookup per chunk of long URLs finds the links that already exist
+        existing = storage.find_short_codes({url for _, url, custom, expires_at in accepted
+                                             if not custom and expires_at is None},
+                                            user_id)
+
+    rows = []
+    needs_code = []
+    duplicates = []  # (result, the row whose code the result gets) for repeated long URLs within the batch
+    first_rows = {}  # normalized long URL -> the first new row created for it
+    for result, original_url, custom_short_code, expires_at in accepted:
+        deduplicated = dedup != 'off' and expires_at is None  # a link that expires always gets a code of its own
+        if custom_short_code in taken:
+            result.update(status='error', error=f"short code '{custom_short_code}' is already in use")
+        elif custom_short_code:
+            rows.append([user_id, original_url, custom_short_code, expires_at, result])
+        elif deduplicated and original_url in existing:
+            short_code = existing[original_url]
+            result.update(status='existing', short_code=short_code, short_url=format_short_url(short_code))
+        elif deduplicated and normalize_long_url(original_url) in first_rows:
+            duplicates.append((result, first_rows[normalize_long_url(original_url)]))
+        else:
+            row = [user_id, original_url, None, expires_at, result]
+            rows.append(row)
+            needs_code.append(row)
+            if deduplicated:
+                first_rows[normalize_long_url(original_url)] = row
+
+    # one allocator reservation covers the whole batch, codes a user picked as custom codes earlier are skipped
+    while needs_code:
+        codes = allocator.next_codes(storage, len(needs_code))
+        clashes = existing_short_codes(storage, codes, code_filter) | (requested & set(codes))
+        fresh = [code for code in codes if code not in clashes]
+        for row, code in zip(needs_code, fresh):
+            row[2] = code
+        needs_code = needs_code[len(fresh):]
+
+    created_at = int(time.time())
+    # raises sqlite3.IntegrityError when another request took one of the codes between the check and the insert,
+    # nothing of the batch is written then
+    storage.insert_mappings([(user_id, original_url, short_code, created_at, expires_at)
+                             for user_id, original_url, short_code, expires_at, _ in rows])
+
+    if code_filter is not None:
+        for row in rows:
+            code_filter.add(row[2])
+
+    for _, _, short_code, expires_at, result in rows:
+        result.update(status='created', short_code=short_code, short_url=format_short_url(short_code),
+                      expires_at=expires_at)
+    for result, row in duplicates:
+        result.update(status='existing', short_code=row[2], short_url=format_short_url(row[2]))
+
+    return results, [row[2] for row in rows]
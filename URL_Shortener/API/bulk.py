@@ -0,0 +1,414 @@
+import argparse
+import csv  # for reading and writing the CSV files
+import json
+import logging
+import os
+import sqlite3  # for database operations, a database engine, a relational database management system
+import sys
+import time
+from datetime import datetime
+
+from allocator import SequenceAllocator, base62_encode
+from long_urls import long_url_error, long_url_hash
+from migrations import migrate
+from short_codes import normalize_short_code, short_code_error
+from storage import shard_of
+
+# Bulk import and export of url mappings, for migrating from another shortener or restoring a backup.
+#
+#   python bulk.py import links.csv --rejects rejected.jsonl
+#   python bulk.py export --format jsonl --output links.jsonl
+#
+# The import streams a CSV (with a header row) or JSON lines file and validates every row in memory. Valid rows are
+# written with one executemany() per database file and chunk. The indexes of url_mappings are dropped for the
+# duration of the load and rebuilt once at the end, which is far cheaper than updating them row by row. Short codes
+# that already exist (or appear twice in the input) are removed with one set-based query before the unique indexes
+# come back, the oldest row keeps the code.
+#
+# Progress is kept in the import_checkpoints table of every database file, committed together with the rows, so an
+# interrupted import started again with the same arguments continues after the last committed chunk without writing
+# any row twice. The application (and snapshot.py --interval) should be stopped while an import runs: without the
+# indexes it would be slow and could hand out a code twice.
+#
+# The export walks url_mappings in URL_ID order one chunk per query, so it uses the same memory for any table size.
+# Its columns can be read back by the import.
+
+CHUNK_SIZE = 50000  # rows per transaction
+EXPORT_COLUMNS = ('url_id', 'user_id', 'short_code', 'long_url', 'created_at', 'expires_at')
+INSERT_MAPPING = ("INSERT OR IGNORE INTO url_mappings "
+                  "(USER_ID, LONG_URL, SHORT_URL, CREATED_AT, EXPIRES_AT, LONG_URL_HASH) VALUES (?, ?, ?, ?, ?, ?)")
+
+
+class RowError(ValueError):  # raised for a row that cannot be imported, the message ends up in the rejects file
+    pass
+
+
+def connect(path):  # a connection tuned for long sequential writes
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')  # a commit survives the process being killed, which resuming needs
+    conn.execute('PRAGMA cache_size = -262144')  # 256 MiB, the index rebuilds sort in the page cache
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+class OffsetLines:  # iterates the lines of a binary file as text, remembering the byte offset after each line
+    def __init__(self, f, offset):
+        f.seek(offset)
+        self.f = f
+        self.offset = offset
+
+    def __iter__(self):
+        for line in self.f:
+            self.offset += len(line)
+            yield line.decode('utf-8')
+
+
+def read_records(f, fmt, offset):
+    # yields (record, byte offset after the record) from offset on. A record is a dict, or a RowError for a line that
+    # could not be parsed. csv.reader pulls one line at a time, so the offset is exact even for quoted line breaks.
+    if fmt == 'csv':
+        f.seek(0)
+        header_line = f.readline()
+        header = next(csv.reader([header_line.decode('utf-8-sig')]), None)
+        if not header:
+            return
+        lines = OffsetLines(f, max(offset, len(header_line)))
+        for values in csv.reader(lines):
+            if values:
+                yield dict(zip(header, values)), lines.offset
+    else:
+        lines = OffsetLines(f, offset)
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                record = RowError(f"invalid JSON: {e}")
+            yield record, lines.offset
+
+
+def parse_created_at(value, default, column='created_at'):  # unix time from an integer or an ISO 8601 string
+    if value in (None, ''):
+        return default
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = str(value).strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return int(datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise RowError(f"{column} {value!r} is neither unix time nor ISO 8601") from None
+
+
+class Importer:
+    def __init__(self, path, source, fmt, shard_paths=None, chunk_size=CHUNK_SIZE, defer_indexes=True,
+                 user_email=None, rejects=None):
+        self.source = os.path.abspath(source)  # the checkpoint key, the same file resumes the same import
+        self.fmt = fmt
+        self.chunk_size = chunk_size
+        self.defer_indexes = defer_indexes
+        self.rejects = rejects  # an open file receiving one JSON line per rejected row, or None
+        self.main = connect(path)
+        self.shards = [connect(shard) for shard in shard_paths] if shard_paths else [self.main]
+        self.files = [self.main] + [conn for conn in self.shards if conn is not self.main]
+        for conn in self.files:
+            migrate(conn)
+
+        # users are looked up in memory, one query for the whole import
+        self.emails = dict(self.main.execute('SELECT EMAIL, ID FROM users'))
+        self.user_ids = set(self.emails.values())
+        self.default_user = None
+        if user_email is not None:
+            self.default_user = self.emails.get(user_email)
+            if self.default_user is None:
+                raise SystemExit(f"No user with the email {user_email}")
+
+        self.code_offset = SequenceAllocator().offset  # codes are generated the way the sequence allocator does
+        self.offsets = {}  # database file -> input offset whose rows it already holds
+        self.imported = self.rejected = self.duplicates = 0
+
+    def _checkpoint(self, conn):
+        return conn.execute('SELECT OFFSET, START_ID, INDEXES, CHUNK_SIZE, PENDING_OFFSET, CODE_BASE, IMPORTED, '
+                            'REJECTED FROM import_checkpoints WHERE SOURCE = ?', (self.source,)).fetchone()
+
+    def begin(self):  # creates (or reads back) the checkpoint of every file and drops the indexes
+        for conn in self.files:
+            row = self._checkpoint(conn)
+            if row is None:
+                start_id = conn.execute('SELECT COALESCE(MAX(URL_ID), 0) + 1 FROM url_mappings').fetchone()[0]
+                indexes = []
+                if self.defer_indexes:
+                    indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' "
+                                           "AND tbl_name = 'url_mappings' AND sql IS NOT NULL").fetchall()
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('INSERT INTO import_checkpoints (SOURCE, OFFSET, START_ID, INDEXES, CHUNK_SIZE) '
+                             'VALUES (?, 0, ?, ?, ?)', (self.source, start_id, json.dumps(indexes), self.chunk_size))
+                for name, _ in indexes:
+                    conn.execute(f'DROP INDEX {name}')
+                conn.commit()
+                row = self._checkpoint(conn)
+            self.offsets[conn] = row[0]
+
+        offset, _, _, chunk_size, _, _, self.imported, self.rejected = self._checkpoint(self.main)
+        if offset:
+            self.chunk_size = chunk_size  # a resumed chunk must contain the same rows as the interrupted one
+            print(f"Resuming {self.source} at byte {offset}: {self.imported} rows imported, "
+                  f"{self.rejected} rejected so far", file=sys.stderr)
+
+    def _reject(self, offset, error, record):  # writes a rejected row to the rejects file
+        if self.rejects is not None:
+            self.rejects.write(json.dumps({'offset': offset, 'error': str(error), 'row': record}, default=str) + '\n')
+
+    def validate(self, record, now):  # returns (USER_ID, LONG_URL, SHORT_URL or None, CREATED_AT, EXPIRES_AT or None)
+        if isinstance(record, RowError):
+            raise record
+        if not isinstance(record, dict):
+            raise RowError("expected an object")
+
+        long_url = str(record.get('long_url') or record.get('original_url') or '').strip()
+        if not long_url:
+            raise RowError("long_url is required")
+        error = long_url_error(long_url)
+        if error:
+            raise RowError(error)
+
+        short_code = normalize_short_code(str(record.get('short_code') or record.get('short_url') or '')) or None
+        error = short_code_error(short_code) if short_code is not None else None
+        if error:
+            raise RowError(error)
+
+        user_id = record.get('user_id')
+        if user_id not in (None, ''):
+            try:
+                user_id = int(user_id)
+            except (TypeError, ValueError):
+                raise RowError(f"user_id {user_id!r} is not a number") from None
+            if user_id not in self.user_ids:
+                raise RowError(f"no user with ID {user_id}")
+        elif record.get('email'):
+            user_id = self.emails.get(record['email'])
+            if user_id is None:
+                raise RowError(f"no user with the email {record['email']}")
+        elif self.default_user is not None:
+            user_id = self.default_user
+        else:
+            raise RowError("user_id or email is required (or pass --user-email)")
+
+        return (user_id, long_url, short_code, parse_created_at(record.get('created_at'), now),
+                parse_created_at(record.get('expires_at'), None, 'expires_at'))
+
+    def _code_base(self, chunk_start, missing):
+        # reserves `missing` sequence numbers for the rows without a short code. The reservation is recorded as the
+        # pending chunk, so a chunk that is replayed after an interruption gets exactly the same codes (and therefore
+        # lands in the same shards) as the first time.
+        _, _, _, _, pending_offset, code_base, _, _ = self._checkpoint(self.main)
+        if pending_offset == chunk_start:
+            return code_base
+        self.main.execute('BEGIN IMMEDIATE')
+        code_base = self.main.execute("SELECT NEXT_VALUE FROM code_sequences WHERE NAME = 'short_code'").fetchone()[0]
+        self.main.execute("UPDATE code_sequences SET NEXT_VALUE = ? WHERE NAME = 'short_code'", (code_base + missing,))
+        self.main.execute('UPDATE import_checkpoints SET PENDING_OFFSET = ?, CODE_BASE = ? WHERE SOURCE = ?',
+                          (chunk_start, code_base, self.source))
+        self.main.commit()
+        return code_base
+
+    def _write_chunk(self, chunk, chunk_end):
+        now = int(time.time())
+        rows = []  # (byte offset after the row, row)
+        for record, offset in chunk:
+            try:
+                rows.append((offset, list(self.validate(record, now))))
+            except RowError as e:
+                self._reject(offset, e, record)
+                self.rejected += 1
+
+        missing = [row for _, row in rows if row[2] is None]
+        if missing:
+            code_base = self._code_base(self.offsets[self.main], len(missing))
+            for number, row in enumerate(missing):
+                row[2] = base62_encode(self.code_offset + code_base + number)
+
+        groups = {conn: [] for conn in self.files}
+        for offset, row in rows:
+            conn = self.shards[shard_of(row[2], len(self.shards))]
+            if offset > self.offsets[conn]:  # rows a shard committed before an interruption are not written again
+                groups[conn].append(row)
+
+        for conn, shard_rows in groups.items():
+            conn.execute('BEGIN IMMEDIATE')
+            changes = conn.total_changes
+            conn.executemany(INSERT_MAPPING, ((*row, long_url_hash(row[1])) for row in shard_rows))
+            self.duplicates += len(shard_rows) - (conn.total_changes - changes)  # only with --keep-indexes
+            conn.execute('UPDATE import_checkpoints SET OFFSET = ? WHERE SOURCE = ?', (chunk_end, self.source))
+            conn.commit()
+            self.offsets[conn] = chunk_end
+
+        self.imported += len(rows)
+        if self.rejects is not None:
+            self.rejects.flush()  # the chunk's rejects are on disk before the checkpoint moves past them
+        self.main.execute('UPDATE import_checkpoints SET OFFSET = ?, PENDING_OFFSET = NULL, IMPORTED = ?, '
+                          'REJECTED = ? WHERE SOURCE = ?', (chunk_end, self.imported, self.rejected, self.source))
+        self.main.commit()
+
+    def run(self):
+        self.begin()
+        started = time.perf_counter()
+        done = 0
+        with open(self.source, 'rb') as f:
+            chunk = []
+            for record, offset in read_records(f, self.fmt, self.offsets[self.main]):
+                chunk.append((record, offset))
+                if len(chunk) == self.chunk_size:
+                    self._write_chunk(chunk, offset)
+                    done += len(chunk)
+                    chunk = []
+                    elapsed = time.perf_counter() - started
+                    print(f"\r{done} rows, {done / elapsed:.0f} rows/s", end='', file=sys.stderr, flush=True)
+            if chunk:
+                self._write_chunk(chunk, chunk[-1][1])
+                done += len(chunk)
+        loaded = time.perf_counter() - started
+        print(f"\rLoaded {done} rows in {loaded:.1f}s ({done / loaded if loaded else 0:.0f} rows/s)",
+              file=sys.stderr)
+
+        self.finish()
+        elapsed = time.perf_counter() - started
+        print(f"Imported {self.imported - self.duplicates} links, rejected {self.rejected} invalid rows and "
+              f"{self.duplicates} duplicate short codes in {elapsed:.1f}s "
+              f"({done / elapsed if elapsed else 0:.0f} rows/s)", file=sys.stderr)
+
+    def finish(self):  # drops duplicate codes, rebuilds the indexes and removes the checkpoints
+        for conn in self.files:
+            _, start_id, indexes, _, _, _, _, _ = self._checkpoint(conn)
+            # a code taken by an older row (or by an earlier row of the input) is rejected, the first row keeps it
+            duplicates = conn.execute(
+                'SELECT URL_ID, USER_ID, SHORT_URL, LONG_URL FROM url_mappings WHERE URL_ID >= ? AND URL_ID NOT IN '
+                '(SELECT MIN(URL_ID) FROM url_mappings GROUP BY SHORT_URL)', (start_id,)
+            ).fetchall()
+            for url_id, user_id, short_code, long_url in duplicates:
+                self._reject(None, f"short code {short_code!r} is already in use",
+                             {'user_id': user_id, 'short_code': short_code, 'long_url': long_url})
+            self.duplicates += len(duplicates)
+            conn.execute('BEGIN IMMEDIATE')
+            # the delete trigger logs every removed row for snapshot.py (see migrations.py), but these codes stay live
+            # in the row that keeps them: their log entries are dropped again, in the same transaction, or the next
+            # incremental snapshot would leave the surviving links out
+            logged = conn.execute('SELECT COALESCE(MAX(SEQ), 0) FROM mapping_deletions').fetchone()[0]
+            conn.executemany('DELETE FROM url_mappings WHERE URL_ID = ?', ((row[0],) for row in duplicates))
+            conn.execute('DELETE FROM mapping_deletions WHERE SEQ > ?', (logged,))
+
+            existing = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            for name, sql in json.loads(indexes or '[]'):
+                if name not in existing:
+                    conn.execute(sql)  # one sort per index instead of one B-tree update per row
+            conn.commit()
+
+            if conn is not self.main:  # a shard, its users go into the index of the main file
+                users = conn.execute('SELECT DISTINCT USER_ID FROM url_mappings WHERE URL_ID >= ?', (start_id,))
+                shard = self.shards.index(conn)
+                self.main.executemany('INSERT OR IGNORE INTO user_shards (USER_ID, SHARD) VALUES (?, ?)',
+                                      ((user_id, shard) for user_id, in users))
+                self.main.commit()
+            conn.execute('ANALYZE')
+
+        # the main file's checkpoint goes last, until then a new run repeats this step instead of loading again
+        for conn in reversed(self.files):
+            conn.execute('DELETE FROM import_checkpoints WHERE SOURCE = ?', (self.source,))
+            conn.commit()
+
+
+def export(path, out, fmt, shard_paths=None, user_id=None, chunk_size=CHUNK_SIZE):
+    # writes every link (or every link of one user) to out, file by file in URL_ID order, one chunk per query
+    started = time.perf_counter()
+    done = 0
+    writer = csv.writer(out) if fmt == 'csv' else None
+    if writer is not None:
+        writer.writerow(EXPORT_COLUMNS)
+
+    query = 'SELECT URL_ID, USER_ID, SHORT_URL, LONG_URL, CREATED_AT, EXPIRES_AT FROM url_mappings WHERE URL_ID > ?'
+    if user_id is not None:
+        query += ' AND USER_ID = ?'
+    query += ' ORDER BY URL_ID LIMIT ?'
+
+    for database in shard_paths or [path]:
+        conn = connect(database)
+        after_id = 0
+        while True:
+            parameters = (after_id, user_id, chunk_size) if user_id is not None else (after_id, chunk_size)
+            rows = conn.execute(query, parameters).fetchall()
+            if not rows:
+                break
+            if writer is not None:
+                writer.writerows(rows)
+            else:
+                out.write(''.join(json.dumps(dict(zip(EXPORT_COLUMNS, row)), separators=(',', ':')) + '\n'
+                                  for row in rows))
+            after_id = rows[-1][0]
+            done += len(rows)
+            elapsed = time.perf_counter() - started
+            print(f"\r{done} rows, {done / elapsed:.0f} rows/s", end='', file=sys.stderr, flush=True)
+        conn.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"\rExported {done} links in {elapsed:.1f}s ({done / elapsed if elapsed else 0:.0f} rows/s)",
+          file=sys.stderr)
+
+
+def main():
+    common = argparse.ArgumentParser(add_help=False)  # the options both commands take
+    common.add_argument('--db', default='url_shortener.db', help="the main database file (DATABASE)")
+    common.add_argument('--shards', type=int, default=1, help="number of shard files (STORAGE_SHARDS)")
+    common.add_argument('--shard-path', default='url_shortener.shard{}.db',
+                        help="the shard file names, {} is replaced by the shard number (STORAGE_SHARD_PATH)")
+    common.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="rows per transaction or query")
+
+    parser = argparse.ArgumentParser(description="Bulk import and export of url mappings.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    importing = commands.add_parser('import', parents=[common],
+                                    help="load a CSV or JSON lines file, resuming an interrupted load")
+    importing.add_argument('input', help="the file to load (columns user_id or email, long_url, short_code, "
+                                         "created_at, expires_at, only long_url is required)")
+    importing.add_argument('--format', choices=('csv', 'jsonl'), help="default: taken from the file extension")
+    importing.add_argument('--user-email', help="owner of the rows that name no user")
+    importing.add_argument('--rejects', help="append the rejected rows to this JSON lines file")
+    importing.add_argument('--keep-indexes', action='store_true',
+                           help="keep the indexes during the load (slower, for small imports into a live database)")
+
+    exporting = commands.add_parser('export', parents=[common], help="write the links as CSV or JSON lines")
+    exporting.add_argument('--output', default='-', help="the file to write, '-' for standard output")
+    exporting.add_argument('--format', choices=('csv', 'jsonl'), default='csv')
+    exporting.add_argument('--user-email', help="only export the links of this user")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')  # shows the migration notes
+
+    shard_paths = [args.shard_path.format(number) for number in range(args.shards)] if args.shards > 1 else None
+
+    if args.command == 'import':
+        fmt = args.format or ('jsonl' if args.input.endswith(('.jsonl', '.ndjson', '.json')) else 'csv')
+        rejects = open(args.rejects, 'a') if args.rejects else None
+        try:
+            Importer(args.db, args.input, fmt, shard_paths, args.chunk_size, not args.keep_indexes,
+                     args.user_email, rejects).run()
+        finally:
+            if rejects is not None:
+                rejects.close()
+    else:
+        user_id = None
+        if args.user_email:
+            row = connect(args.db).execute('SELECT ID FROM users WHERE EMAIL = ?', (args.user_email,)).fetchone()
+            if row is None:
+                raise SystemExit(f"No user with the email {args.user_email}")
+            user_id = row[0]
+        if args.output == '-':
+            export(args.db, sys.stdout, args.format, shard_paths, user_id, args.chunk_size)
+        else:
+            with open(args.output, 'w', newline='') as out:
+                export(args.db, out, args.format, shard_paths, user_id, args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
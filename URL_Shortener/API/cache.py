@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import OrderedDict  # a dict that remembers insertion order, used as the LRU list
+
+
+class LRUCache:  # a bounded, thread-safe least-recently-used cache whose entries expire after a time-to-live
+    # A value of None is cached as a "negative" entry: it remembers that a key does not exist so repeated lookups of
+    # unknown keys do not reach the database either. Negative entries get their own, usually shorter, TTL.
+
+    def __init__(self, max_size=100000, ttl=300, negative_ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # key -> (value, expires_at), the least recently used key comes first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):  # returns (found, value), found is False when the database has to be asked
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)  # mark as most recently used
+            if value is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, value
+
+    def set(self, key, value, ttl=None):
+        # stores a value, or a negative entry when value is None. ttl shortens the entry's lifetime (a link that
+        # expires sooner than the cache's own TTL), it never lengthens it.
+        default = self.negative_ttl if value is None else self.ttl
+        ttl = default if ttl is None else min(ttl, default)
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)  # drop the least recently used entry
+                self.evictions += 1
+
+    def invalidate(self, key):  # forgets a key, called whenever the underlying row changes or is deleted
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):  # a snapshot of the counters, exposed by the /cache-stats route
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'negative_ttl': self.negative_ttl,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'hit_ratio': (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,79 @@
+import argparse
+import logging
+import sys
+import time
+from itertools import groupby
+
+from db import ConnectionPool
+from long_urls import normalize_long_url
+from storage import make_storage
+
+# Merges links whose long URLs are equal once normalized (see long_urls.py), for databases filled before DEDUP_MODE
+# was switched on. The oldest link of every group survives, the others become rows of url_aliases pointing to it: their
+# short codes keep redirecting, they just no longer show up as links of their own, and their clicks are added to the
+# survivor's. Only the links of the same user are merged: a link merged into another user's would vanish from its
+# owner's listing, and break as soon as the other user deleted theirs.
+#
+#   python compact_urls.py --db url_shortener.db --dry-run
+#
+# The duplicates are found in one pass over the LONG_URL_HASH index of every shard, so the job reads each link once.
+# It can run next to the application, every merge is a short transaction of its own.
+
+
+def find_duplicates(storage):  # yields (duplicate code, survivor code) pairs
+    for key, rows in groupby(storage.scan_long_urls(), lambda row: row[:2]):  # grouped by (LONG_URL_HASH, USER_ID)
+        if key[0] is None:
+            continue  # links without a long URL
+        groups = {}  # normalized long URL -> its rows, rows that only share the hash stay apart
+        for _, _, url_id, shard, short_code, long_url, created_at in rows:
+            groups.setdefault(normalize_long_url(long_url), []).append((created_at or 0, url_id, shard, short_code))
+        for group in groups.values():
+            if len(group) > 1:
+                group.sort()  # the oldest link survives, URL_IDs only order the links of one shard
+                for *_, short_code in group[1:]:
+                    yield short_code, group[0][3]
+
+
+def compact(storage, dry_run=False):
+    started = time.perf_counter()
+    # collected before anything is written, so the scan does not hold its read transactions open during the merges
+    merges = list(find_duplicates(storage))
+    print(f"Found {len(merges)} duplicate links in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    if dry_run:
+        for short_code, target in merges:
+            print(f"{short_code} -> {target}")
+        return
+
+    merged = 0
+    for short_code, target in merges:
+        if storage.merge_mapping(short_code, target):  # False when the link was deleted in the meantime
+            merged += 1
+        if merged % 1000 == 0:
+            print(f"\r{merged}/{len(merges)} merged", end='', file=sys.stderr, flush=True)
+
+    elapsed = time.perf_counter() - started
+    print(f"\rMerged {merged} duplicate links in {elapsed:.1f}s ({merged / elapsed if elapsed else 0:.0f} links/s)",
+          file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Merge the links of a user whose long URLs are the same into one short code.")
+    parser.add_argument('--db', default='url_shortener.db', help="the main database file (DATABASE)")
+    parser.add_argument('--shards', type=int, default=1, help="number of shard files (STORAGE_SHARDS)")
+    parser.add_argument('--shard-path', default='url_shortener.shard{}.db',
+                        help="the shard file names, {} is replaced by the shard number (STORAGE_SHARD_PATH)")
+    parser.add_argument('--dry-run', action='store_true', help="only print the merges that would be made")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')  # shows the migration notes
+
+    storage = make_storage(ConnectionPool(args.db), shard_count=args.shards, shard_path=args.shard_path)
+    storage.migrate()
+    try:
+        compact(storage, args.dry_run)
+    finally:
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+import hashlib
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+from array import array
+
+# A cuckoo filter over every short code in url_mappings.
+# The filter answers "might this code exist?" from memory. A "no" is definite, so lookups of unknown codes (typos,
+# scanners) skip the database entirely, a "yes" is wrong with a small probability and is confirmed by the database.
+# Unlike a Bloom filter it supports deletes, which delete_url_mapping needs.
+#
+# Each worker process keeps its own filter. Codes created by other processes are picked up by a cheap
+# "URL_ID > last seen" query per shard at most every refresh_interval seconds, codes deleted elsewhere simply stay in
+# the filter (a false positive, never a wrong "no"). A snapshot file lets a restarted worker skip the full rebuild.
+
+BUCKET_SIZE = 4  # fingerprints per bucket
+MAX_KICKS = 500  # relocations tried before an insert gives up and the filter is rebuilt larger
+SNAPSHOT_MAGIC = b'CKF2'
+SNAPSHOT_HEADER = struct.Struct('<4sIIQI')  # magic, schema version, bucket count, item count, shard count
+SNAPSHOT_MARK = struct.Struct('<Q')  # followed by the highest URL_ID seen in each shard
+
+
+def _hash(code):  # one 64 bit hash per code, split into the bucket index and the 16 bit fingerprint
+    value = int.from_bytes(hashlib.blake2b(code.encode('utf-8'), digest_size=8).digest(), 'little')
+    fingerprint = (value >> 48) or 1  # 0 marks an empty slot
+    return value, fingerprint
+
+
+class CuckooFilter:
+    def __init__(self, capacity=100000, num_buckets=None):
+        if num_buckets is None:
+            num_buckets = 1
+            while num_buckets * BUCKET_SIZE * 0.9 < capacity:  # stay below ~90% load, where inserts start failing
+                num_buckets *= 2
+        self.num_buckets = num_buckets  # always a power of two so the alternate bucket can be found with a XOR
+        self.mask = num_buckets - 1
+        self.slots = array('H', bytes(num_buckets * BUCKET_SIZE * 2))
+        self.count = 0
+        self.victim = None  # (bucket, fingerprint) that could not be placed, kept so it is never reported missing
+
+    def _alt_bucket(self, bucket, fingerprint):
+        return (bucket ^ (fingerprint * 0x5bd1e995)) & self.mask
+
+    def _buckets(self, code):
+        value, fingerprint = _hash(code)
+        first = value & self.mask
+        return first, self._alt_bucket(first, fingerprint), fingerprint
+
+    def _find(self, bucket, fingerprint):  # returns the slot holding fingerprint in bucket, or -1
+        start = bucket * BUCKET_SIZE
+        for slot in range(start, start + BUCKET_SIZE):
+            if self.slots[slot] == fingerprint:
+                return slot
+        return -1
+
+    def _place(self, bucket, fingerprint):  # puts fingerprint into a free slot of bucket, returns False when full
+        slot = self._find(bucket, 0)
+        if slot == -1:
+            return False
+        self.slots[slot] = fingerprint
+        return True
+
+    def add(self, code):  # returns False when the filter is too full, the caller should rebuild it larger
+        if self.victim is not None:
+            return False
+        first, second, fingerprint = self._buckets(code)
+        if self._place(first, fingerprint) or self._place(second, fingerprint):
+            self.count += 1
+            return True
+
+        bucket = random.choice((first, second))
+        for _ in range(MAX_KICKS):  # evict a random fingerprint and move it to its own alternate bucket
+            slot = bucket * BUCKET_SIZE + random.randrange(BUCKET_SIZE)
+            fingerprint, self.slots[slot] = self.slots[slot], fingerprint
+            bucket = self._alt_bucket(bucket, fingerprint)
+            if self._place(bucket, fingerprint):
+                self.count += 1
+                return True
+
+        self.victim = (bucket, fingerprint)
+        self.count += 1
+        return False
+
+    def __contains__(self, code):
+        first, second, fingerprint = self._buckets(code)
+        if self.victim is not None and self.victim[1] == fingerprint and self.victim[0] in (first, second):
+            return True
+        return self._find(first, fingerprint) != -1 or self._find(second, fingerprint) != -1
+
+    def remove(self, code):  # only call this for a code that was added, otherwise another code may be lost
+        first, second, fingerprint = self._buckets(code)
+        for bucket in (first, second):
+            slot = self._find(bucket, fingerprint)
+            if slot != -1:
+                self.slots[slot] = 0
+                self.count -= 1
+                return True
+        return False
+
+    @property
+    def memory_bytes(self):
+        return self.slots.itemsize * len(self.slots)
+
+    @property
+    def load_factor(self):
+        return self.count / (self.num_buckets * BUCKET_SIZE)
+
+    @property
+    def false_positive_rate(self):  # the expected share of unknown codes reported as "might exist"
+        return min(1.0, 2 * BUCKET_SIZE * self.load_factor / 65535)
+
+
+class ShortCodeFilter:  # the application's view of the filter: building, catching up, snapshots and statistics
+    def __init__(self, storage, snapshot_path=None, refresh_interval=1.0):
+        self.storage = storage
+        self.snapshot_path = snapshot_path
+        self.refresh_interval = refresh_interval
+        self.filter = None
+        self.loaded = False  # set once load() is done, until then every code "might exist" and nothing is tracked
+        self.high_water = []  # the highest URL_ID the filter has seen, per shard
+        # codes add() put in the filter whose rows are above high_water: the next catch up sees those rows again and
+        # must not add a second fingerprint, remove() would only take one of them away
+        self._added = set()
+        self.schema_version = 0
+        self._refreshed_at = 0.0
+        self._lock = threading.Lock()
+        self.definite_misses = 0
+        self.maybe_hits = 0
+
+    def load(self):  # loads the snapshot if it still matches the database, otherwise builds the filter from scratch
+        self.schema_version = self.storage.schema_version()
+        max_ids = self.storage.high_water_marks()
+
+        # may run on a background thread while requests are served: the lock is only taken for the final catch up,
+        # the other methods ignore the filter until it is marked loaded. Codes created in the meantime are found by
+        # that catch up, codes deleted in the meantime stay in the filter (a false positive).
+        if not self._load_snapshot(max_ids):
+            self._build()
+        with self._lock:
+            self._catch_up()
+            self.loaded = True
+
+    def _load_snapshot(self, max_ids):
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+        with open(self.snapshot_path, 'rb') as f:
+            header = f.read(SNAPSHOT_HEADER.size)
+            if len(header) != SNAPSHOT_HEADER.size:
+                return False
+            magic, schema_version, num_buckets, count, shards = SNAPSHOT_HEADER.unpack(header)
+            if magic != SNAPSHOT_MAGIC or schema_version != self.schema_version or shards != len(max_ids):
+                return False  # a snapshot from another schema or shard layout is rebuilt
+            marks = f.read(SNAPSHOT_MARK.size * shards)
+            if len(marks) != SNAPSHOT_MARK.size * shards:
+                return False
+            high_water = [mark for mark, in SNAPSHOT_MARK.iter_unpack(marks)]
+            if any(mark > max_id for mark, max_id in zip(high_water, max_ids)):
+                return False  # ahead of the database (e.g. the file was restored from a backup)
+            loaded = CuckooFilter(num_buckets=num_buckets)
+            loaded.slots = array('H')
+            loaded.slots.frombytes(f.read())
+        if len(loaded.slots) != num_buckets * BUCKET_SIZE:
+            return False
+        loaded.count = count
+        self.filter, self.high_water = loaded, high_water
+        return True
+
+    def save(self):  # writes the snapshot atomically, readers never see a half-written file
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            if not self.loaded or self.filter.victim is not None:
+                return
+            self._catch_up()  # the marks must cover every code in the filter, the ones add() put there included
+            header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, self.schema_version, self.filter.num_buckets,
+                                          self.filter.count, len(self.high_water))
+            header += b''.join(SNAPSHOT_MARK.pack(mark) for mark in self.high_water)
+            data = self.filter.slots.tobytes()
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            f.write(data)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _build(self, capacity=None):  # fills a new filter from every row of url_mappings and every alias
+        if capacity is None:
+            capacity = self.storage.count_mappings() * 2
+        while True:
+            self.filter = CuckooFilter(max(capacity, 100000))
+            self.high_water = [0] * self.storage.shard_count
+            self._added = set()
+            # merged duplicates keep resolving, their codes have to pass the filter too
+            if (self._add_rows(self.storage.scan_codes(self.high_water))
+                    and all(self.filter.add(short_code) for short_code in self.storage.alias_codes())):
+                return
+            capacity *= 2
+
+    def _add_rows(self, rows):  # adds (shard, URL_ID, code) rows, returns False if the filter ran full
+        for shard, url_id, short_code in rows:
+            if short_code in self._added:
+                self._added.discard(short_code)  # added by this process already, short codes are unique
+            elif not self.filter.add(short_code):
+                return False
+            self.high_water[shard] = max(self.high_water[shard], url_id)
+        return True
+
+    def _catch_up(self):  # adds the rows created since the filter last looked, by any process
+        rows = list(self.storage.scan_codes(self.high_water))
+        if not self._add_rows(rows):
+            self._build(self.filter.num_buckets * BUCKET_SIZE * 2)
+        self._refreshed_at = time.monotonic()
+
+    def refresh(self, force=False):  # catches up when the last refresh is older than refresh_interval
+        if not self.loaded:
+            return
+        if force or time.monotonic() - self._refreshed_at >= self.refresh_interval:
+            with self._lock:
+                self._catch_up()
+
+    def might_contain(self, short_code):  # False means the code definitely does not exist
+        if not self.loaded:
+            return True  # not loaded (yet), every code has to be checked in the database
+        self.refresh()
+        with self._lock:
+            found = short_code in self.filter
+        if found:
+            self.maybe_hits += 1
+        else:
+            self.definite_misses += 1
+        return found
+
+    def add(self, short_code):  # called after a mapping was inserted
+        if not self.loaded:
+            return
+        with self._lock:
+            if not self.filter.add(short_code):
+                self._build(self.filter.num_buckets * BUCKET_SIZE * 2)  # reads the new row too
+            else:
+                self._added.add(short_code)
+
+    def remove(self, short_code):  # called once a mapping was deleted
+        # the caller must have called refresh(force=True) while the row still existed: the row may have been
+        # created by another process, and removing a fingerprint that was never added could drop another code's
+        if not self.loaded:
+            return
+        with self._lock:
+            self.filter.remove(short_code)
+            self._added.discard(short_code)
+
+    def stats(self):
+        with self._lock:
+            if not self.loaded:
+                return {'loaded': False}
+            return {
+                'loaded': True,
+                'items': self.filter.count,
+                'buckets': self.filter.num_buckets,
+                'load_factor': self.filter.load_factor,
+                'memory_bytes': self.filter.memory_bytes,
+                'estimated_false_positive_rate': self.filter.false_positive_rate,
+                'high_water_url_ids': self.high_water,
+                'definite_misses': self.definite_misses,
+                'maybe_hits': self.maybe_hits,
+            }
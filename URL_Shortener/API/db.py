@@ -0,0 +1,115 @@
+import queue  # a thread-safe FIFO used to hold the idle connections of the pool
+import sqlite3  # for database operations, a database engine, a relational database management system
+import threading
+from contextlib import contextmanager
+
+from metrics import InstrumentedConnection  # a connection class timing every statement for the /metrics route
+
+
+DATABASE = 'url_shortener.db'  # the SQLite database file shared by every part of the application
+
+# Pragmas applied once to every new connection.
+# journal_mode=WAL lets readers keep working while the single writer commits, synchronous=NORMAL is safe under WAL
+# and avoids an fsync per commit, mmap_size maps the file into memory so reads skip the read() syscall, a negative
+# cache_size is in KiB (64 MiB of page cache per connection) and busy_timeout makes a writer wait instead of failing
+# straight away when another connection holds the write lock. auto_vacuum only takes effect in a file that has no
+# tables yet: new files are created with INCREMENTAL so the pages of purged links can be handed back to the file
+# system (see expiry.py), older files keep their mode until purge_links.py --convert rewrites them.
+PRAGMAS = (
+    ('auto_vacuum', 'INCREMENTAL'),
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('mmap_size', 268435456),
+    ('cache_size', -65536),
+    ('temp_store', 'MEMORY'),
+    ('busy_timeout', 5000),
+    ('foreign_keys', 'ON'),
+)
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    # raised when no connection became free in time, handled like SQLite's own "database is locked"
+    pass
+
+
+class ConnectionPool:  # a bounded pool of long-lived SQLite connections shared between worker threads
+    def __init__(self, database=DATABASE, max_size=8, cached_statements=256, pragmas=PRAGMAS, timeout=10.0):
+        self.database = database
+        self.max_size = max_size
+        self.timeout = timeout  # seconds acquire() waits for a connection once all max_size are checked out
+        self.pragmas = pragmas
+        # sqlite3 keeps an LRU of compiled statements per connection, reusing connections means the same parameterised
+        # query is only prepared once instead of once per request.
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue()  # LIFO so the most recently used (warmest) connection is handed out first
+        self._lock = threading.Lock()
+        self._created = 0
+
+    def _connect(self):  # opens a new connection and applies the tuned pragmas
+        conn = sqlite3.connect(self.database, timeout=5.0, check_same_thread=False,
+                               cached_statements=self.cached_statements, factory=InstrumentedConnection)
+        # check_same_thread=False because a connection may be checked out by different threads over its lifetime,
+        # the pool guarantees that only one thread uses it at a time.
+        for name, value in self.pragmas:
+            if name == 'auto_vacuum' and conn.execute('PRAGMA page_count').fetchone()[0]:
+                continue  # setting it on a file in use waits for the write lock and changes nothing anyway
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+    def acquire(self):  # hands out an idle connection, opening a new one while the pool is below max_size
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.max_size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)  # the pool is exhausted, wait for a connection to be released
+        except queue.Empty:
+            raise PoolTimeout(f"no connection to {self.database} was released within {self.timeout}s") from None
+
+    def release(self, conn):  # gives a connection back to the pool
+        if conn.in_transaction:
+            conn.rollback()  # never hand an open transaction (and the write lock it may hold) to the next user
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):  # a "with" block borrowing a connection, how the storage layer and the scripts use the pool
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):  # closes every idle connection, used at shutdown and by scripts that replace the db file
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+pool = ConnectionPool()  # the process wide pool used by the application
+
+
+def init_app(app):  # applies the settings of a Flask application to the pool
+    pool.database = app.config.get('DATABASE', pool.database)
+    pool.max_size = app.config.get('DB_POOL_SIZE', pool.max_size)
+    pool.timeout = app.config.get('DB_POOL_TIMEOUT', pool.timeout)
@@ -0,0 +1,98 @@
+import atexit  # for stopping the purge thread when the process exits
+import logging
+import threading
+import time
+
+# Link expiry.
+# A link may be created with an expiry time (url_mappings.EXPIRES_AT, unix time, NULL for a permanent link). From that
+# moment on it is gone for the redirect, test and list paths: their queries only match rows that have not expired, and
+# the redirect cache keeps a link no longer than it lives. LinkPurger then deletes the expired rows in the background,
+# at most batch_size per shard and transaction with a short pause in between, so the write lock is only ever held for
+# one small batch and the links being created at the same time barely notice. After a purge the freed pages are
+# handed back to the file system with "PRAGMA incremental_vacuum", a few at a time, so the database file follows the
+# number of live links instead of every link ever created (for files created with auto_vacuum = INCREMENTAL, see
+# db.PRAGMAS, older files are converted once with purge_links.py --convert).
+
+logger = logging.getLogger(__name__)
+
+
+def parse_expiry(expires_in=None, expires_at=None, default_ttl=None, now=None):
+    # turns the expires_in (seconds from now) or expires_at (unix time) a client sent into an EXPIRES_AT value, None
+    # for a permanent link. Raises ValueError for a value that is not a positive whole number or lies in the past.
+    now = int(time.time()) if now is None else now
+    if expires_at not in (None, ''):
+        expires_at = int(expires_at)
+        if expires_at <= now:
+            raise ValueError("expires_at lies in the past")
+        return expires_at
+    if expires_in in (None, ''):
+        expires_in = default_ttl
+        if not expires_in:
+            return None
+    expires_in = int(expires_in)
+    if expires_in <= 0:
+        raise ValueError("expires_in must be a positive number of seconds")
+    return now + expires_in
+
+
+class LinkPurger:  # deletes expired links in small batches on a background thread
+    def __init__(self, storage, interval=60.0, batch_size=500, pause=0.05, vacuum_pages=1000, on_purge=None):
+        self.storage = storage
+        self.interval = interval  # seconds between two purges
+        self.batch_size = batch_size  # links deleted per shard and transaction
+        self.pause = pause  # seconds between two batches, lets the waiting writers in
+        self.vacuum_pages = vacuum_pages  # free pages handed back to the file system after a purge, 0 disables
+        self.on_purge = on_purge  # called with the short codes of every deleted batch
+        self.purged = 0
+        self.vacuumed_pages = 0
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):  # starts the background purge, the first one runs right away
+        if self._thread is not None:
+            return  # already running, checked without the lock because every request calls this
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='link-purger', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped:
+            try:
+                self.purge()
+            except Exception:
+                logger.exception("Error while purging expired links")  # the next purge picks the rows up again
+            self._wake.wait(self.interval)
+
+    def purge(self, now=None):  # deletes every link expired at now, returns how many were deleted
+        now = int(time.time()) if now is None else now
+        deleted = 0
+        while not self._stopped:
+            codes = self.storage.purge_expired(now, self.batch_size)
+            if not codes:
+                break
+            deleted += len(codes)
+            if self.on_purge is not None:
+                self.on_purge(codes)
+            time.sleep(self.pause)
+        self.purged += deleted
+        while deleted and self.vacuum_pages and not self._stopped:
+            freed = self.storage.incremental_vacuum(self.vacuum_pages)  # a few pages per transaction as well
+            self.vacuumed_pages += freed
+            if not freed:
+                break
+            time.sleep(self.pause)
+        return deleted
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+
+    def stats(self):
+        return {'purged': self.purged, 'vacuumed_pages': self.vacuumed_pages, 'running': self._thread is not None}
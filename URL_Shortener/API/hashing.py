@@ -0,0 +1,138 @@
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+# Werkzeug is utility library for WSGI that provides security related functions
+
+# Password hashing off the request workers.
+# Hashing is deliberately slow, so it runs in a small pool of separate processes (which do not compete for the GIL
+# with the request threads). At most workers + max_queue hashes may be running or waiting at once, any request beyond
+# that is turned away immediately with HashingSaturated instead of tying up another request thread. Per-IP and
+# per-email token buckets stop a single client from filling that budget on its own.
+
+
+class HashingSaturated(Exception):  # raised when the hashing pool is full or did not answer in time
+    pass
+
+
+def _generate(password, method):  # runs in a hashing process
+    return generate_password_hash(password, method=method)
+
+
+def _check(stored_hash, password):  # runs in a hashing process
+    return check_password_hash(stored_hash, password)
+
+
+def hash_parameters(stored_hash):  # the method and cost part of a werkzeug hash, e.g. 'scrypt:32768:8:1'
+    return stored_hash.split('$', 1)[0]
+
+
+class PasswordHasher:
+    def __init__(self, workers=2, max_queue=16, timeout=5.0, method='scrypt'):
+        self.workers = workers
+        self.max_in_flight = workers + max_queue  # running plus waiting hashes
+        self.timeout = timeout
+        self.method = method
+        self._parameters = None  # hash_parameters() of a hash made with the current method, worked out by start()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self.rejected = 0
+
+    def start(self):
+        # starts the hashing processes. Call this at startup, before the application starts any threads: with the
+        # fork start method all the processes are created by the first task, and forking a process that is still
+        # single-threaded is safe.
+        with self._lock:
+            if self._executor is None:
+                # fork is not available everywhere (Windows), the default start method is used there instead
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+                executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                # the first task creates the processes, it also makes the reference hash needs_rehash() compares to
+                self._parameters = hash_parameters(executor.submit(_generate, '', self.method).result())
+                self._executor = executor
+
+    def _pool(self):
+        if self._executor is None:
+            self.start()
+        return self._executor
+
+    def _run(self, function, *args):  # runs function in the pool, or raises HashingSaturated straight away
+        with self._lock:
+            if self._in_flight >= self.max_in_flight:
+                self.rejected += 1
+                raise HashingSaturated()
+            self._in_flight += 1
+        try:
+            future = self._pool().submit(function, *args)
+        except BrokenProcessPool:
+            self._finished(None)
+            self._restart()
+            raise HashingSaturated() from None
+        except BaseException:
+            self._finished(None)
+            raise
+        # the slot is given back when the task is done, not when the request stops waiting for it: a task that timed
+        # out still occupies the pool until it runs or is cancelled, and the cap has to count it
+        future.add_done_callback(self._finished)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()  # drops the task if it has not started yet, a running one finishes on its own
+            raise HashingSaturated() from None
+        except BrokenProcessPool:
+            self._restart()
+            raise HashingSaturated() from None
+
+    def _finished(self, future):  # gives back the slot of a task, called by the pool once the task is done
+        with self._lock:
+            self._in_flight -= 1
+
+    def _restart(self):
+        # a hashing process died (e.g. killed by the OOM killer), start a fresh pool for the next request
+        with self._lock:
+            self._executor = None
+
+    def generate(self, password):
+        return self._run(_generate, password, self.method)
+
+    def check(self, stored_hash, password):
+        return self._run(_check, stored_hash, password)
+
+    def needs_rehash(self, stored_hash):  # True when the hash was made with other cost parameters than configured
+        if self._parameters is None:
+            self.start()
+        return hash_parameters(stored_hash) != self._parameters
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class TokenBucketLimiter:  # allows `burst` attempts per key at once, refilled at `rate` attempts per second
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys  # the least recently seen keys are forgotten beyond this, bounding memory
+        self._buckets = OrderedDict()  # key -> (tokens, last refill time)
+        self._lock = threading.Lock()
+
+    def allow(self, key):  # takes a token for key, returns the seconds to wait when none is left (0 when allowed)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                wait = 0
+            else:
+                self._buckets[key] = (tokens, now)
+                wait = (1 - tokens) / self.rate
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
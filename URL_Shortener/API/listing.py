@@ -0,0 +1,60 @@
+import csv  # for writing the CSV export
+import io
+import json
+
+from short_codes import format_short_url
+
+# Keyset pagination and streaming export of a user's links.
+# Pages are read with "URL_ID > last seen id ORDER BY URL_ID LIMIT n" (see Storage.list_page), which walks the
+# (USER_ID) index from where the previous page stopped instead of counting past an OFFSET, so every page costs the same
+# no matter how deep it is. The export reuses the same query chunk by chunk, holding at most one chunk in memory and no
+# long read transaction.
+
+EXPORT_COLUMNS = ('url_id', 'short_code', 'short_url', 'long_url', 'created_at', 'expires_at')
+
+
+def fetch_page(storage, user_id, cursor=None, limit=100):
+    # returns (rows, next_cursor), next_cursor is None on the last page. Rows are dicts ready to be rendered or
+    # turned into JSON. The cursor is opaque: a URL_ID for a single database file, '<URL_ID>.<shard>' for shards.
+    records, next_cursor = storage.list_page(user_id, cursor, limit)
+    rows = [
+        {'url_id': url_id, 'short_code': short_code, 'short_url': format_short_url(short_code),
+         'long_url': long_url, 'created_at': created_at, 'expires_at': expires_at}
+        for url_id, short_code, long_url, created_at, expires_at in records
+    ]
+    return rows, next_cursor
+
+
+def iter_rows(storage, user_id, chunk_size=1000):  # yields every link of a user, one chunk per query
+    rows, cursor = fetch_page(storage, user_id, None, chunk_size)
+    yield from rows
+    while cursor is not None:  # the connections go back to the pool between chunks
+        rows, cursor = fetch_page(storage, user_id, cursor, chunk_size)
+        yield from rows
+
+
+def export_csv(storage, user_id, chunk_size=1000):  # yields the CSV export in pieces of about one chunk
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+
+    for count, row in enumerate(iter_rows(storage, user_id, chunk_size), start=1):
+        writer.writerow([row[column] for column in EXPORT_COLUMNS])
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def export_jsonl(storage, user_id, chunk_size=1000):  # yields the export as JSON lines, one object per link
+    lines = []
+    for row in iter_rows(storage, user_id, chunk_size):
+        lines.append(json.dumps(row, separators=(',', ':')))
+        if len(lines) == chunk_size:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+
+    if lines:
+        yield '\n'.join(lines) + '\n'
@@ -0,0 +1,49 @@
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+
+# Long URL normalization for deduplication.
+# Two long URLs that only differ in the case of the scheme or host, a default port or a missing "/" path lead to the
+# same page and are treated as the same link. Every url_mappings row stores a 64 bit hash of its normalized LONG_URL
+# (LONG_URL_HASH), indexed together with USER_ID, so finding an existing link for a URL is one small index lookup
+# instead of a scan of the LONG_URL texts. Hash collisions are ruled out by comparing the normalized URLs themselves.
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+MAX_URL_LENGTH = 2048  # the longest long URL accepted from users and imports
+
+
+def normalize_long_url(url):  # the canonical form of a URL, anything that is not an absolute URL is only stripped
+    url = (url or '').strip()
+    parts = urlsplit(url)
+    if not parts.scheme or not parts.netloc:
+        return url
+
+    try:
+        port = parts.port
+    except ValueError:
+        return url  # not a valid port, leave the URL alone
+
+    scheme = parts.scheme.lower()
+    host = parts.hostname or ''  # already lower case
+    if ':' in host:
+        host = f'[{host}]'  # an IPv6 address
+    userinfo = parts.netloc.rpartition('@')[0]
+    netloc = (userinfo + '@' if userinfo else '') + host
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc += f':{port}'
+    return urlunsplit((scheme, netloc, parts.path or '/', parts.query, parts.fragment))
+
+
+def long_url_error(url):  # why a long URL cannot be shortened, None when it can
+    if len(url) > MAX_URL_LENGTH:
+        return f"long URL is longer than {MAX_URL_LENGTH} characters"
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.netloc:
+        return "long URL must be an absolute http(s) URL"  # no javascript:, data: or relative URLs
+    return None
+
+
+def long_url_hash(url):  # a signed 64 bit hash of the normalized URL, stored as an SQLite INTEGER
+    if url is None:
+        return None
+    digest = hashlib.blake2b(normalize_long_url(url).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
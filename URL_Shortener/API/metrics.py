@@ -0,0 +1,198 @@
+import re
+import sqlite3  # for database operations, a database engine, a relational database management system
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import lru_cache
+
+from flask import g, request, template_rendered, before_render_template
+# template_rendered, before_render_template: Flask signals sent around every render_template() call
+
+# Request, SQL, template, QR and password hashing instrumentation in the Prometheus text format.
+# Every observation is a perf_counter() difference added to a histogram under a lock, cheap enough to leave on in
+# production. The registry is rendered by the /metrics route. While a request is running, the SQL statements it runs
+# are also collected per request so that a slow request can be logged together with its query breakdown.
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):  # escapes a label value for the text format
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:  # a Prometheus histogram, one set of buckets per combination of label values
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}  # label values -> [count per bucket..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect_left(self.buckets, value)  # the first bucket whose upper bound is >= value
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):  # times the body of a "with" block
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labelvalues)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = {labelvalues: list(values) for labelvalues, values in self._series.items()}
+        inf_label = 'le="+Inf"'
+        for labelvalues, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                labels = _labels(self.labelnames, labelvalues, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            cumulative += values[len(self.buckets)]
+            lines.append(f'{self.name}_bucket{_labels(self.labelnames, labelvalues, inf_label)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labelnames, labelvalues)} {values[-1]}')
+            lines.append(f'{self.name}_count{_labels(self.labelnames, labelvalues)} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):  # the whole registry in the Prometheus text exposition format
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram('http_request_duration_seconds', 'Time spent handling HTTP requests.',
+                                     ('endpoint', 'method', 'status'))
+SQL_SECONDS = REGISTRY.histogram('sqlite_statement_duration_seconds', 'Time spent executing SQL statements.',
+                                 ('statement',))
+TEMPLATE_SECONDS = REGISTRY.histogram('template_render_duration_seconds', 'Time spent rendering Jinja templates.',
+                                      ('template',))
+QR_RENDER_SECONDS = REGISTRY.histogram('qr_render_duration_seconds', 'Time spent encoding QR codes with segno.',
+                                       ('format',))
+PASSWORD_HASH_SECONDS = REGISTRY.histogram('password_hash_duration_seconds',
+                                           'Time spent hashing and checking passwords.', ('operation',))
+
+_local = threading.local()  # per thread: the running request's query breakdown and the template timer
+
+
+@lru_cache(maxsize=1024)
+def normalize_statement(sql):  # one label per statement shape: whitespace collapsed, "IN (?, ?, ...)" shortened
+    sql = ' '.join(sql.split())
+    return re.sub(r'IN \((\?, )+\?\)', 'IN (?...)', sql)
+
+
+def _record_statement(sql, elapsed):
+    statement = normalize_statement(sql)
+    SQL_SECONDS.observe(elapsed, statement)
+    queries = getattr(_local, 'queries', None)
+    if queries is not None:
+        entry = queries[statement]
+        entry[0] += 1
+        entry[1] += elapsed
+
+
+class InstrumentedCursor(sqlite3.Cursor):  # a cursor timing every statement it executes
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_statement(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_statement(sql, time.perf_counter() - started)
+
+
+class InstrumentedConnection(sqlite3.Connection):  # pass as factory= to sqlite3.connect() to time every statement
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def _before_request():
+    g.metrics_started = time.perf_counter()
+    _local.queries = defaultdict(lambda: [0, 0.0])  # statement -> [executions, seconds]
+
+
+def _after_request(response):
+    g.metrics_status = response.status_code
+    return response
+
+
+def _teardown_request(app):
+    def teardown(exception=None):
+        started = g.pop('metrics_started', None)
+        queries, _local.queries = getattr(_local, 'queries', None), None
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+        status = g.pop('metrics_status', 500)
+        REQUEST_SECONDS.observe(elapsed, endpoint, request.method, str(status))
+
+        threshold = app.config.get('SLOW_REQUEST_SECONDS')
+        if threshold is not None and elapsed >= threshold:
+            breakdown = sorted((queries or {}).items(), key=lambda item: item[1][1], reverse=True)
+            details = '; '.join(f'{seconds * 1000:.1f}ms x{count} {statement}'
+                                for statement, (count, seconds) in breakdown[:10])
+            app.logger.warning("Slow request %s %s took %.1fms (status %s), SQL: %s",
+                               request.method, request.path, elapsed * 1000, status, details or 'none')
+    return teardown
+
+
+def _before_render(sender, template, context, **extra):
+    _local.template_started = time.perf_counter()
+
+
+def _rendered(sender, template, context, **extra):
+    started = getattr(_local, 'template_started', None)
+    if started is not None:
+        TEMPLATE_SECONDS.observe(time.perf_counter() - started, template.name or 'string')
+        _local.template_started = None
+
+
+def init_app(app):  # wires the request and template timers into a Flask application
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request(app))
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
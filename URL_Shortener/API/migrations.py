@@ -0,0 +1,190 @@
+import logging
+import sqlite3  # for database operations, a database engine, a relational database management system
+
+from short_codes import SHORT_URL_PREFIX
+from long_urls import long_url_hash
+
+# Versioned schema migrations.
+# The schema version of a database file is kept in SQLite's built-in "PRAGMA user_version" header field, every
+# function registered with @migration brings the schema up by one version. migrate() runs the missing steps once at
+# startup, each step in its own transaction, so an existing url_shortener.db is upgraded in place.
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = []  # the ordered list of migration steps, index + 1 is the schema version a step produces
+
+
+def migration(func):  # decorator registering a migration step, the order of definition is the order they run in
+    MIGRATIONS.append(func)
+    return func
+
+
+@migration
+def create_base_tables(conn):  # version 1: the original tables, a no-op for databases created by older releases
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS users '
+        '(ID INTEGER PRIMARY KEY AUTOINCREMENT, NAME TEXT, EMAIL TEXT UNIQUE, PASSWORD TEXT)'
+    )
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS url_mappings '
+        '(URL_ID INTEGER PRIMARY KEY AUTOINCREMENT,  USER_ID INTEGER, LONG_URL TEXT, SHORT_URL TEXT, '
+        'FOREIGN KEY (USER_ID) REFERENCES users(ID))'
+    )
+
+
+@migration
+def bare_short_codes_and_indexes(conn):  # version 2: store only the bare code and index the lookup columns
+    # strip the 'https://short-url/' prefix from every stored short url, keeping only the code itself
+    conn.execute("UPDATE url_mappings SET SHORT_URL = substr(SHORT_URL, ?) WHERE substr(SHORT_URL, 1, ?) = ?",
+                 (len(SHORT_URL_PREFIX) + 1, len(SHORT_URL_PREFIX), SHORT_URL_PREFIX))
+
+    # the old collision check did not stop the same user from holding a code twice, keep the oldest row
+    conn.execute(
+        'DELETE FROM url_mappings WHERE URL_ID NOT IN '
+        '(SELECT MIN(URL_ID) FROM url_mappings GROUP BY USER_ID, SHORT_URL)'
+    )
+
+    # (USER_ID, SHORT_URL) answers the per-user existence checks and the per-user listing from the index alone
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_url_mappings_user_short '
+                 'ON url_mappings (USER_ID, SHORT_URL)')
+    # SHORT_URL on its own serves lookups by code regardless of the owner (collision checks, public redirects)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_url_mappings_short ON url_mappings (SHORT_URL)')
+
+
+@migration
+def globally_unique_short_codes(conn):  # version 3: one owner per short code and the allocator tables
+    # older releases only checked codes per user, the oldest mapping keeps a code that several users share and the
+    # newer ones are renamed to '<code>-<URL_ID>' ('-' never appears in allocated codes, so this cannot collide).
+    # Every rename is recorded: the other owners keep reaching their link under the old code on the signed-in routes
+    # (see Storage.get_link), and the table tells them (or an administrator) which new code their link got.
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS short_code_renames '
+        '(OLD_CODE TEXT NOT NULL, USER_ID INTEGER, NEW_CODE TEXT NOT NULL, RENAMED_AT INTEGER NOT NULL, '
+        'PRIMARY KEY (OLD_CODE, USER_ID))'
+    )
+    shared = "URL_ID NOT IN (SELECT MIN(URL_ID) FROM url_mappings GROUP BY SHORT_URL)"
+    conn.execute(
+        "INSERT INTO short_code_renames (OLD_CODE, USER_ID, NEW_CODE, RENAMED_AT) "
+        "SELECT SHORT_URL, USER_ID, SHORT_URL || '-' || URL_ID, CAST(strftime('%s', 'now') AS INTEGER) "
+        f"FROM url_mappings WHERE {shared}"
+    )
+    renamed = conn.execute(f"UPDATE url_mappings SET SHORT_URL = SHORT_URL || '-' || URL_ID WHERE {shared}").rowcount
+    if renamed:
+        logger.warning("Renamed %d short codes that several users shared, the old and new codes are listed in the "
+                       "short_code_renames table", renamed)
+    conn.execute('DROP INDEX IF EXISTS idx_url_mappings_short')
+    conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_url_mappings_short_unique ON url_mappings (SHORT_URL)')
+
+    # the monotonic counters used by allocator.SequenceAllocator
+    conn.execute('CREATE TABLE IF NOT EXISTS code_sequences (NAME TEXT PRIMARY KEY, NEXT_VALUE INTEGER NOT NULL)')
+    conn.execute("INSERT OR IGNORE INTO code_sequences (NAME, NEXT_VALUE) VALUES ('short_code', 0)")
+    # the pre-generated random codes used by allocator.RandomPoolAllocator
+    conn.execute('CREATE TABLE IF NOT EXISTS code_pool (CODE TEXT PRIMARY KEY) WITHOUT ROWID')
+
+
+@migration
+def click_analytics(conn):  # version 4: aggregated click counters written by analytics.ClickRecorder
+    # one row per short code, time bucket and referrer host, the primary key also serves the per-link statistics
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS url_clicks '
+        '(SHORT_URL TEXT NOT NULL, BUCKET INTEGER NOT NULL, REFERRER TEXT NOT NULL, CLICKS INTEGER NOT NULL, '
+        'PRIMARY KEY (SHORT_URL, BUCKET, REFERRER)) WITHOUT ROWID'
+    )
+
+
+@migration
+def keyset_listing(conn):  # version 5: creation time of each link and an index for listing a user's links in order
+    conn.execute('ALTER TABLE url_mappings ADD COLUMN CREATED_AT INTEGER')  # unix time, NULL for older links
+    # SQLite appends the rowid (URL_ID) to every index entry, so this index is ordered by (USER_ID, URL_ID) and
+    # serves "WHERE USER_ID = ? AND URL_ID > ? ORDER BY URL_ID" as a range scan
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_url_mappings_user_id ON url_mappings (USER_ID)')
+
+
+@migration
+def user_shard_index(conn):  # version 6: which shard files hold links of which user
+    # only filled by storage.ShardedSQLiteStorage, it lets a user's links be listed without asking every shard
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS user_shards '
+        '(USER_ID INTEGER NOT NULL, SHARD INTEGER NOT NULL, PRIMARY KEY (USER_ID, SHARD)) WITHOUT ROWID'
+    )
+
+
+@migration
+def bulk_import_checkpoints(conn):  # version 7: resumable progress of bulk.py imports, one row per input file
+    # every database file (main and shards) keeps its own row, updated in the same transaction as the rows it received
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS import_checkpoints '
+        '(SOURCE TEXT PRIMARY KEY, OFFSET INTEGER NOT NULL, START_ID INTEGER NOT NULL, INDEXES TEXT, '
+        'CHUNK_SIZE INTEGER, PENDING_OFFSET INTEGER, CODE_BASE INTEGER, '
+        'IMPORTED INTEGER NOT NULL DEFAULT 0, REJECTED INTEGER NOT NULL DEFAULT 0)'
+    )
+
+
+@migration
+def long_url_dedup(conn):  # version 8: a hash of every normalized long URL, and aliases for merged duplicates
+    conn.execute('ALTER TABLE url_mappings ADD COLUMN LONG_URL_HASH INTEGER')
+    conn.create_function('long_url_hash', 1, long_url_hash, deterministic=True)
+    conn.execute('UPDATE url_mappings SET LONG_URL_HASH = long_url_hash(LONG_URL)')
+    # (LONG_URL_HASH, USER_ID) finds a user's link for a URL, and with the hash alone anybody's link for it
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_url_mappings_long_url_hash ON url_mappings (LONG_URL_HASH, USER_ID)')
+    # codes of duplicates merged by compact_urls.py, they keep redirecting to the link they were merged into
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS url_aliases '
+        '(SHORT_URL TEXT PRIMARY KEY, TARGET TEXT NOT NULL, USER_ID INTEGER) WITHOUT ROWID'
+    )
+
+
+@migration
+def link_expiry(conn):  # version 9: an optional expiry time per link
+    conn.execute('ALTER TABLE url_mappings ADD COLUMN EXPIRES_AT INTEGER')  # unix time, NULL for a permanent link
+    # a partial index: only the links that expire take space in it, and the purge finds the expired ones in order
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_url_mappings_expires_at ON url_mappings (EXPIRES_AT) '
+                 'WHERE EXPIRES_AT IS NOT NULL')
+
+
+@migration
+def api_tokens(conn):  # version 10: bearer tokens of the JSON API, only their SHA-256 is stored
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS api_tokens '
+        '(TOKEN_HASH TEXT PRIMARY KEY, USER_ID INTEGER NOT NULL, NAME TEXT, CREATED_AT INTEGER) WITHOUT ROWID'
+    )
+
+
+@migration
+def mapping_deletions(conn):  # version 11: a log of deleted links, read by snapshot.py to update its file in place
+    # AUTOINCREMENT so a sequence number is never handed out twice, not even after the newest rows were trimmed
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS mapping_deletions '
+        '(SEQ INTEGER PRIMARY KEY AUTOINCREMENT, SHORT_URL TEXT NOT NULL, DELETED_AT INTEGER NOT NULL)'
+    )
+    # a trigger catches every way a link disappears (delete, expiry purge, merge into an alias). bulk.py drops the
+    # entries of the duplicate rows it removes, their codes stay live in the row that keeps them.
+    conn.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_url_mappings_deleted AFTER DELETE ON url_mappings BEGIN '
+        'INSERT INTO mapping_deletions (SHORT_URL, DELETED_AT) '
+        "VALUES (OLD.SHORT_URL, CAST(strftime('%s', 'now') AS INTEGER)); END"
+    )
+
+
+def schema_version(conn):  # returns the schema version stored in the database header
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):  # applies every migration the database has not seen yet, returns the resulting version
+    version = schema_version(conn)
+
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            conn.execute('BEGIN IMMEDIATE')  # take the write lock up front so two workers never migrate at once
+            if schema_version(conn) >= number:  # another process finished this step while we waited for the lock
+                conn.rollback()
+                continue
+            step(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+        logger.info("Applied migration %d: %s", number, step.__name__)
+
+    return schema_version(conn)
@@ -0,0 +1,65 @@
+import argparse
+import logging
+import sqlite3  # for database operations, a database engine, a relational database management system
+import time
+
+from db import ConnectionPool
+from expiry import LinkPurger
+from storage import make_storage
+
+# Deletes expired links from the command line, the same way the application's background purge does (see expiry.py),
+# for deployments that set LINK_PURGE_INTERVAL = None and purge from cron instead:
+#
+#   python purge_links.py --db url_shortener.db
+#
+# Files created before auto_vacuum = INCREMENTAL became the default cannot hand free pages back until they have been
+# rewritten once. --convert does that with a full VACUUM of every file, which needs about as much free disk space as
+# the file itself and blocks writers while it runs, so stop the application first.
+
+
+def convert(paths):  # switches every file to auto_vacuum = INCREMENTAL, returns the paths that were rewritten
+    converted = []
+    for path in paths:
+        conn = sqlite3.connect(path)
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            started = time.perf_counter()
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')  # the new mode only takes effect once the file is rebuilt
+            print(f"Converted {path} to incremental auto_vacuum in {time.perf_counter() - started:.1f}s")
+            converted.append(path)
+        conn.close()
+    return converted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Delete expired links and give their space back.")
+    parser.add_argument('--db', default='url_shortener.db', help="the main database file (DATABASE)")
+    parser.add_argument('--shards', type=int, default=1, help="number of shard files (STORAGE_SHARDS)")
+    parser.add_argument('--shard-path', default='url_shortener.shard{}.db',
+                        help="the shard file names, {} is replaced by the shard number (STORAGE_SHARD_PATH)")
+    parser.add_argument('--batch-size', type=int, default=500, help="links deleted per transaction (LINK_PURGE_BATCH)")
+    parser.add_argument('--vacuum-pages', type=int, default=1000,
+                        help="free pages handed back per transaction (LINK_VACUUM_PAGES), 0 disables")
+    parser.add_argument('--convert', action='store_true',
+                        help="rewrite files without incremental auto_vacuum once (application stopped)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')  # shows the migration notes
+
+    if args.convert:
+        shard_paths = [args.shard_path.format(number) for number in range(args.shards)] if args.shards > 1 else []
+        convert([args.db] + shard_paths)
+
+    storage = make_storage(ConnectionPool(args.db), shard_count=args.shards, shard_path=args.shard_path)
+    storage.migrate()
+    try:
+        purger = LinkPurger(storage, batch_size=args.batch_size, vacuum_pages=args.vacuum_pages)
+        started = time.perf_counter()
+        purger.purge()
+        print(f"Purged {purger.purged} expired links and freed {purger.vacuumed_pages} pages in "
+              f"{time.perf_counter() - started:.1f}s")
+    finally:
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from metrics import QR_RENDER_SECONDS
+
+# Content-addressed QR code cache.
+# An image is identified by a hash of the encoded data and the render options, so the same URL rendered the same way
+# is only ever encoded once. Rendered images are kept in a bounded in-memory cache backed by files in cache_dir, and
+# the hash doubles as the ETag of the HTTP response.
+
+FORMATS = {  # the image formats that can be served, with their content types
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+
+class QRCodeCache:
+    def __init__(self, cache_dir='qr_cache', max_memory_bytes=32 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self._memory = OrderedDict()  # key -> image bytes, least recently used first
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.renders = 0
+
+    @staticmethod
+    def key(data, fmt, scale, border):  # the content address of an image
+        return hashlib.sha256(f'{fmt}|{scale}|{border}|{data}'.encode('utf-8')).hexdigest()
+
+    def get(self, data, fmt='png', scale=5, border=4):  # returns (image bytes, key), rendering only on a full miss
+        key = self.key(data, fmt, scale, border)
+
+        with self._lock:
+            image = self._memory.get(key)
+            if image is not None:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return image, key
+
+        path = os.path.join(self.cache_dir, f'{key}.{fmt}')
+        try:
+            with open(path, 'rb') as f:
+                image = f.read()
+            self.disk_hits += 1
+        except FileNotFoundError:
+            image = self._render(data, fmt, scale, border)
+            self._write(path, image)
+
+        self._remember(key, image)
+        return image, key
+
+    def _render(self, data, fmt, scale, border):
+        import segno  # a python library for generating qr codes, imported by the first render to keep startup short
+        buffer = io.BytesIO()
+        with QR_RENDER_SECONDS.time(fmt):
+            segno.make(data).save(buffer, kind=fmt, scale=scale, border=border)
+        self.renders += 1
+        return buffer.getvalue()
+
+    def _write(self, path, image):  # writes to a temporary file first so readers never see a half-written image
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(image)
+            os.replace(tmp_path, path)  # atomic, concurrent writers of the same key just replace identical bytes
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+    def _remember(self, key, image):  # adds an image to the memory cache, evicting the least recently used ones
+        with self._lock:
+            if key in self._memory or len(image) > self.max_memory_bytes:
+                return
+            self._memory[key] = image
+            self._memory_bytes += len(image)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._memory),
+                'memory_bytes': self._memory_bytes,
+                'max_memory_bytes': self.max_memory_bytes,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'renders': self.renders,
+            }
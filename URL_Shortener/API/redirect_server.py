@@ -0,0 +1,186 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+from urllib.parse import quote, unquote
+
+from snapshot_file import Snapshot
+
+# A redirect-only server for the public GET /<code> route, next to (or in front of) the Flask application.
+# It answers from a snapshot file written by snapshot.py instead of the database: no login, session or template
+# machinery and no database connections, just a binary search over the memory-mapped file per request. The file is
+# mapped with snapshot_file.py, which needs nothing but the standard library. One asyncio event loop per process
+# keeps thousands of keep-alive connections open, --workers starts several processes that share the listening port
+# (SO_REUSEPORT) and, through the page cache, the one copy of the snapshot.
+#
+#   python snapshot.py --db url_shortener.db --out url_shortener.snapshot --interval 5 &
+#   python redirect_server.py --snapshot url_shortener.snapshot --port 8080 --workers 4
+#
+# The server checks every --reload-interval seconds whether the snapshot file was replaced and maps the new one, so
+# links show up (and disappear) one snapshot interval after they were changed. Expired links stop redirecting right
+# away, the expiry time is part of the snapshot. Clicks are not counted here, the server never writes anything.
+
+MAX_HEADER_SIZE = 8192  # bytes of request line and headers accepted before the connection is dropped
+REASONS = {200: 'OK', 301: 'Moved Permanently', 302: 'Found', 307: 'Temporary Redirect', 308: 'Permanent Redirect',
+           400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 431: 'Request Header Fields Too Large',
+           503: 'Service Unavailable'}
+URL_SAFE = "/:?#[]@!$&'()*+,;=%~"  # kept as they are when a long URL is put into a Location header
+
+
+class RedirectServer:  # the state shared by the connections of one process
+    def __init__(self, path, status=302, idle_timeout=15.0):
+        self.path = path
+        self.status = status  # like the application's REDIRECT_STATUS
+        self.idle_timeout = idle_timeout  # seconds a keep-alive connection may stay silent
+        self.snapshot = None
+        self.connections = set()
+        self.requests = 0
+        self.misses = 0
+        self.reload()
+
+    def reload(self):  # maps the snapshot file again if it has been replaced, True if it was
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False  # not written yet, or being replaced right now
+        if self.snapshot is not None and (stat.st_ino, stat.st_mtime_ns) == \
+                (self.snapshot.stat.st_ino, self.snapshot.stat.st_mtime_ns):
+            return False
+        snapshot = Snapshot(self.path)
+        old, self.snapshot = self.snapshot, snapshot
+        if old is not None:
+            old.close()  # lookups run on the event loop thread, none can be using the old map at this point
+        print(f"[{os.getpid()}] Serving {snapshot.count} links from {self.path}", flush=True)
+        return True
+
+    def tick(self, loop, reload_interval):  # runs every reload_interval seconds on the event loop
+        try:
+            self.reload()
+        except (OSError, ValueError) as e:
+            print(f"[{os.getpid()}] Keeping the current snapshot, could not map the new one:", e, flush=True)
+        idle_since = loop.time() - self.idle_timeout
+        for connection in [c for c in self.connections if c.last_active < idle_since]:
+            connection.transport.close()
+        loop.call_later(reload_interval, self.tick, loop, reload_interval)
+
+    def respond(self, target):  # returns (status, extra headers, body) for a GET or HEAD request
+        if self.snapshot is None:
+            return 503, '', b'No snapshot loaded yet.\n'
+        short_code = unquote(target.partition('?')[0][1:])
+        self.requests += 1
+        link = self.snapshot.get(short_code) if short_code and '/' not in short_code else None
+        if link is None:
+            self.misses += 1
+            return 404, '', b'Not Found\n'
+        return self.status, f'Location: {quote(link[0], safe=URL_SAFE)}\r\n', b''
+
+
+class RedirectProtocol(asyncio.Protocol):  # one client connection, HTTP/1.1 with keep-alive and pipelining
+    def __init__(self, server, loop):
+        self.server = server
+        self.loop = loop
+        self.transport = None
+        self.buffer = b''
+        self.last_active = loop.time()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.connections.add(self)
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+
+    def data_received(self, data):
+        self.last_active = self.loop.time()
+        self.buffer += data
+        while self.buffer:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self.buffer) > MAX_HEADER_SIZE:
+                    self.send(431, '', b'', keep_alive=False)
+                return  # the rest of the request has not arrived yet
+            head, self.buffer = self.buffer[:end].decode('latin-1'), self.buffer[end + 4:]
+            if not self.handle(head):
+                return
+
+    def handle(self, head):  # answers one request, False once the connection is being closed
+        request_line, *header_lines = head.split('\r\n')
+        parts = request_line.split(' ')
+        if len(parts) != 3 or not parts[2].startswith('HTTP/1.') or not parts[1].startswith('/'):
+            return self.send(400, '', b'Bad Request\n', keep_alive=False)
+        method, target, version = parts
+        headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+        if headers.get('content-length', '0') != '0' or 'transfer-encoding' in headers:
+            return self.send(400, '', b'Request bodies are not accepted.\n', keep_alive=False)
+
+        connection = headers.get('connection', '')
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+        if method not in ('GET', 'HEAD'):
+            return self.send(405, 'Allow: GET, HEAD\r\n', b'', keep_alive)
+        status, extra, body = self.server.respond(target)
+        return self.send(status, extra, b'' if method == 'HEAD' else body, keep_alive, len(body))
+
+    def send(self, status, extra, body, keep_alive, length=None):
+        self.transport.write(
+            f"HTTP/1.1 {status} {REASONS[status]}\r\n{extra}Content-Length: {len(body) if length is None else length}"
+            f"\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + body)
+        if not keep_alive:
+            self.transport.close()
+        return keep_alive
+
+
+async def serve(path, host, port, status, reload_interval, idle_timeout, reuse_port):
+    loop = asyncio.get_running_loop()
+    server = RedirectServer(path, status, idle_timeout)
+    listener = await loop.create_server(lambda: RedirectProtocol(server, loop), host, port, reuse_port=reuse_port,
+                                        backlog=4096)
+    loop.call_later(reload_interval, server.tick, loop, reload_interval)
+    print(f"[{os.getpid()}] Listening on {host}:{port}", flush=True)
+    async with listener:
+        await listener.serve_forever()
+
+
+def run(*args):  # the entry point of a worker process
+    try:
+        asyncio.run(serve(*args))
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the public redirects from a snapshot file.")
+    parser.add_argument('--snapshot', default='url_shortener.snapshot', help="the file written by snapshot.py")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1, help="processes sharing the port and the snapshot")
+    parser.add_argument('--status', type=int, choices=(301, 302, 307, 308), default=302,
+                        help="the redirect status code (REDIRECT_STATUS)")
+    parser.add_argument('--reload-interval', type=float, default=1.0,
+                        help="seconds between two checks whether the snapshot file was replaced")
+    parser.add_argument('--idle-timeout', type=float, default=15.0,
+                        help="seconds after which a silent keep-alive connection is closed")
+    args = parser.parse_args()
+
+    serve_args = (args.snapshot, args.host, args.port, args.status, args.reload_interval, args.idle_timeout,
+                  args.workers > 1)
+    if args.workers <= 1:
+        run(*serve_args)
+        return
+    workers = [multiprocessing.Process(target=run, args=serve_args, daemon=True) for _ in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        started = time.monotonic()
+        for worker in workers:
+            worker.join(timeout=max(0.0, 5 - (time.monotonic() - started)))
+
+
+if __name__ == '__main__':
+    main()
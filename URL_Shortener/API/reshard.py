@@ -0,0 +1,120 @@
+import argparse
+import logging
+import os
+import sqlite3  # for database operations, a database engine, a relational database management system
+import time
+from collections import defaultdict
+
+from migrations import migrate
+from storage import shard_of
+
+# Moves the links of a single-file url_shortener.db into shard files, for STORAGE_SHARDS > 1.
+# url_mappings rows are copied in URL_ID order, chunk by chunk, into the shard their short code hashes to (keeping
+# their URL_ID, so listing cursors stay meaningful), url_clicks rows follow their link, and the user -> shard index is
+# filled in the main file. The users and the allocator tables stay where they are. Stop the application first:
+#
+#   python reshard.py --db url_shortener.db --shards 4
+#
+# then set STORAGE_SHARDS = 4 and start it again. The short code filter snapshot is rebuilt on its own.
+
+MAPPING_COLUMNS = 'URL_ID, USER_ID, LONG_URL, SHORT_URL, CREATED_AT, LONG_URL_HASH, EXPIRES_AT'
+CLICK_COLUMNS = 'SHORT_URL, BUCKET, REFERRER, CLICKS'
+ALIAS_COLUMNS = 'SHORT_URL, TARGET, USER_ID'
+
+
+def connect(path):
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')  # only has an effect on the new shard files (see db.PRAGMAS)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    return conn
+
+
+def copy_rows(source, shards, table, columns, code_index, query, chunk_size):
+    # streams the rows of a source query into the shards, one transaction per shard and chunk. Returns the number of
+    # rows copied and the set of (USER_ID, shard) pairs seen when the rows carry a USER_ID.
+    placeholders = ', '.join('?' * len(columns.split(',')))
+    insert = f'INSERT INTO {table} ({columns}) VALUES ({placeholders})'
+    rows = source.execute(query)
+    copied = 0
+    while True:
+        chunk = rows.fetchmany(chunk_size)
+        if not chunk:
+            return copied
+        groups = defaultdict(list)
+        for row in chunk:
+            groups[shard_of(row[code_index], len(shards))].append(row)
+        for number, shard_rows in groups.items():
+            shards[number].executemany(insert, shard_rows)
+            shards[number].commit()
+        copied += len(chunk)
+        print(f"\r{table}: {copied} rows", end='', flush=True)
+
+
+def reshard(path, shard_count, shard_path, chunk_size=50000, keep_source=False):
+    paths = [shard_path.format(number) for number in range(shard_count)]
+    existing = [shard for shard in paths if os.path.exists(shard)]
+    if existing:
+        raise SystemExit(f"Shard files already exist, remove them first: {', '.join(existing)}")
+
+    started = time.perf_counter()
+    source = connect(path)
+    migrate(source)
+    shards = [connect(shard) for shard in paths]
+    for conn in shards:
+        migrate(conn)
+
+    mappings = copy_rows(source, shards, 'url_mappings', MAPPING_COLUMNS, 3,
+                         f'SELECT {MAPPING_COLUMNS} FROM url_mappings ORDER BY URL_ID', chunk_size)
+    print()
+    clicks = copy_rows(source, shards, 'url_clicks', CLICK_COLUMNS, 0,
+                       f'SELECT {CLICK_COLUMNS} FROM url_clicks', chunk_size)
+    print()
+    aliases = copy_rows(source, shards, 'url_aliases', ALIAS_COLUMNS, 0,
+                        f'SELECT {ALIAS_COLUMNS} FROM url_aliases', chunk_size)
+    print()
+
+    # every shard that received a link of a user, worked out by SQLite from the shard files themselves
+    for number, conn in enumerate(shards):
+        users = conn.execute('SELECT DISTINCT USER_ID FROM url_mappings').fetchall()
+        source.executemany('INSERT OR IGNORE INTO user_shards (USER_ID, SHARD) VALUES (?, ?)',
+                           ((user_id, number) for user_id, in users))
+    source.commit()
+
+    if not keep_source:
+        # the application refuses to start sharded while the main file still holds links
+        source.execute('DELETE FROM url_clicks')
+        source.execute('DELETE FROM url_aliases')
+        source.execute('DELETE FROM url_mappings')
+        source.execute('DELETE FROM mapping_deletions')  # filled by the delete above, the snapshot is rebuilt anyway
+        source.commit()
+
+    for conn in shards:
+        conn.execute('ANALYZE')
+        conn.close()
+    source.close()
+
+    print(f"Moved {mappings} links, {aliases} aliases and {clicks} click counters into {shard_count} shards in "
+          f"{time.perf_counter() - started:.1f}s, now start the application with STORAGE_SHARDS = {shard_count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move the links of a single-file database into shard files.")
+    parser.add_argument('--db', default='url_shortener.db', help="the single-file database to reshard")
+    parser.add_argument('--shards', type=int, required=True, help="number of shard files to create")
+    parser.add_argument('--shard-path', default='url_shortener.shard{}.db',
+                        help="the shard file names, {} is replaced by the shard number (STORAGE_SHARD_PATH)")
+    parser.add_argument('--chunk-size', type=int, default=50000, help="rows copied per transaction")
+    parser.add_argument('--keep-source', action='store_true',
+                        help="leave the links in the main file as well (it then has to be emptied by hand)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')  # shows the migration notes
+
+    if args.shards < 2:
+        parser.error("--shards must be at least 2, a single shard is the plain url_shortener.db")
+
+    reshard(args.db, args.shards, args.shard_path, args.chunk_size, args.keep_source)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import re
+
+SHORT_URL_PREFIX = 'https://short-url/'  # the prefix shown to users in front of every short code
+# Only the bare code is stored in url_mappings.SHORT_URL, the prefix is added back when a link is displayed.
+
+CODE_PATTERN = re.compile(r'[0-9A-Za-z_-]{1,64}')  # the custom short codes accepted from users and imports
+# the first path segment of every route of the application (see app.py): a code equal to one of them would be
+# shadowed by the route instead of reaching GET /<code>
+RESERVED_CODES = frozenset({
+    'api', 'cache-stats', 'delete-url', 'export-urls', 'filter-stats', 'generate-qr-code', 'list-urls', 'logout',
+    'metrics', 'qr', 'redirect', 'shorten-url', 'signin', 'signup', 'signup-success', 'static', 'stats', 'test-url',
+    'urlshortener',
+})
+
+
+def normalize_short_code(value):  # turns whatever the user typed into the bare code stored in the database
+    # accepts the full 'https://short-url/XXXXXX' form (with or without the scheme) as well as the bare code
+    if value is None:
+        return None
+    value = value.strip()
+    for prefix in (SHORT_URL_PREFIX, 'http://short-url/', 'short-url/'):
+        if value.startswith(prefix):
+            return value[len(prefix):]
+    return value
+
+
+def format_short_url(short_code):  # builds the full short URL displayed to the user from a stored code
+    return f'{SHORT_URL_PREFIX}{short_code}'
+
+
+def short_code_error(short_code):  # why a custom short code cannot be used, None when it can
+    if len(short_code) > 64:
+        return "short code is longer than 64 characters"
+    if not CODE_PATTERN.fullmatch(short_code):
+        return f"short code {short_code!r} may only contain letters, digits, '-' and '_'"
+    if short_code in RESERVED_CODES:
+        return f"short code {short_code!r} is reserved"
+    return None
@@ -0,0 +1,142 @@
+import argparse
+import hashlib
+import heapq
+import logging
+import os
+import time
+from array import array
+
+from db import ConnectionPool
+from snapshot_file import ALIAS, HEADER, MAGIC, MARK, open_snapshot, pack_entry
+from storage import make_storage
+
+# A read-only snapshot of every live link (short code -> long URL) for redirect_server.py.
+# The file is a header, the links sorted by code and an index of their offsets at the end, its format and the reader
+# live in snapshot_file.py. This module writes and updates the file and is the only one that needs the database.
+#
+# A rebuild only reads what changed since the marks in the current file: the rows above its URL_ID mark of every
+# shard, and the codes the mapping_deletions log (filled by a trigger, see migrations.py) recorded above its deletion
+# mark. Those are merged with the links of the current file into a new one, which then replaces it with os.replace(),
+# an atomic rename: a reader has either the old file or the new one mapped, never half of one. Aliases are read in full
+# every time, there are few of them. Links are left out once they expire, and readers check the expiry time too.
+# When nothing changed the file is left alone, and the links of the current file are copied over as they are.
+#
+#   python snapshot.py --db url_shortener.db --out url_shortener.snapshot --interval 5
+
+DELETION_RETENTION = 7 * 24 * 3600  # seconds the deletion log is kept, an older snapshot is rebuilt in full
+
+
+def write_snapshot(path, entries, marks, built_at, alias_digest=0):
+    # writes packed links, already sorted by code, to a new file that replaces path, returns how many were written
+    temporary = f'{path}.{os.getpid()}.tmp'
+    offsets = array('Q')
+    with open(temporary, 'wb') as f:
+        f.write(b'\0' * (HEADER.size + len(marks) * MARK.size))  # the header is written last, once the count is known
+        position = f.tell()
+        for entry in entries:
+            offsets.append(position)
+            f.write(entry)
+            position += len(entry)
+        offsets.tofile(f)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(offsets), position, built_at, alias_digest, len(marks)))
+        for mark in marks:
+            f.write(MARK.pack(*mark))
+        f.flush()
+        os.fsync(f.fileno())  # the rename must not become visible before the data
+    os.replace(temporary, path)
+    return len(offsets)
+
+
+def build(storage, path, full=False, now=None, retention=DELETION_RETENTION):
+    # brings the snapshot at path up to date, returns (links in the file, whether it was rebuilt in full)
+    now = int(time.time()) if now is None else now
+    current = None if full else open_snapshot(path)
+    # the URL_ID marks are read first: a link inserted between the two reads is picked up by the next build, a link
+    # deleted in between shows up in the deletion log above the deletion mark read here, or in the next one
+    url_marks = storage.high_water_marks()
+    deletion_marks = storage.deletion_marks()
+    if current is not None and (len(current.marks) != len(url_marks) or current.built_at < now - retention or
+                                any(mark < old for mark, (old, _) in zip(url_marks, current.marks))):
+        # resharded, older than the deletion log reaches back, or a shard file that was replaced
+        current.close()
+        current = None
+
+    marks = list(zip(url_marks, deletion_marks))
+    aliases = list(storage.alias_links())
+    alias_digest = int.from_bytes(hashlib.blake2b(repr(aliases).encode('utf-8'), digest_size=8).digest(), 'big')
+    if current is not None and marks == current.marks and alias_digest == current.alias_digest:
+        current.close()
+        storage.trim_deletions(now - retention)
+        return current.count, False  # nothing changed, the readers keep the file they have mapped
+
+    previous = current.marks if current is not None else [(0, 0)] * len(url_marks)
+    deleted = set()
+    if current is not None:
+        for shard, (_, after) in enumerate(previous):
+            deleted |= {code.encode('utf-8') for code in storage.deleted_codes(shard, after, deletion_marks[shard])}
+
+    def packed(links, priority, flags=0):  # (code, priority, expiry time, packed link) of new links
+        for code, long_url, expires_at in links:
+            code = code.encode('utf-8')
+            yield code, priority, expires_at, pack_entry(code, long_url.encode('utf-8'), expires_at, flags)
+
+    # every source is sorted by code and tagged with its priority: when a code shows up twice (deleted and created
+    # again, or merged into an alias since the marks were read) the newest source wins
+    sources = [packed(heapq.merge(*(storage.scan_links(shard, after, url_marks[shard])
+                                    for shard, (after, _) in enumerate(previous))), 0),
+               packed(aliases, 1, ALIAS)]
+    if current is not None:
+        # the links kept from the current file are copied as they are, without decoding them
+        sources.append((code, 2, expires_at, entry) for code, expires_at, flags, entry in current.entries()
+                       if not flags & ALIAS and code not in deleted)
+
+    def entries():
+        last = None
+        for code, _, expires_at, entry in heapq.merge(*sources):
+            if code == last or (expires_at and expires_at <= now):
+                continue
+            last = code
+            yield entry
+
+    try:
+        written = write_snapshot(path, entries(), marks, now, alias_digest)
+    finally:
+        if current is not None:
+            current.close()
+    storage.trim_deletions(now - retention)
+    return written, current is None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the live links to a snapshot file for redirect_server.py.")
+    parser.add_argument('--db', default='url_shortener.db', help="the main database file (DATABASE)")
+    parser.add_argument('--shards', type=int, default=1, help="number of shard files (STORAGE_SHARDS)")
+    parser.add_argument('--shard-path', default='url_shortener.shard{}.db',
+                        help="the shard file names, {} is replaced by the shard number (STORAGE_SHARD_PATH)")
+    parser.add_argument('--out', default='url_shortener.snapshot', help="the snapshot file to write")
+    parser.add_argument('--full', action='store_true', help="rebuild from scratch instead of applying the changes")
+    parser.add_argument('--interval', type=float, default=0,
+                        help="keep running and update the snapshot every that many seconds, 0 updates it once")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')  # shows the migration notes
+
+    storage = make_storage(ConnectionPool(args.db), shard_count=args.shards, shard_path=args.shard_path)
+    storage.migrate()
+    try:
+        full = args.full
+        while True:
+            started = time.perf_counter()
+            written, rebuilt = build(storage, args.out, full)
+            print(f"{'Rebuilt' if rebuilt else 'Updated'} {args.out} with {written} links in "
+                  f"{time.perf_counter() - started:.2f}s", flush=True)
+            if not args.interval:
+                break
+            full = False
+            time.sleep(args.interval)
+    finally:
+        storage.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import mmap
+import os
+import struct
+import time
+
+# The snapshot file format and its reader, see snapshot.py for how the file is built and kept up to date.
+# This module only needs the standard library, so redirect_server.py can map a snapshot without pulling in the
+# database, storage or metrics modules (or Flask through them).
+#
+#   header   magic, link count, index offset, build time, alias digest, shard count, then (URL_ID, deletion SEQ)
+#            marks per shard
+#   links    expiry time (0 for never), flags, code length, URL length, the code, the URL, one after the other
+#   index    the offset of every link, in code order, so a lookup is a binary search over the mapped file
+#
+# Readers map the file with mmap instead of loading it, so every server process on a host shares the one copy in
+# the page cache and opening a new file costs nothing up front. The numbers are written in the byte order of the
+# host, build the snapshot on the host that serves it.
+
+MAGIC = b'URLSNAP1'
+HEADER = struct.Struct('=8sQQqQI')  # magic, link count, index offset, build time, alias digest, shard count
+MARK = struct.Struct('=qq')  # per shard: highest URL_ID and highest mapping_deletions.SEQ included
+ENTRY = struct.Struct('=qBHI')  # expiry time, flags, code length, URL length
+ALIAS = 1  # flag of a link that is an alias, aliases are replaced on every rebuild
+
+
+class Snapshot:  # a snapshot file mapped into memory
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.stat = os.fstat(f.fileno())  # tells readers whether the file on disk has been replaced since
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self._index, self.built_at, self.alias_digest, shard_count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a link snapshot")
+        self.marks = [MARK.unpack_from(self._map, HEADER.size + number * MARK.size) for number in range(shard_count)]
+        self._data = HEADER.size + shard_count * MARK.size
+        # the offsets as a view into the mapped file, reading one does not copy the index
+        self._offsets = memoryview(self._map)[self._index:self._index + self.count * 8].cast('Q')
+
+    def _entry(self, offset):  # returns (expiry time, flags, code, URL offset, URL length) of the link at offset
+        expires_at, flags, code_length, url_length = ENTRY.unpack_from(self._map, offset)
+        start = offset + ENTRY.size
+        return expires_at, flags, self._map[start:start + code_length], start + code_length, url_length
+
+    def get(self, short_code, now=None):  # returns (long URL, expiry time or None) of a live link, or None
+        key = short_code.encode('utf-8')  # UTF-8 bytes sort like the code points they encode
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            expires_at, _, code, url_offset, url_length = self._entry(self._offsets[middle])
+            if code < key:
+                low = middle + 1
+            elif code > key:
+                high = middle
+            else:
+                if expires_at and expires_at <= (time.time() if now is None else now):
+                    return None  # expired since the snapshot was built
+                return self._map[url_offset:url_offset + url_length].decode('utf-8'), expires_at or None
+        return None
+
+    def entries(self):  # yields (code, expiry time, flags, the packed link) of every link in code order, as bytes
+        offset = self._data
+        while offset < self._index:
+            expires_at, flags, code, url_offset, url_length = self._entry(offset)
+            end = url_offset + url_length
+            yield code, expires_at, flags, self._map[offset:end]
+            offset = end
+
+    def __iter__(self):  # yields (code, long URL, expiry time or None, flags) of every link in code order
+        for code, expires_at, flags, entry in self.entries():
+            yield code.decode('utf-8'), entry[ENTRY.size + len(code):].decode('utf-8'), expires_at or None, flags
+
+    def close(self):
+        self._offsets.release()  # the map cannot be closed while a view into it exists
+        self._map.close()
+
+
+def open_snapshot(path):  # the snapshot at path, or None when there is none or it cannot be read
+    try:
+        return Snapshot(path)
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def pack_entry(code, long_url, expires_at, flags=0):  # a link as it is stored in the file, code and URL as bytes
+    return ENTRY.pack(expires_at or 0, flags, len(code), len(long_url)) + code + long_url
@@ -0,0 +1,677 @@
+import heapq
+import logging
+import sqlite3  # for database operations, a database engine, a relational database management system
+import threading
+import time
+import zlib  # crc32, a fast hash that is the same in every process and Python version
+from collections import defaultdict
+from contextlib import ExitStack
+
+from db import ConnectionPool, PRAGMAS
+from long_urls import long_url_hash, normalize_long_url
+from migrations import migrate, schema_version
+
+# Storage backends.
+# Every query the application runs against users, url_mappings and url_clicks lives behind the Storage interface, so
+# the routes do not care whether the data sits in one file or in several.
+#
+# SQLiteStorage keeps everything in a single database file. ShardedSQLiteStorage keeps users, the allocator tables and
+# a user -> shard index in the main file and spreads url_mappings (together with their url_clicks) over N shard files
+# by a hash of the short code. Each file has its own write lock, so links created at the same time usually land in
+# different files and do not queue behind each other. A short code always maps to the same shard, which keeps the
+# unique index of each shard enough to make codes unique everywhere.
+
+logger = logging.getLogger(__name__)
+
+QUERY_CHUNK = 500  # how many codes are checked per "IN (...)" query, well below SQLite's bound parameter limit
+MAX_INDEXED_USERS = 1000000  # (user, shard) pairs remembered as already indexed before the memory is cleared
+MAX_ALIAS_HOPS = 8  # how many aliases of aliases are followed before a code is treated as unknown
+
+# the users a link refers to live in the main file, a shard's own (empty) users table cannot back a foreign key
+SHARD_PRAGMAS = tuple((name, 'OFF' if name == 'foreign_keys' else value) for name, value in PRAGMAS)
+
+INSERT_MAPPING = (
+    "INSERT INTO url_mappings (USER_ID, LONG_URL, SHORT_URL, CREATED_AT, EXPIRES_AT, LONG_URL_HASH) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
+# a link that has expired is gone for every reader, even before the purge has deleted its row
+LIVE = "(EXPIRES_AT IS NULL OR EXPIRES_AT > ?)"
+
+# URL_ID >= ? rather than > ?, list_page() works out per shard where the previous page stopped
+PAGE_QUERY = (
+    "SELECT URL_ID, SHORT_URL, LONG_URL, CREATED_AT, EXPIRES_AT FROM url_mappings "
+    f"WHERE USER_ID = ? AND URL_ID >= ? AND {LIVE} ORDER BY URL_ID LIMIT ?"
+)
+
+UPSERT_CLICKS = (
+    "INSERT INTO url_clicks (SHORT_URL, BUCKET, REFERRER, CLICKS) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT (SHORT_URL, BUCKET, REFERRER) DO UPDATE SET CLICKS = CLICKS + excluded.CLICKS"
+)
+
+
+def shard_of(short_code, shard_count):  # the shard holding a short code, stable across processes and restarts
+    if shard_count == 1:
+        return 0
+    return zlib.crc32(short_code.encode('utf-8')) % shard_count
+
+
+class Storage:  # the interface every storage backend implements
+    shard_count = 1  # how many files url_mappings is spread over, shard numbers run from 0 to shard_count - 1
+
+    # schema and allocator tables
+    def migrate(self):  # brings every database file up to date, run once at startup
+        raise NotImplementedError
+
+    def schema_version(self):
+        raise NotImplementedError
+
+    def meta_connection(self):  # a "with" block yielding a connection to the code_sequences and code_pool tables
+        raise NotImplementedError
+
+    # users
+    def find_user(self, email):  # returns (ID, PASSWORD) or None
+        raise NotImplementedError
+
+    def create_user(self, name, email, password_hash):  # returns the new user's ID
+        raise NotImplementedError
+
+    def update_password(self, user_id, password_hash):
+        raise NotImplementedError
+
+    def create_token(self, user_id, token_hash, name, created_at):  # stores an API token (see api.py)
+        raise NotImplementedError
+
+    def find_token(self, token_hash):  # returns the USER_ID of an API token, or None
+        raise NotImplementedError
+
+    def delete_token(self, token_hash):  # True if there was such a token
+        raise NotImplementedError
+
+    # links
+    def insert_mapping(self, user_id, long_url, short_code, created_at, expires_at=None):
+        # sqlite3.IntegrityError if the code is taken. expires_at is a unix time, None for a link that never expires.
+        raise NotImplementedError
+
+    def insert_mappings(self, rows):  # inserts (USER_ID, LONG_URL, SHORT_URL, CREATED_AT, EXPIRES_AT) rows, all or none
+        raise NotImplementedError
+
+    def existing_short_codes(self, codes):  # the subset of codes that are already used, by a link or an alias
+        raise NotImplementedError
+
+    def find_short_codes(self, long_urls, user_id=None):
+        # long URL -> the oldest short code of an equal (normalized) long URL, of the user or of anyone when user_id
+        # is None. Only links that never expire are reused, URLs without such a link are left out.
+        raise NotImplementedError
+
+    def get_link(self, short_code, user_id=None):
+        # returns (LONG_URL, EXPIRES_AT), None when the code does not exist, has expired (or is not the user's). With a
+        # user_id, codes of merged duplicates and codes renamed by migration 3 resolve for their owner too.
+        raise NotImplementedError
+
+    def get_long_url(self, short_code, user_id=None):  # the LONG_URL of get_link(), or None
+        link = self.get_link(short_code, user_id)
+        return link[0] if link else None
+
+    def delete_mapping(self, user_id, short_code):
+        # deletes a user's link and its clicks, or the user's alias of that code, True if there was either
+        raise NotImplementedError
+
+    def list_page(self, user_id, cursor=None, limit=100):
+        # returns ([(URL_ID, SHORT_URL, LONG_URL, CREATED_AT, EXPIRES_AT), ...], next_cursor) of the links that have not
+        # expired, next_cursor is None on the last page
+        raise NotImplementedError
+
+    # expiry
+    def purge_expired(self, now, limit=500):
+        # deletes up to limit links of every shard that expired at or before now (with their clicks), one short
+        # transaction per shard. Returns the deleted short codes.
+        raise NotImplementedError
+
+    def incremental_vacuum(self, pages):  # hands up to pages free pages per file back, returns how many were freed
+        raise NotImplementedError
+
+    # duplicate compaction
+    def scan_long_urls(self):
+        # yields (LONG_URL_HASH, USER_ID, URL_ID, shard, SHORT_URL, LONG_URL, CREATED_AT) for every link that never
+        # expires, in that order
+        raise NotImplementedError
+
+    def merge_mapping(self, short_code, target_code):
+        # turns a link into an alias of another link, its clicks move over. False if the link does not exist.
+        raise NotImplementedError
+
+    # the short code filter
+    def high_water_marks(self):  # the highest URL_ID of every shard
+        raise NotImplementedError
+
+    def count_mappings(self):
+        raise NotImplementedError
+
+    def scan_codes(self, after):  # yields (shard, URL_ID, SHORT_URL) for every row above after[shard], in order
+        raise NotImplementedError
+
+    def alias_codes(self):  # yields every short code that is an alias
+        raise NotImplementedError
+
+    # the redirect snapshot (see snapshot.py)
+    def deletion_marks(self):  # the highest mapping_deletions.SEQ of every shard
+        raise NotImplementedError
+
+    def scan_links(self, shard, after, upto):
+        # yields (SHORT_URL, LONG_URL, EXPIRES_AT) of the shard's rows with after < URL_ID <= upto, by SHORT_URL
+        raise NotImplementedError
+
+    def deleted_codes(self, shard, after, upto):  # the set of codes deleted from the shard with after < SEQ <= upto
+        raise NotImplementedError
+
+    def alias_links(self):  # yields (alias code, LONG_URL, EXPIRES_AT) of the link every alias resolves to, by code
+        raise NotImplementedError
+
+    def trim_deletions(self, before):  # forgets the deletions logged before that unix time, returns how many
+        raise NotImplementedError
+
+    # clicks
+    def record_clicks(self, rows):  # adds (SHORT_URL, BUCKET, REFERRER, CLICKS) rows, returns the rows not written
+        raise NotImplementedError
+
+    def link_clicks(self, short_code):  # returns (total, [(BUCKET, CLICKS)], [(REFERRER, CLICKS)] top 20)
+        raise NotImplementedError
+
+    def user_clicks(self, user_id):  # returns [(SHORT_URL, total clicks)] of every link of the user, most clicked first
+        raise NotImplementedError
+
+    def most_clicked(self, since, limit):  # returns [(SHORT_URL, clicks)] of the links clicked most since a unix time
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+
+class SQLiteStorage(Storage):  # everything in one database file, the default
+    def __init__(self, pool, shards=None):
+        self.pool = pool  # users, the allocator tables and the user -> shard index
+        self.shards = shards or [pool]  # the pools holding url_mappings and url_clicks, index = shard number
+        self.shard_count = len(self.shards)
+
+    def _pools(self):  # every distinct pool, the main one first
+        return [self.pool] + [shard for shard in self.shards if shard is not self.pool]
+
+    def _shard(self, short_code):
+        return shard_of(short_code, self.shard_count)
+
+    def _group(self, items, code_of=lambda item: item):  # shard number -> the items whose code lives there
+        groups = defaultdict(list)
+        for item in items:
+            groups[self._shard(code_of(item))].append(item)
+        return groups
+
+    def _user_shards(self, user_id):  # the shards that may hold links of the user
+        return range(self.shard_count)
+
+    def _index_users(self, pairs):  # records (USER_ID, shard) pairs in the user -> shard index
+        pass  # a single file needs no index
+
+    def migrate(self):
+        for pool in self._pools():
+            with pool.connection() as conn:
+                migrate(conn)
+
+    def schema_version(self):
+        with self.pool.connection() as conn:
+            return schema_version(conn)
+
+    def meta_connection(self):
+        return self.pool.connection()
+
+    def find_user(self, email):
+        with self.pool.connection() as conn:
+            return conn.execute("SELECT ID, PASSWORD FROM users WHERE EMAIL = ?", (email,)).fetchone()
+
+    def create_user(self, name, email, password_hash):
+        with self.pool.connection() as conn:
+            cursor = conn.execute("INSERT INTO users (NAME, EMAIL, PASSWORD) VALUES (?, ?, ?)",
+                                  (name, email, password_hash))
+            conn.commit()
+            return cursor.lastrowid
+
+    def update_password(self, user_id, password_hash):
+        with self.pool.connection() as conn:
+            conn.execute("UPDATE users SET PASSWORD = ? WHERE ID = ?", (password_hash, user_id))
+            conn.commit()
+
+    def create_token(self, user_id, token_hash, name, created_at):
+        with self.pool.connection() as conn:
+            conn.execute("INSERT INTO api_tokens (TOKEN_HASH, USER_ID, NAME, CREATED_AT) VALUES (?, ?, ?, ?)",
+                         (token_hash, user_id, name, created_at))
+            conn.commit()
+
+    def find_token(self, token_hash):
+        with self.pool.connection() as conn:
+            row = conn.execute("SELECT USER_ID FROM api_tokens WHERE TOKEN_HASH = ?", (token_hash,)).fetchone()
+        return row[0] if row else None
+
+    def delete_token(self, token_hash):
+        with self.pool.connection() as conn:
+            deleted = conn.execute("DELETE FROM api_tokens WHERE TOKEN_HASH = ?", (token_hash,)).rowcount
+            conn.commit()
+        return bool(deleted)
+
+    def insert_mapping(self, user_id, long_url, short_code, created_at, expires_at=None):
+        shard = self._shard(short_code)
+        # the index is written first: a crash in between leaves a shard without links in the index, never a link
+        # that the listing cannot find
+        self._index_users({(user_id, shard)})
+        with self.shards[shard].connection() as conn:
+            try:
+                # a merged duplicate's code keeps resolving through url_aliases, it is never handed out again
+                if conn.execute("SELECT 1 FROM url_aliases WHERE SHORT_URL = ?", (short_code,)).fetchone():
+                    raise sqlite3.IntegrityError(f"short code {short_code!r} is an alias")
+                conn.execute(INSERT_MAPPING,
+                             (user_id, long_url, short_code, created_at, expires_at, long_url_hash(long_url)))
+                conn.commit()
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                raise
+
+    def insert_mappings(self, rows):
+        groups = self._group(rows, lambda row: row[2])
+        self._index_users({(row[0], shard) for shard, shard_rows in groups.items() for row in shard_rows})
+        with ExitStack() as stack:
+            # every shard gets its own transaction. The shards are written in a fixed order so two batches never wait
+            # for each other's locks, and nothing is committed until every insert went through.
+            writes = [(stack.enter_context(self.shards[shard].connection()), shard_rows)
+                      for shard, shard_rows in sorted(groups.items())]
+            try:
+                for conn, shard_rows in writes:
+                    conn.executemany(INSERT_MAPPING, ((*row, long_url_hash(row[1])) for row in shard_rows))
+            except sqlite3.IntegrityError:
+                for conn, _ in writes:
+                    conn.rollback()
+                raise
+            for conn, _ in writes:
+                conn.commit()
+
+    def existing_short_codes(self, codes):
+        taken = set()
+        for shard, shard_codes in self._group(codes).items():
+            with self.shards[shard].connection() as conn:
+                for start in range(0, len(shard_codes), QUERY_CHUNK):
+                    chunk = shard_codes[start:start + QUERY_CHUNK]
+                    placeholders = ', '.join('?' * len(chunk))
+                    rows = conn.execute(
+                        f"SELECT SHORT_URL FROM url_mappings WHERE SHORT_URL IN ({placeholders}) "
+                        f"UNION ALL SELECT SHORT_URL FROM url_aliases WHERE SHORT_URL IN ({placeholders})",
+                        chunk + chunk)
+                    taken.update(row[0] for row in rows)
+        return taken
+
+    def find_short_codes(self, long_urls, user_id=None):
+        wanted = defaultdict(dict)  # LONG_URL_HASH -> {long URL: its normalized form}
+        for long_url in long_urls:
+            wanted[long_url_hash(long_url)][long_url] = normalize_long_url(long_url)
+        hashes = list(wanted)
+        found = {}  # long URL -> ((CREATED_AT, URL_ID, shard), SHORT_URL) of the oldest match so far
+        for shard in (self._user_shards(user_id) if user_id is not None else range(self.shard_count)):
+            with self.shards[shard].connection() as conn:
+                for start in range(0, len(hashes), QUERY_CHUNK):
+                    chunk = hashes[start:start + QUERY_CHUNK]
+                    placeholders = ', '.join('?' * len(chunk))
+                    # served by idx_url_mappings_long_url_hash
+                    # a link that expires is never handed to somebody asking for a permanent one
+                    query = ("SELECT LONG_URL_HASH, LONG_URL, SHORT_URL, CREATED_AT, URL_ID FROM url_mappings "
+                             f"WHERE LONG_URL_HASH IN ({placeholders}) AND EXPIRES_AT IS NULL")
+                    if user_id is not None:
+                        query += " AND USER_ID = ?"
+                        chunk = chunk + [user_id]
+                    for hashed, long_url, short_code, created_at, url_id in conn.execute(query, chunk):
+                        normalized = normalize_long_url(long_url)
+                        age = (created_at or 0, url_id, shard)  # the same link compact_urls.py keeps
+                        for url, url_normalized in wanted[hashed].items():
+                            # the normalized URLs are compared, equal hashes alone could be a collision
+                            if url_normalized == normalized and (url not in found or age < found[url][0]):
+                                found[url] = age, short_code
+        return {url: short_code for url, (_, short_code) in found.items()}
+
+    def _alias_rows(self, codes):  # alias code -> (TARGET, USER_ID) for those codes that are aliases
+        rows = {}
+        for shard, shard_codes in self._group(codes).items():
+            with self.shards[shard].connection() as conn:
+                for start in range(0, len(shard_codes), QUERY_CHUNK):
+                    chunk = shard_codes[start:start + QUERY_CHUNK]
+                    placeholders = ', '.join('?' * len(chunk))
+                    for short_code, target, user_id in conn.execute(
+                            f"SELECT SHORT_URL, TARGET, USER_ID FROM url_aliases WHERE SHORT_URL IN ({placeholders})",
+                            chunk):
+                        rows[short_code] = target, user_id
+        return rows
+
+    def _resolve_aliases(self, codes):  # alias code -> the link it finally points to, for those codes that are aliases
+        codes = set(codes)
+        resolved = {}
+        frontier = codes
+        for _ in range(MAX_ALIAS_HOPS):
+            targets = {code: target for code, (target, _) in self._alias_rows(frontier).items()}
+            if not targets:
+                break
+            for code in codes:  # a merged link can itself be merged later, follow the chain
+                now = resolved.get(code, code)
+                if now in targets:
+                    resolved[code] = targets[now]
+            frontier = set(targets.values())
+        return resolved
+
+    def _mapping(self, short_code, user_id=None):  # (LONG_URL, EXPIRES_AT) of a link that has not expired
+        now = int(time.time())
+        with self.shards[self._shard(short_code)].connection() as conn:
+            if user_id is None:
+                return conn.execute(f"SELECT LONG_URL, EXPIRES_AT FROM url_mappings WHERE SHORT_URL = ? AND {LIVE}",
+                                    (short_code, now)).fetchone()
+            return conn.execute(f"SELECT LONG_URL, EXPIRES_AT FROM url_mappings WHERE USER_ID = ? AND SHORT_URL = ? "
+                                f"AND {LIVE}", (user_id, short_code, now)).fetchone()
+
+    def _renamed_code(self, short_code, user_id):
+        # the code migration 3 gave the user's link when several users shared short_code, None if it was not renamed
+        with self.pool.connection() as conn:  # renames only happened in the main file, before any sharding
+            row = conn.execute("SELECT NEW_CODE FROM short_code_renames WHERE OLD_CODE = ? AND USER_ID = ?",
+                               (short_code, user_id)).fetchone()
+        return row[0] if row else None
+
+    def get_link(self, short_code, user_id=None):
+        link = self._mapping(short_code, user_id)
+        if link is not None:
+            return link
+        alias = self._alias_rows([short_code]).get(short_code)  # a merged duplicate still resolves
+        if alias is None or (user_id is not None and alias[1] != user_id):
+            renamed = self._renamed_code(short_code, user_id) if user_id is not None else None
+            return self._mapping(renamed, user_id) if renamed else None
+        target = alias[0]
+        return self._mapping(self._resolve_aliases([target]).get(target, target))
+
+    def delete_mapping(self, user_id, short_code):
+        with self.shards[self._shard(short_code)].connection() as conn:
+            deleted = conn.execute("DELETE FROM url_mappings WHERE USER_ID = ? AND SHORT_URL = ?",
+                                   (user_id, short_code)).rowcount
+            if deleted:
+                # the code may be picked again later, its click history goes with the link
+                conn.execute("DELETE FROM url_clicks WHERE SHORT_URL = ?", (short_code,))
+            else:
+                # a merged duplicate resolves for its owner through url_aliases, deleting it removes the alias (its
+                # clicks were moved to the link it points to)
+                deleted = conn.execute("DELETE FROM url_aliases WHERE USER_ID = ? AND SHORT_URL = ?",
+                                       (user_id, short_code)).rowcount
+            conn.commit()
+        return bool(deleted)
+
+    def _encode_cursor(self, url_id, shard):  # a plain URL_ID for a single file, '<URL_ID>.<shard>' otherwise
+        return url_id if self.shard_count == 1 else f'{url_id}.{shard}'
+
+    def _decode_cursor(self, cursor):  # returns (URL_ID, shard) of the last row of the previous page
+        if cursor in (None, ''):
+            return 0, -1
+        url_id, _, shard = str(cursor).partition('.')
+        try:
+            return int(url_id), int(shard) if shard else self.shard_count - 1
+        except ValueError:
+            return 0, -1  # an unreadable cursor starts over from the first page
+
+    def list_page(self, user_id, cursor=None, limit=100):
+        # URL_IDs are only unique within a shard, pages are ordered by (URL_ID, shard). Each shard is asked for one row
+        # more than a page, starting right after the cursor, and the merged result is cut to the page.
+        after_id, after_shard = self._decode_cursor(cursor)
+        now = int(time.time())
+        records = []
+        for shard in self._user_shards(user_id):
+            first_id = after_id if shard > after_shard else after_id + 1
+            with self.shards[shard].connection() as conn:
+                rows = conn.execute(PAGE_QUERY, (user_id, first_id, now, limit + 1)).fetchall()
+            records.extend((url_id, shard, *rest) for url_id, *rest in rows)
+
+        records.sort()
+        page = records[:limit]
+        next_cursor = self._encode_cursor(page[-1][0], page[-1][1]) if len(records) > limit else None
+        return [(url_id, *rest) for url_id, _, *rest in page], next_cursor
+
+    def purge_expired(self, now, limit=500):
+        purged = []
+        for shard in self.shards:
+            with shard.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')  # the write lock is held for one batch only
+                try:
+                    # served by the partial index idx_url_mappings_expires_at
+                    codes = [code for code, in conn.execute(
+                        "SELECT SHORT_URL FROM url_mappings WHERE EXPIRES_AT <= ? ORDER BY EXPIRES_AT LIMIT ?",
+                        (now, min(limit, QUERY_CHUNK)))]
+                    if codes:
+                        placeholders = ', '.join('?' * len(codes))
+                        conn.execute(f"DELETE FROM url_clicks WHERE SHORT_URL IN ({placeholders})", codes)
+                        conn.execute(f"DELETE FROM url_mappings WHERE SHORT_URL IN ({placeholders})", codes)
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    raise
+            purged.extend(codes)
+        return purged
+
+    def incremental_vacuum(self, pages):
+        freed = 0
+        for pool in self._pools():
+            with pool.connection() as conn:
+                if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:  # 2 is INCREMENTAL
+                    continue
+                before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                # the pragma frees one page per step and returns no rows, so execute() would stop after the first
+                # page. executescript() steps it to the end and commits.
+                conn.executescript(f'PRAGMA incremental_vacuum({int(pages)})')
+                freed += before - conn.execute('PRAGMA freelist_count').fetchone()[0]
+        return freed
+
+    def high_water_marks(self):
+        marks = []
+        for shard in self.shards:
+            with shard.connection() as conn:
+                marks.append(conn.execute('SELECT COALESCE(MAX(URL_ID), 0) FROM url_mappings').fetchone()[0])
+        return marks
+
+    def count_mappings(self):
+        total = 0
+        for shard in self.shards:
+            with shard.connection() as conn:
+                total += conn.execute('SELECT COUNT(*) FROM url_mappings').fetchone()[0]
+        return total
+
+    def scan_codes(self, after):
+        for number, shard in enumerate(self.shards):
+            with shard.connection() as conn:
+                rows = conn.execute('SELECT URL_ID, SHORT_URL FROM url_mappings WHERE URL_ID > ? ORDER BY URL_ID',
+                                    (after[number],))
+                for url_id, short_code in rows:
+                    yield number, url_id, short_code
+
+    def alias_codes(self):
+        for shard in self.shards:
+            with shard.connection() as conn:
+                for short_code, in conn.execute('SELECT SHORT_URL FROM url_aliases'):
+                    yield short_code
+
+    def deletion_marks(self):
+        marks = []
+        for shard in self.shards:
+            with shard.connection() as conn:
+                marks.append(conn.execute('SELECT COALESCE(MAX(SEQ), 0) FROM mapping_deletions').fetchone()[0])
+        return marks
+
+    def scan_links(self, shard, after, upto):
+        with self.shards[shard].connection() as conn:
+            yield from conn.execute('SELECT SHORT_URL, LONG_URL, EXPIRES_AT FROM url_mappings '
+                                    'WHERE URL_ID > ? AND URL_ID <= ? ORDER BY SHORT_URL', (after, upto))
+
+    def deleted_codes(self, shard, after, upto):
+        with self.shards[shard].connection() as conn:
+            return {code for code, in conn.execute(
+                'SELECT SHORT_URL FROM mapping_deletions WHERE SEQ > ? AND SEQ <= ?', (after, upto))}
+
+    def alias_links(self):
+        targets = {}  # alias code -> the code it points to
+        for shard in self.shards:
+            with shard.connection() as conn:
+                targets.update(conn.execute('SELECT SHORT_URL, TARGET FROM url_aliases'))
+        final = {}
+        for code, target in targets.items():
+            for _ in range(MAX_ALIAS_HOPS):  # the same chains get_link() follows, resolved in memory
+                if target not in targets:
+                    final[code] = target
+                    break
+                target = targets[target]
+        links = {}
+        for shard, codes in self._group(set(final.values())).items():
+            with self.shards[shard].connection() as conn:
+                for start in range(0, len(codes), QUERY_CHUNK):
+                    chunk = codes[start:start + QUERY_CHUNK]
+                    placeholders = ', '.join('?' * len(chunk))
+                    for short_code, long_url, expires_at in conn.execute(
+                            "SELECT SHORT_URL, LONG_URL, EXPIRES_AT FROM url_mappings "
+                            f"WHERE SHORT_URL IN ({placeholders})", chunk):
+                        links[short_code] = long_url, expires_at
+        for code in sorted(final):
+            if final[code] in links:  # an alias of a deleted link resolves to nothing
+                yield (code, *links[final[code]])
+
+    def trim_deletions(self, before):
+        trimmed = 0
+        for shard in self.shards:
+            with shard.connection() as conn:
+                trimmed += conn.execute('DELETE FROM mapping_deletions WHERE DELETED_AT < ?', (before,)).rowcount
+                conn.commit()
+        return trimmed
+
+    def scan_long_urls(self):
+        def shard_rows(number, shard):
+            with shard.connection() as conn:
+                rows = conn.execute('SELECT LONG_URL_HASH, USER_ID, URL_ID, SHORT_URL, LONG_URL, CREATED_AT '
+                                    'FROM url_mappings WHERE EXPIRES_AT IS NULL '
+                                    'ORDER BY LONG_URL_HASH, USER_ID, URL_ID')
+                for hashed, user_id, url_id, short_code, long_url, created_at in rows:
+                    yield hashed, user_id, url_id, number, short_code, long_url, created_at
+
+        # every shard is read in index order, merging them keeps equal hashes next to each other
+        return heapq.merge(*(shard_rows(number, shard) for number, shard in enumerate(self.shards)))
+
+    def merge_mapping(self, short_code, target_code):
+        with self.shards[self._shard(short_code)].connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute("SELECT USER_ID FROM url_mappings WHERE SHORT_URL = ?", (short_code,)).fetchone()
+                if row is None:
+                    conn.rollback()
+                    return False
+                clicks = [(target_code, bucket, referrer, count) for bucket, referrer, count in conn.execute(
+                    "SELECT BUCKET, REFERRER, CLICKS FROM url_clicks WHERE SHORT_URL = ?", (short_code,))]
+                conn.execute("INSERT OR REPLACE INTO url_aliases (SHORT_URL, TARGET, USER_ID) VALUES (?, ?, ?)",
+                             (short_code, target_code, row[0]))
+                conn.execute("DELETE FROM url_clicks WHERE SHORT_URL = ?", (short_code,))
+                conn.execute("DELETE FROM url_mappings WHERE SHORT_URL = ?", (short_code,))
+                conn.commit()
+            except sqlite3.Error:
+                conn.rollback()
+                raise
+        # written once the alias is committed, so no two shard locks are ever held at the same time. The clicks
+        # recorded from now on already go to the target.
+        if self.record_clicks(clicks):
+            raise sqlite3.OperationalError(f"could not move the clicks of {short_code!r} to {target_code!r}")
+        return True
+
+    def record_clicks(self, rows):
+        aliases = self._resolve_aliases({row[0] for row in rows})
+        if aliases:  # clicks on a merged duplicate count for the link it was merged into
+            rows = [(aliases.get(short_code, short_code), *rest) for short_code, *rest in rows]
+        failed = []
+        for shard, shard_rows in self._group(rows, lambda row: row[0]).items():
+            with self.shards[shard].connection() as conn:
+                try:
+                    conn.executemany(UPSERT_CLICKS, shard_rows)
+                    conn.commit()
+                except sqlite3.Error:
+                    conn.rollback()
+                    logger.exception("Error while writing clicks to shard %d", shard)
+                    failed.extend(shard_rows)  # the other shards are committed, only these are retried
+        return failed
+
+    def link_clicks(self, short_code):
+        short_code = self._resolve_aliases([short_code]).get(short_code, short_code)
+        with self.shards[self._shard(short_code)].connection() as conn:
+            total = conn.execute("SELECT COALESCE(SUM(CLICKS), 0) FROM url_clicks WHERE SHORT_URL = ?",
+                                 (short_code,)).fetchone()[0]
+            buckets = conn.execute("SELECT BUCKET, SUM(CLICKS) FROM url_clicks WHERE SHORT_URL = ? "
+                                   "GROUP BY BUCKET ORDER BY BUCKET", (short_code,)).fetchall()
+            referrers = conn.execute("SELECT REFERRER, SUM(CLICKS) AS TOTAL FROM url_clicks WHERE SHORT_URL = ? "
+                                     "GROUP BY REFERRER ORDER BY TOTAL DESC LIMIT 20", (short_code,)).fetchall()
+        return total, buckets, referrers
+
+    def user_clicks(self, user_id):
+        rows = []
+        for shard in self._user_shards(user_id):
+            with self.shards[shard].connection() as conn:  # a link and its clicks always live in the same shard
+                rows.extend(conn.execute(
+                    "SELECT m.SHORT_URL, COALESCE(SUM(c.CLICKS), 0) AS TOTAL FROM url_mappings m "
+                    "LEFT JOIN url_clicks c ON c.SHORT_URL = m.SHORT_URL WHERE m.USER_ID = ? "
+                    "GROUP BY m.SHORT_URL", (user_id,)
+                ))
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return rows
+
+    def most_clicked(self, since, limit):
+        rows = []
+        for shard in self.shards:
+            with shard.connection() as conn:  # reads every counter of the shard, there is no index by bucket
+                rows.extend(conn.execute(
+                    "SELECT SHORT_URL, SUM(CLICKS) AS TOTAL FROM url_clicks WHERE BUCKET >= ? "
+                    "GROUP BY SHORT_URL ORDER BY TOTAL DESC LIMIT ?", (since, limit)
+                ))
+        return heapq.nlargest(limit, rows, key=lambda row: row[1])
+
+    def close(self):
+        for pool in self._pools():
+            pool.close_all()
+
+
+class ShardedSQLiteStorage(SQLiteStorage):  # users in the main file, links spread over shard files
+    def __init__(self, pool, shard_paths, pool_size=8):
+        shards = [ConnectionPool(path, max_size=pool_size, pragmas=SHARD_PRAGMAS) for path in shard_paths]
+        super().__init__(pool, shards)
+        self._indexed = set()  # (USER_ID, shard) pairs known to be in the index, saves a write per link
+        self._indexed_lock = threading.Lock()
+
+    def migrate(self):
+        super().migrate()
+        with self.pool.connection() as conn:
+            if conn.execute('SELECT 1 FROM url_mappings LIMIT 1').fetchone():
+                # the links of a single-file database would silently disappear, they have to be moved first
+                raise RuntimeError(f"{self.pool.database} still holds links, move them into the shards with "
+                                   f"reshard.py before starting with {self.shard_count} shards")
+
+    def _user_shards(self, user_id):
+        with self.pool.connection() as conn:
+            return [row[0] for row in conn.execute("SELECT SHARD FROM user_shards WHERE USER_ID = ? ORDER BY SHARD",
+                                                   (user_id,))]
+
+    def _index_users(self, pairs):
+        # entries are only ever added: a shard whose links were all deleted costs one empty query when listing
+        with self._indexed_lock:
+            missing = pairs - self._indexed
+        if not missing:
+            return
+        with self.pool.connection() as conn:
+            conn.executemany("INSERT OR IGNORE INTO user_shards (USER_ID, SHARD) VALUES (?, ?)", missing)
+            conn.commit()
+        with self._indexed_lock:
+            if len(self._indexed) + len(missing) > MAX_INDEXED_USERS:
+                self._indexed.clear()
+            self._indexed.update(missing)
+
+
+def make_storage(pool, shard_count=1, shard_path='url_shortener.shard{}.db', pool_size=8):
+    # builds the backend selected by the STORAGE_SHARDS setting, shard_path is formatted with the shard number
+    if shard_count <= 1:
+        return SQLiteStorage(pool)
+    return ShardedSQLiteStorage(pool, [shard_path.format(number) for number in range(shard_count)], pool_size)
@@ -0,0 +1,243 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Drives every endpoint of the application with concurrent workers and reports throughput and latency percentiles.
+# Run generate_db.py first, then point --workdir at the directory holding the generated url_shortener.db. The
+# results are written as JSON, and --compare checks them against an earlier run so regressions show up in review.
+#
+#   python generate_db.py --db /tmp/bench/url_shortener.db --users 10000 --mappings 10000000
+#   python bench_endpoints.py --workdir /tmp/bench --users 10000 --mappings 10000000 --output after.json \
+#       --compare before.json
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'API')
+sys.path.insert(0, API_DIR)
+
+from generate_db import PASSWORD, code_for, owner_of  # noqa: E402
+
+
+def percentile(sorted_values, fraction):  # nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class Worker:  # one simulated, signed-in user with its own test client (and therefore its own session cookie)
+    def __init__(self, app, user_id, users, mappings, rng):
+        self.client = app.test_client()
+        self.user_id = user_id
+        self.users = users
+        self.mappings = mappings
+        self.rng = rng
+        response = self.client.post('/signin', data={'EMAIL': f'bench{user_id}@example.com', 'PASSWORD': PASSWORD})
+        if response.status_code != 302 or not response.location.endswith('/urlshortener'):
+            raise RuntimeError(f"Could not sign in as bench{user_id}@example.com, was the database generated?")
+        # the /api/v1 endpoints are called with a bearer token and without the session cookie
+        token = self.client.post('/api/v1/tokens', json={'name': 'bench'}).get_json()['token']
+        self.api_client = app.test_client()
+        self.api_headers = {'Authorization': f'Bearer {token}'}
+
+    def owned_code(self):  # a random code owned by this worker's user
+        owned = (self.mappings - self.user_id) // self.users + 1  # how many of the mappings belong to the user
+        index = self.user_id - 1 + self.rng.randrange(owned) * self.users
+        assert owner_of(index, self.users) == self.user_id
+        return code_for(index)
+
+
+def shorten(worker, _):
+    return worker.client.post('/shorten-url', data={'original_url': f'https://example.com/new/{worker.rng.random()}'})
+
+
+def redirect(worker, _):
+    return worker.client.post('/redirect', data={'shortURL': 'https://short-url/' + worker.owned_code()})
+
+
+def follow(worker, _):  # the public GET /<code> route
+    return worker.client.get('/' + code_for(worker.rng.randrange(worker.mappings)))
+
+
+def test_url(worker, _):  # half of the tested codes exist, half are typos
+    code = worker.owned_code() if worker.rng.random() < 0.5 else 'missing' + str(worker.rng.randrange(10 ** 9))
+    return worker.client.post('/test-url', data={'test-url': 'https://short-url/' + code})
+
+
+def list_urls(worker, _):
+    return worker.client.get('/list-urls')
+
+
+def generate_qr_code(worker, _):
+    return worker.client.post('/generate-qr-code', data={'full_short_url': 'https://short-url/' + worker.owned_code()})
+
+
+def delete_url(worker, number):  # every request deletes a different mapping of the worker's user
+    index = worker.user_id - 1 + (number + 1) * worker.users
+    if index >= worker.mappings:
+        index = worker.user_id - 1
+    return worker.client.post('/delete-url', data={'short-url-to-delete': code_for(index)})
+
+
+def api_shorten(worker, _):
+    return worker.api_client.post('/api/v1/links', json={'url': f'https://example.com/new/{worker.rng.random()}'},
+                                  headers=worker.api_headers)
+
+
+def api_resolve(worker, _):  # the JSON counterpart of /redirect, public like GET /<code>
+    return worker.api_client.get('/api/v1/links/' + worker.owned_code())
+
+
+def api_exists(worker, _):  # the JSON counterpart of /test-url
+    code = worker.owned_code() if worker.rng.random() < 0.5 else 'missing' + str(worker.rng.randrange(10 ** 9))
+    return worker.api_client.get(f'/api/v1/links/{code}/exists', headers=worker.api_headers)
+
+
+def api_list(worker, _):
+    return worker.api_client.get('/api/v1/links', headers=worker.api_headers)
+
+
+def api_delete(worker, number):  # deletes the mappings delete_url leaves alone, from the other end of the user's list
+    owned = (worker.mappings - worker.user_id) // worker.users + 1
+    index = worker.user_id - 1 + max(owned - 1 - number, 0) * worker.users
+    return worker.api_client.delete('/api/v1/links/' + code_for(index), headers=worker.api_headers)
+
+
+ENDPOINTS = {  # name -> (request function, status codes that count as a success)
+    'shorten-url': (shorten, {200}),
+    'redirect': (redirect, {302}),
+    'follow': (follow, {301, 302}),
+    'test-url': (test_url, {200}),
+    'list-urls': (list_urls, {200}),
+    'generate-qr-code': (generate_qr_code, {200}),
+    'delete-url': (delete_url, {200, 401}),  # 401 once a worker runs out of mappings to delete
+    'api-shorten': (api_shorten, {200, 201}),
+    'api-resolve': (api_resolve, {200, 404}),  # 404 for the mappings the delete endpoints removed
+    'api-exists': (api_exists, {200}),
+    'api-list': (api_list, {200}),
+    'api-delete': (api_delete, {204, 404}),  # 404 once a worker runs out of mappings to delete
+}
+
+
+def run_endpoint(workers, name, requests_per_worker):  # runs one endpoint on all workers at once
+    request_function, ok_statuses = ENDPOINTS[name]
+    latencies = []
+    errors = 0
+    response_bytes = 0
+    lock = threading.Lock()
+
+    def drive(worker):
+        nonlocal errors, response_bytes
+        own_latencies = []
+        own_errors = 0
+        own_bytes = 0
+        for number in range(requests_per_worker):
+            started = time.perf_counter()
+            response = request_function(worker, number)
+            own_latencies.append(time.perf_counter() - started)
+            own_bytes += len(response.data)
+            if response.status_code not in ok_statuses:
+                own_errors += 1
+        with lock:
+            latencies.extend(own_latencies)
+            errors += own_errors
+            response_bytes += own_bytes
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+        list(executor.map(drive, workers))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': elapsed,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'mean_ms': 1000 * sum(latencies) / len(latencies) if latencies else 0.0,
+        'p50_ms': 1000 * percentile(latencies, 0.50),
+        'p95_ms': 1000 * percentile(latencies, 0.95),
+        'p99_ms': 1000 * percentile(latencies, 0.99),
+        'mean_response_bytes': response_bytes / len(latencies) if latencies else 0.0,
+    }
+
+
+def compare(results, baseline, max_regression):  # prints the change against a baseline, returns the regressions
+    regressions = []
+    print(f"\n{'endpoint':<18}{'p95 before':>12}{'p95 after':>12}{'change':>10}")
+    for name, current in results['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(name)
+        if not previous or not previous['p95_ms']:
+            continue
+        change = current['p95_ms'] / previous['p95_ms'] - 1
+        print(f"{name:<18}{previous['p95_ms']:>11.2f}ms{current['p95_ms']:>10.2f}ms{change:>+10.1%}")
+        if change > max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the URL shortener endpoints.")
+    parser.add_argument('--workdir', required=True, help="directory holding the url_shortener.db to run against")
+    parser.add_argument('--users', type=int, required=True, help="--users given to generate_db.py")
+    parser.add_argument('--mappings', type=int, required=True, help="--mappings given to generate_db.py")
+    parser.add_argument('--concurrency', type=int, default=8, help="number of concurrent workers")
+    parser.add_argument('--requests', type=int, default=200, help="requests per worker and endpoint")
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help="comma separated endpoints to run")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="a previous results file to compare against")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="fail when a p95 latency grows by more than this fraction (default 0.2)")
+    args = parser.parse_args()
+
+    if args.concurrency > args.users:
+        parser.error("--concurrency cannot be larger than --users, every worker signs in as its own user")
+
+    os.chdir(args.workdir)  # the application opens url_shortener.db relative to the working directory
+    import app as app_module
+
+    # every worker signs in from 127.0.0.1, so the per-IP sign in limit has to let all of them through at once
+    app = app_module.create_app({'AUTH_IP_BURST': max(20, args.concurrency)})
+    rng = random.Random(args.seed)
+    workers = [Worker(app, user_id, args.users, args.mappings, random.Random(rng.random()))
+               for user_id in range(1, args.concurrency + 1)]
+
+    results = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'users': args.users,
+            'mappings': args.mappings,
+            'concurrency': args.concurrency,
+            'requests_per_worker': args.requests,
+        },
+        'endpoints': {},
+    }
+
+    print(f"{'endpoint':<18}{'rps':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'errors':>8}{'bytes':>8}")
+    for name in args.endpoints.split(','):
+        result = run_endpoint(workers, name, args.requests)
+        results['endpoints'][name] = result
+        print(f"{name:<18}{result['throughput_rps']:>10.1f}{result['p50_ms']:>8.2f}ms{result['p95_ms']:>8.2f}ms"
+              f"{result['p99_ms']:>8.2f}ms{result['errors']:>8}{result['mean_response_bytes']:>8.0f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        if regressions:
+            print(f"\np95 regressed by more than {args.max_regression:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
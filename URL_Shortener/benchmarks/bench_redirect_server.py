@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+# Drives a running redirect_server.py with many concurrent keep-alive connections and reports throughput and latency
+# percentiles. Every connection sends one GET /<code> at a time and waits for the answer, the codes are drawn from the
+# codes generate_db.py wrote (--miss-rate of them are unknown codes).
+#
+#   python ../API/snapshot.py --db /tmp/bench/url_shortener.db --out /tmp/bench/url_shortener.snapshot
+#   python ../API/redirect_server.py --snapshot /tmp/bench/url_shortener.snapshot --port 8080 --workers 4 &
+#   python bench_redirect_server.py --port 8080 --mappings 10000000 --connections 2000
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'API')
+sys.path.insert(0, API_DIR)
+
+from bench_endpoints import percentile  # noqa: E402
+from generate_db import code_for  # noqa: E402
+
+
+async def client(host, port, codes, requests, latencies, errors):  # one keep-alive connection
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for code in codes[:requests]:
+            started = time.perf_counter()
+            writer.write(f'GET /{code} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode('ascii'))
+            head = await reader.readuntil(b'\r\n\r\n')
+            latencies.append(time.perf_counter() - started)
+            status = int(head.split(b' ', 2)[1])
+            length = int(head.lower().split(b'content-length:', 1)[1].split(b'\r\n', 1)[0])
+            if length:
+                await reader.readexactly(length)
+            if status not in (302, 301, 307, 308, 404):
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    codes = [[code_for(rng.randrange(args.mappings)) if rng.random() >= args.miss_rate else f'missing{n}'
+              for n in range(args.requests)] for _ in range(args.connections)]
+    latencies, errors = [], []
+    started = time.perf_counter()
+    await asyncio.gather(*(client(args.host, args.port, connection_codes, args.requests, latencies, errors)
+                           for connection_codes in codes))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a running redirect_server.py.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--mappings', type=int, required=True, help="--mappings given to generate_db.py")
+    parser.add_argument('--connections', type=int, default=1000, help="concurrent keep-alive connections")
+    parser.add_argument('--requests', type=int, default=100, help="requests per connection")
+    parser.add_argument('--miss-rate', type=float, default=0.1, help="fraction of requests for unknown codes")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    # latencies are measured by a single client process, at high concurrency they include its own queueing
+    print(f"{args.connections} connections: {result['rps']:.0f} requests/s, p50 {result['p50_ms']:.2f}ms, "
+          f"p95 {result['p95_ms']:.2f}ms, p99 {result['p99_ms']:.2f}ms, {result['errors']} errors")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                                'python': platform.python_version(), 'platform': platform.platform(),
+                                'mappings': args.mappings, 'connections': args.connections}, 'result': result},
+                      f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+# Measures how long a new worker takes to become useful: importing app.py, create_app() and the first requests, each
+# run in a fresh process so nothing is cached in memory. Run generate_db.py first and point --workdir at its directory.
+#
+#   python bench_startup.py --workdir /tmp/bench --runs 5 --output startup.json
+#
+# Scenarios:
+#   snapshot    the short code filter snapshot of the previous run is there (the usual restart)
+#   cold        no filter snapshot, the filter is built from url_mappings before the first request
+#   background  no filter snapshot, WARM_CACHES loads the filter and the caches while requests are served
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'API')
+SCENARIOS = {
+    'snapshot': (True, {}),  # (keep the filter snapshot, create_app() settings)
+    'cold': (False, {}),
+    'background': (False, {'WARM_CACHES': True}),
+}
+TIMINGS = ('import_ms', 'create_ms', 'first_page_ms', 'first_redirect_ms', 'ready_ms')
+
+
+def child(scenario):  # runs in the measured process, prints its timings as JSON
+    started = time.perf_counter()
+    sys.path.insert(0, API_DIR)
+    import app as app_module
+    imported = time.perf_counter()
+    app = app_module.create_app(SCENARIOS[scenario][1])
+    created = time.perf_counter()
+    client = app.test_client()
+    page = client.get('/')  # renders a template
+    paged = time.perf_counter()
+    from generate_db import code_for
+    redirect = client.get('/' + code_for(0))  # the cache, the filter and the database
+    redirected = time.perf_counter()
+    if page.status_code != 200 or redirect.status_code not in (301, 302):
+        raise SystemExit(f"unexpected responses {page.status_code} and {redirect.status_code}, was the database "
+                         f"generated?")
+    print(json.dumps({
+        'import_ms': 1000 * (imported - started),
+        'create_ms': 1000 * (created - imported),
+        'first_page_ms': 1000 * (paged - created),
+        'first_redirect_ms': 1000 * (redirected - paged),
+        'ready_ms': 1000 * (redirected - started),
+    }))
+
+
+def measure(workdir, scenario, runs):  # returns the median of every timing over runs fresh processes
+    keep_snapshot = SCENARIOS[scenario][0]
+    snapshot = os.path.join(workdir, 'short_codes.filter')
+    samples = []
+    for _ in range(runs):
+        if not keep_snapshot and os.path.exists(snapshot):
+            os.remove(snapshot)
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', scenario], cwd=workdir,
+                                check=True, capture_output=True, text=True).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))  # the child prints its timings last
+    return {name: statistics.median(sample[name] for sample in samples) for name in TIMINGS}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the start of a new application process.")
+    parser.add_argument('--workdir', help="directory holding the url_shortener.db to start against")
+    parser.add_argument('--runs', type=int, default=5, help="fresh processes per scenario, the median is reported")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="comma separated scenarios to run")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="a previous results file to compare against")
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help="fail when a scenario's ready time grows by more than this fraction (default 0.2)")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+    if not args.workdir:
+        parser.error("--workdir is required")
+
+    # a first start, so the snapshot scenario finds a filter snapshot and every scenario finds the schema up to date
+    measure(args.workdir, 'snapshot', 1)
+
+    results = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'runs': args.runs,
+        },
+        'scenarios': {},
+    }
+    print(f"{'scenario':<12}" + ''.join(f"{name[:-3]:>16}" for name in TIMINGS))
+    for scenario in args.scenarios.split(','):
+        result = measure(args.workdir, scenario, args.runs)
+        results['scenarios'][scenario] = result
+        print(f"{scenario:<12}" + ''.join(f"{result[name]:>14.1f}ms" for name in TIMINGS))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = []
+        for scenario, current in results['scenarios'].items():
+            previous = baseline.get('scenarios', {}).get(scenario)
+            if not previous or not previous['ready_ms']:
+                continue
+            change = current['ready_ms'] / previous['ready_ms'] - 1
+            print(f"{scenario:<12} ready {previous['ready_ms']:.1f}ms -> {current['ready_ms']:.1f}ms ({change:+.1%})")
+            if change > args.max_regression:
+                regressions.append(scenario)
+        if regressions:
+            print(f"\nready time regressed by more than {args.max_regression:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
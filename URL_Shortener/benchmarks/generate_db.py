@@ -0,0 +1,85 @@
+import argparse
+import os
+import sqlite3  # for database operations, a database engine, a relational database management system
+import sys
+import time
+
+# Generates a synthetic url_shortener.db for the benchmarks.
+# Users are called bench<N>@example.com and all share the password 'benchmark'. Mapping i belongs to user
+# (i % users) + 1 and gets the code the sequence allocator would have produced for i, so bench_endpoints.py can work
+# out which codes exist and who owns them without reading them back.
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'API')
+sys.path.insert(0, API_DIR)
+
+from werkzeug.security import generate_password_hash  # noqa: E402
+
+from allocator import SequenceAllocator, base62_encode  # noqa: E402
+from long_urls import long_url_hash  # noqa: E402
+from migrations import migrate  # noqa: E402
+
+PASSWORD = 'benchmark'  # the password of every synthetic user
+
+
+def code_for(index):  # the short code of mapping number index
+    return base62_encode(SequenceAllocator().offset + index)
+
+
+def owner_of(index, users):  # the user ID owning mapping number index
+    return index % users + 1
+
+
+def generate(path, users, mappings, chunk_size=50000):
+    if os.path.exists(path):
+        os.remove(path)
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')  # like the files the application creates (db.PRAGMAS)
+    migrate(conn)
+
+    # the data is thrown away if the load fails, so durability is switched off while loading
+    conn.execute('PRAGMA journal_mode = OFF')
+    conn.execute('PRAGMA synchronous = OFF')
+
+    started = time.perf_counter()
+    password_hash = generate_password_hash(PASSWORD)  # hashed once, every user gets the same hash
+    conn.executemany("INSERT INTO users (ID, NAME, EMAIL, PASSWORD) VALUES (?, ?, ?, ?)",
+                     ((user_id, f'bench{user_id}', f'bench{user_id}@example.com', password_hash)
+                      for user_id in range(1, users + 1)))
+    conn.commit()
+
+    created_at = int(time.time())
+    for start in range(0, mappings, chunk_size):
+        stop = min(start + chunk_size, mappings)
+        conn.executemany("INSERT INTO url_mappings (URL_ID, USER_ID, LONG_URL, SHORT_URL, CREATED_AT, LONG_URL_HASH) "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         ((index + 1, owner_of(index, users), f'https://example.com/page/{index}', code_for(index),
+                           created_at, long_url_hash(f'https://example.com/page/{index}'))
+                          for index in range(start, stop)))
+        conn.commit()
+        print(f"\r{stop}/{mappings} mappings", end='', flush=True)
+    print()
+
+    # the application's allocator continues after the synthetic codes
+    conn.execute("UPDATE code_sequences SET NEXT_VALUE = ? WHERE NAME = 'short_code'", (mappings,))
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.close()
+
+    print(f"Generated {users} users and {mappings} mappings in {time.perf_counter() - started:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic url_shortener.db for benchmarking.")
+    parser.add_argument('--db', default='url_shortener.db', help="path of the database file to (re)create")
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--mappings', type=int, default=1000000)
+    parser.add_argument('--chunk-size', type=int, default=50000, help="rows inserted per transaction")
+    args = parser.parse_args()
+
+    generate(args.db, args.users, args.mappings, args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
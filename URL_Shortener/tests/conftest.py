@@ -0,0 +1,62 @@
+import os
+import sys
+
+import pytest
+
+# The tests run the application against a fresh database in a temporary directory, one per test. The modules of
+# API/ import each other by their plain names, like the benchmarks they are put on the path first.
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'API')
+sys.path.insert(0, API_DIR)
+
+TEST_CONFIG = {
+    'TESTING': True,
+    'SHORT_CODE_FILTER_SNAPSHOT': None,  # nothing is saved at exit, the temporary directory is gone by then
+    'SHORT_CODE_FILTER_REFRESH': 0,  # every filter lookup catches up with the database first
+    'LINK_PURGE_INTERVAL': None,  # the tests purge by hand
+    'ANALYTICS_FLUSH_INTERVAL': 3600,  # and flush by hand
+    'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',  # fast hashes, the cost does not matter here
+    'PASSWORD_HASH_WORKERS': 1,
+}
+
+
+@pytest.fixture
+def database(tmp_path):  # the database file the application is built on, a test module can prepare its own
+    return tmp_path / 'url_shortener.db'
+
+
+@pytest.fixture
+def app_module(tmp_path, database, monkeypatch):  # the app module with an application built by create_app()
+    monkeypatch.chdir(tmp_path)  # the default file names (url_shortener.db, qr_cache) are relative
+    import app as app_module
+    app_module.create_app({**TEST_CONFIG, 'DATABASE': str(database),
+                           'QR_CACHE_DIR': str(tmp_path / 'qr_cache')})
+    yield app_module
+    app_module.click_recorder.stop()
+    app_module.link_purger.stop()
+    app_module.password_hasher.shutdown()
+    app_module.storage.close()  # the pool is shared by the process, the next test opens another file
+
+
+@pytest.fixture
+def app(app_module):
+    return app_module.app
+
+
+@pytest.fixture
+def storage(app_module):
+    return app_module.storage
+
+
+@pytest.fixture
+def user_id(storage):  # a user that owns the links a test creates
+    return storage.create_user('Test', 'test@example.com', 'not a real hash')
+
+
+@pytest.fixture
+def client(app):  # a test client signed in as a fresh user
+    client = app.test_client()
+    client.post('/signup', data={'NAME': 'Test', 'EMAIL': 'client@example.com', 'PASSWORD': 'secret'})
+    response = client.post('/signin', data={'EMAIL': 'client@example.com', 'PASSWORD': 'secret'})
+    assert response.status_code == 302
+    return client
@@ -0,0 +1,36 @@
+import time
+
+from allocator import RandomPoolAllocator, SequenceAllocator, base62_decode, base62_encode
+
+
+def test_base62_round_trip():
+    assert base62_encode(0) == '0'
+    assert base62_encode(61) == 'z'
+    assert base62_encode(62) == '10'
+    assert all(base62_decode(base62_encode(number)) == number for number in (1, 62 ** 5, 10 ** 12))
+
+
+def test_workers_reserve_separate_blocks(storage):
+    first, second = SequenceAllocator(block_size=10), SequenceAllocator(block_size=10)
+    first_codes = [first.next_code(storage) for _ in range(15)]  # spans two blocks
+    second_codes = second.next_codes(storage, 5)
+    assert first_codes[0] == '100000' and all(len(code) == 6 for code in first_codes)
+    assert not set(first_codes) & set(second_codes)
+    assert second_codes[0] == base62_encode(62 ** 5 + 20)  # after the two blocks of the first worker
+    assert first.next_codes(storage, 5) == [base62_encode(62 ** 5 + number) for number in range(15, 20)]
+
+
+def test_a_custom_code_taken_first_is_skipped(app_module, user_id):
+    now = int(time.time())
+    assert app_module.create_link(user_id, 'https://example.com/custom', '100000', now) == ('100000', True)
+    # the allocator hands out 100000 next, the insert fails on the unique index and the next code is used
+    assert app_module.create_link(user_id, 'https://example.com/next', None, now) == ('100001', True)
+
+
+def test_the_random_pool_leaves_out_codes_in_use(storage, user_id, monkeypatch):
+    storage.insert_mapping(user_id, 'https://example.com/taken', 'TAKEN1', int(time.time()))
+    candidates = iter(['TAKEN1', 'FREE01', 'FREE02', 'FREE03', 'FREE04', 'FREE05'])
+    allocator = RandomPoolAllocator(block_size=2)
+    monkeypatch.setattr(allocator, '_random_code', lambda: next(candidates))
+    codes = allocator.next_codes(storage, 3)
+    assert len(set(codes)) == 3 and 'TAKEN1' not in codes
@@ -0,0 +1,41 @@
+import sqlite3
+import time
+
+import pytest
+
+from analytics import link_stats
+
+
+@pytest.fixture
+def short_code(app_module, user_id):
+    return app_module.create_link(user_id, 'https://example.com/clicked', None, int(time.time()))[0]
+
+
+def test_redirects_are_written_in_one_flush(app_module, app, storage, short_code):
+    visitor = app.test_client()
+    visitor.get(f'/{short_code}', headers={'Referer': 'https://news.example.org/item?id=1'})
+    visitor.get(f'/{short_code}', headers={'Referer': 'https://news.example.org/item?id=2'})
+    visitor.get(f'/{short_code}')
+    assert storage.link_clicks(short_code)[0] == 0  # only buffered so far
+
+    assert app_module.click_recorder.flush() == 3
+    stats = link_stats(storage, short_code)
+    assert stats['clicks'] == 3
+    assert {row['referrer']: row['clicks'] for row in stats['referrers']} == {'news.example.org': 2, None: 1}
+    assert app_module.click_recorder.flush() == 0
+
+
+def test_clicks_of_a_failed_write_are_kept(app_module, storage, short_code, monkeypatch):
+    recorder = app_module.click_recorder
+    recorder.record(short_code, 'https://example.org/')
+    recorder.record(short_code)
+
+    def locked(rows):
+        raise sqlite3.OperationalError("database is locked")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(storage, 'record_clicks', locked)
+        with pytest.raises(sqlite3.OperationalError):
+            recorder.flush()
+    assert recorder.flush() == 2  # the next flush writes them
+    assert storage.link_clicks(short_code)[0] == 2
@@ -0,0 +1,41 @@
+import pytest
+
+
+@pytest.fixture
+def token(client):
+    response = client.post('/api/v1/tokens', json={'name': 'tests'})
+    assert response.status_code == 201
+    return response.get_json()['token']
+
+
+def test_bearer_tokens(app, token):
+    api = app.test_client()  # no session cookie, only the token
+    assert api.post('/api/v1/links', json={'url': 'https://example.com/api'}).status_code == 401
+    assert api.get('/api/v1/links', headers={'Authorization': 'Bearer not-a-token'}).status_code == 401
+
+    headers = {'Authorization': f'Bearer {token}'}
+    response = api.post('/api/v1/links', json={'url': 'https://example.com/api', 'code': 'apicode'}, headers=headers)
+    assert response.status_code == 201 and response.get_json()['code'] == 'apicode'
+    assert api.get('/api/v1/links/apicode/exists', headers=headers).get_json()['exists']
+
+    assert api.delete('/api/v1/tokens', headers=headers).status_code == 204
+    assert api.get('/api/v1/links', headers=headers).status_code == 401  # revoked, the cache forgets it too
+
+
+def test_resolve_answers_if_none_match(app, token):
+    api = app.test_client()
+    headers = {'Authorization': f'Bearer {token}'}
+    api.post('/api/v1/links', json={'url': 'https://example.com/first', 'code': 'etagged'}, headers=headers)
+
+    response = api.get('/api/v1/links/etagged')
+    assert response.status_code == 200 and response.get_json()['long_url'] == 'https://example.com/first'
+    etag = response.headers['ETag']
+    assert api.get('/api/v1/links/etagged', headers={'If-None-Match': etag}).status_code == 304
+    assert api.head('/api/v1/links/etagged', headers={'If-None-Match': etag}).status_code == 304
+
+    # the code now points somewhere else, the old ETag no longer matches
+    assert api.delete('/api/v1/links/etagged', headers=headers).status_code == 204
+    api.post('/api/v1/links', json={'url': 'https://example.com/second', 'code': 'etagged'}, headers=headers)
+    response = api.get('/api/v1/links/etagged', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    assert api.get('/api/v1/links/missing').status_code == 404
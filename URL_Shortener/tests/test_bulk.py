@@ -0,0 +1,48 @@
+import json
+import sqlite3
+
+import pytest
+
+from bulk import Importer
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_an_interrupted_import_resumes_from_its_checkpoint(database, storage, user_id, tmp_path, monkeypatch):
+    source = tmp_path / 'links.jsonl'
+    with open(source, 'w') as f:
+        for number in range(10):  # every other row gets a generated code
+            record = {'email': 'test@example.com', 'long_url': f'https://example.com/{number}'}
+            if number % 2:
+                record['short_code'] = f'custom{number}'
+            f.write(json.dumps(record) + '\n')
+
+    write_chunk = Importer._write_chunk
+    calls = []
+
+    def stop_at_the_third_chunk(importer, chunk, chunk_end):
+        calls.append(chunk_end)
+        if len(calls) == 3:
+            raise Interrupted()  # as if the process was killed before the chunk was written
+        write_chunk(importer, chunk, chunk_end)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(Importer, '_write_chunk', stop_at_the_third_chunk)
+        with pytest.raises(Interrupted):
+            Importer(str(database), str(source), 'jsonl', chunk_size=3).run()
+
+    conn = sqlite3.connect(database)
+    assert conn.execute('SELECT COUNT(*) FROM url_mappings').fetchone()[0] == 6
+    assert conn.execute('SELECT OFFSET FROM import_checkpoints').fetchone()[0] == calls[1]
+
+    Importer(str(database), str(source), 'jsonl', chunk_size=3).run()
+    rows = conn.execute('SELECT LONG_URL, SHORT_URL FROM url_mappings ORDER BY URL_ID').fetchall()
+    assert [long_url for long_url, _ in rows] == [f'https://example.com/{number}' for number in range(10)]
+    assert len({short_code for _, short_code in rows}) == 10
+    assert conn.execute('SELECT COUNT(*) FROM import_checkpoints').fetchone()[0] == 0
+    # the indexes dropped for the load are back
+    assert conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'idx_url_mappings_short_unique'").fetchone()[0]
+    conn.close()
+    assert storage.get_long_url('custom7') == 'https://example.com/7'
@@ -0,0 +1,38 @@
+import time
+
+from compact_urls import compact
+
+
+def test_dedup_stays_within_a_user(app_module, storage, user_id):
+    app_module.app.config['DEDUP_MODE'] = 'user'
+    other_user = storage.create_user('Other', 'other@example.com', 'not a real hash')
+    now = int(time.time())
+    first, created = app_module.create_link(user_id, 'https://example.com/page', None, now)
+    assert created
+    again, created = app_module.create_link(user_id, 'HTTPS://EXAMPLE.COM/page', None, now)
+    assert (again, created) == (first, False)
+    theirs, created = app_module.create_link(other_user, 'https://example.com/page', None, now)
+    assert created and theirs != first
+
+
+def test_compact_merges_a_users_duplicates_only(app_module, storage, user_id):
+    other_user = storage.create_user('Other', 'other@example.com', 'not a real hash')
+    storage.insert_mapping(user_id, 'https://example.com/page', 'MINE1', 1)
+    storage.insert_mapping(user_id, 'https://example.com/page', 'MINE2', 2)
+    storage.insert_mapping(other_user, 'https://example.com/page', 'THEIRS', 3)
+    compact(storage)
+
+    assert storage.get_long_url('MINE2', user_id) == 'https://example.com/page'  # now an alias of MINE1
+    assert [row[1] for row in storage.list_page(other_user)[0]] == ['THEIRS']
+    # the other user deleting their link leaves this user's links alone
+    assert storage.delete_mapping(other_user, 'THEIRS')
+    assert storage.get_link('MINE1') is not None and storage.get_link('MINE2') is not None
+
+
+def test_an_owner_can_delete_a_merged_code(app_module, storage, user_id):
+    storage.insert_mapping(user_id, 'https://example.com/page', 'MINE1', 1)
+    storage.insert_mapping(user_id, 'https://example.com/page', 'MINE2', 2)
+    compact(storage)
+    assert app_module.delete_link(user_id, 'MINE2')
+    assert storage.get_link('MINE2') is None
+    assert not app_module.delete_link(user_id, 'MINE2')
@@ -0,0 +1,33 @@
+import time
+
+import pytest
+
+from expiry import parse_expiry
+
+
+def test_parse_expiry():
+    assert parse_expiry(expires_in='60', now=1000) == 1060
+    assert parse_expiry(expires_at=2000, now=1000) == 2000
+    assert parse_expiry(default_ttl=30, now=1000) == 1030
+    assert parse_expiry(now=1000) is None
+    with pytest.raises(ValueError):
+        parse_expiry(expires_at=999, now=1000)
+    with pytest.raises(ValueError):
+        parse_expiry(expires_in='-5', now=1000)
+
+
+def test_expired_links_are_purged_in_batches(app_module, app, storage, user_id):
+    now = int(time.time())
+    for number in range(5):
+        storage.insert_mapping(user_id, f'https://example.com/old{number}', f'OLD{number}', now - 100, now - 10)
+    storage.insert_mapping(user_id, 'https://example.com/kept', 'KEPT', now - 100)
+    storage.record_clicks([('OLD0', now - now % 3600, '', 4)])
+    assert app.test_client().get('/OLD0').status_code == 404  # gone for the redirect before the purge runs
+
+    purger = app_module.link_purger
+    purger.batch_size, purger.pause = 2, 0
+    assert purger.purge(now) == 5
+    assert purger.stats()['purged'] == 5
+    assert storage.link_clicks('OLD0')[0] == 0  # the clicks went with the link
+    assert storage.get_long_url('KEPT') == 'https://example.com/kept'
+    assert purger.purge(now) == 0
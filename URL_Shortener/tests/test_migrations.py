@@ -0,0 +1,51 @@
+import sqlite3
+
+import pytest
+
+from migrations import MIGRATIONS, migrate, schema_version
+from short_codes import SHORT_URL_PREFIX
+
+
+@pytest.fixture
+def database(tmp_path):  # a database as the first release left it: prefixed codes that several users share
+    path = tmp_path / 'url_shortener.db'
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE users '
+                 '(ID INTEGER PRIMARY KEY AUTOINCREMENT, NAME TEXT, EMAIL TEXT UNIQUE, PASSWORD TEXT)')
+    conn.execute('CREATE TABLE url_mappings (URL_ID INTEGER PRIMARY KEY AUTOINCREMENT,  USER_ID INTEGER, '
+                 'LONG_URL TEXT, SHORT_URL TEXT, FOREIGN KEY (USER_ID) REFERENCES users(ID))')
+    conn.executemany('INSERT INTO users (NAME, EMAIL, PASSWORD) VALUES (?, ?, ?)',
+                     [('First', 'first@example.com', ''), ('Second', 'second@example.com', '')])
+    conn.executemany('INSERT INTO url_mappings (USER_ID, LONG_URL, SHORT_URL) VALUES (?, ?, ?)', [
+        (1, 'https://example.com/first', SHORT_URL_PREFIX + 'shared'),
+        (1, 'https://example.com/again', SHORT_URL_PREFIX + 'shared'),  # the same user twice, dropped
+        (2, 'https://example.com/second', SHORT_URL_PREFIX + 'shared'),  # another user, renamed
+        (2, 'https://example.com/bare', 'bare'),
+    ])
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_a_new_database_gets_every_migration(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'new.db')
+    assert migrate(conn) == len(MIGRATIONS)
+    assert migrate(conn) == len(MIGRATIONS)  # nothing left to do the second time
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {'users', 'url_mappings', 'short_code_renames', 'url_clicks', 'api_tokens', 'mapping_deletions'} <= tables
+    conn.close()
+
+
+def test_an_old_database_is_upgraded_in_place(app_module, database, storage):
+    conn = sqlite3.connect(database)
+    assert schema_version(conn) == len(MIGRATIONS)
+    rows = conn.execute('SELECT USER_ID, SHORT_URL, LONG_URL_HASH IS NOT NULL FROM url_mappings ORDER BY URL_ID')
+    assert rows.fetchall() == [(1, 'shared', 1), (2, 'shared-3', 1), (2, 'bare', 1)]
+    assert conn.execute('SELECT OLD_CODE, USER_ID, NEW_CODE FROM short_code_renames').fetchall() == \
+        [('shared', 2, 'shared-3')]
+    conn.close()
+
+    assert storage.get_long_url('shared') == 'https://example.com/first'
+    # the second user still reaches their link under the code they had before
+    assert storage.get_long_url('shared', 2) == 'https://example.com/second'
+    assert storage.get_long_url('shared-3', 2) == 'https://example.com/second'
@@ -0,0 +1,31 @@
+import time
+
+from cuckoo import CuckooFilter
+
+
+def test_cuckoo_filter_add_and_remove():
+    codes = [f'code{number}' for number in range(1000)]
+    cuckoo = CuckooFilter(capacity=2000)
+    assert all(cuckoo.add(code) for code in codes)
+    assert all(code in cuckoo for code in codes)
+    assert cuckoo.remove('code1')
+    assert 'code1' not in cuckoo
+    assert cuckoo.count == 999
+
+
+def test_created_then_deleted_code_is_gone(app_module, user_id):
+    code_filter = app_module.short_code_filter
+    short_code, created = app_module.create_link(user_id, 'https://example.com/a', None, int(time.time()))
+    assert created
+    assert code_filter.might_contain(short_code)  # catches up with the row add() already put in the filter
+    assert code_filter.stats()['items'] == 1
+
+    assert app_module.delete_link(user_id, short_code)
+    assert not code_filter.might_contain(short_code)
+    assert code_filter.stats()['items'] == 0
+
+
+def test_codes_created_by_another_process_are_caught_up(app_module, storage, user_id):
+    storage.insert_mapping(user_id, 'https://example.com/elsewhere', 'ELSEWHERE', int(time.time()))
+    assert app_module.short_code_filter.might_contain('ELSEWHERE')
+    assert not app_module.short_code_filter.might_contain('NOWHERE')